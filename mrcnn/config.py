@@ -84,6 +84,11 @@ class Config(object):
     # If 2, then anchors are created for every other cell, and so on.
     RPN_ANCHOR_STRIDE = 1
 
+    # Directory to cache generated anchors in. If set, anchors are saved as
+    # .npy files and memory-mapped read-only, so data generator workers share
+    # one copy and later runs skip generating them. None keeps them in memory.
+    ANCHOR_CACHE_DIR = None
+
     # Non-max suppression threshold to filter RPN proposals.
     # You can increase this during training to generate more propsals.
     RPN_NMS_THRESHOLD = 0.7
@@ -94,6 +99,17 @@ class Config(object):
     # ROIs kept after tf.nn.top_k and before non-maximum suppression
     PRE_NMS_LIMIT = 6000
 
+    # If set, ROIs are picked with tf.nn.top_k on each pyramid level
+    # separately, keeping up to this many per level, and then merged for
+    # non-maximum suppression. PRE_NMS_LIMIT is ignored in this mode.
+    # Detectron uses 1000 per level.
+    PRE_NMS_LIMIT_PER_LEVEL = None
+
+    # Minimum RPN foreground score for an ROI to be considered in
+    # non-maximum suppression. None keeps all of them. A small value,
+    # such as 0.01, drops near-zero anchors early on high resolution images.
+    PRE_NMS_MIN_SCORE = None
+
     # ROIs kept after non-maximum suppression (training and inference)
     POST_NMS_ROIS_TRAINING = 2000
     POST_NMS_ROIS_INFERENCE = 1000
@@ -119,6 +135,14 @@ class Config(object):
     #         up before padding. IMAGE_MAX_DIM is ignored in this mode.
     #         The multiple of 64 is needed to ensure smooth scaling of feature
     #         maps up and down the 6 levels of the FPN pyramid (2**6=64).
+    #         Images of different aspect ratios get different shapes. They're
+    #         batched by shape in training and in MaskRCNN.detect().
+    # native: Pads the bottom and right sides with zeros to make them
+    #         multiples of 64, without scaling. Meant for fixed size camera
+    #         streams: a 640x480 frame is run at 640x512, and detections
+    #         are in frame coordinates without rescaling. The window and
+    #         image meta are computed once per frame shape. IMAGE_MIN_DIM,
+    #         IMAGE_MAX_DIM and IMAGE_MIN_SCALE are ignored in this mode.
     # crop:   Picks random crops from the image. First, scales the image based
     #         on IMAGE_MIN_DIM and IMAGE_MIN_SCALE, then picks a random crop of
     #         size IMAGE_MIN_DIM x IMAGE_MIN_DIM. Can be used in training only.
@@ -153,6 +177,12 @@ class Config(object):
     POOL_SIZE = 7
     MASK_POOL_SIZE = 14
 
+    # Number of sampling points per bin (along each axis) in ROIAlign.
+    # 1 interpolates a single value at each bin center, which is fast and
+    # nearly as accurate. 2 averages a 2x2 grid of points per bin as in the
+    # Mask R-CNN paper, at the cost of 4x more interpolations.
+    ROI_ALIGN_SAMPLING_RATIO = 1
+
     # Shape of output mask
     # To change this you also need to change the neural network mask branch
     MASK_SHAPE = [28, 28]
@@ -160,10 +190,25 @@ class Config(object):
     # Maximum number of ground truth instances to use in one image
     MAX_GT_INSTANCES = 100
 
+    # By default, the ground truth arrays of every batch are padded to
+    # MAX_GT_INSTANCES. If set to a list of sizes, such as [8, 16, 32, 100],
+    # each batch is padded to the smallest size that fits the image with the
+    # most instances in the batch instead. This saves memory and transfer
+    # time when images have few instances.
+    GT_INSTANCE_BUCKETS = None
+
     # Bounding box refinement standard deviation for RPN and final detections.
     RPN_BBOX_STD_DEV = np.array([0.1, 0.1, 0.2, 0.2])
     BBOX_STD_DEV = np.array([0.1, 0.1, 0.2, 0.2])
 
+    # Size in bytes of the cache of backbone and RPN outputs (P2 to P6 feature
+    # maps, RPN class and bbox) of the images seen in inference. Repeated
+    # MaskRCNN.run_graph(), compute_features() and detect_with_rois() calls
+    # on the same image then skip the backbone. Images are looked up by a
+    # hash of their pixels, and the least recently used ones are evicted.
+    # A 1024x1024 image takes about 90MB. 0 disables the cache.
+    FEATURE_CACHE_BYTES = 0
+
     # Max number of final detections
     DETECTION_MAX_INSTANCES = 100
 
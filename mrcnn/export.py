@@ -0,0 +1,270 @@
+"""
+Mask R-CNN
+Export of the inference model to a frozen graph, and inference from it.
+
+Licensed under the MIT License (see LICENSE for details)
+
+------------------------------------------------------------
+
+Building the Keras model and loading its weights takes a long time. The
+exported graph has the weights embedded as constants, the batch
+normalization folded into the convolutions before it and the constant
+subgraphs precomputed, so it loads and runs without Keras layers.
+
+Usage:
+
+    # Export a model in inference mode with its weights loaded
+    export_frozen_graph(model, "mask_rcnn.pb")
+
+    # Later, load it with the same config
+    model = FrozenMaskRCNN("mask_rcnn.pb", config)
+    r = model.detect([image])[0]
+
+    # Check the exported graph against the Keras model, e.g. on the CPU
+    print(compare_outputs(keras_model, model, [image]))
+"""
+
+from collections import OrderedDict
+import numpy as np
+import tensorflow as tf
+import keras.backend as K
+import keras.layers as KL
+
+from mrcnn import model as modellib
+
+# Names of the input placeholders and of the outputs in the exported graph,
+# in the order of the inputs and outputs of the Keras model.
+INPUT_NAMES = ["input_image", "input_image_meta"]
+OUTPUT_NAMES = ["detections", "mrcnn_class", "mrcnn_bbox", "mrcnn_mask",
+                "rois", "rpn_class", "rpn_bbox"]
+
+
+############################################################
+#  Batch Normalization Folding
+############################################################
+
+def _inner_layer(layer):
+    """Returns the layer wrapped by a TimeDistributed layer, or the layer."""
+    return layer.layer if isinstance(layer, KL.TimeDistributed) else layer
+
+
+def _nodes(layer, kind):
+    """Inbound or outbound nodes of a layer. They're private since Keras
+    2.1.3.
+    """
+    return getattr(layer, "_{}_nodes".format(kind), None) or \
+        getattr(layer, "{}_nodes".format(kind))
+
+
+def fold_batch_norms(keras_model):
+    """Folds every BatchNorm layer of the model into the convolution it
+    follows, using its moving statistics:
+        kernel' = kernel * gamma / sqrt(variance + epsilon)
+        bias' = (bias - mean) * gamma / sqrt(variance + epsilon) + beta
+
+    keras_model: Inference Keras model with its weights loaded.
+
+    Returns: dict of the weights of the top level layers by name, with the
+        folded weights of the convolutions. The BatchNorm layers become
+        identities when the model is built with BatchNorm.folded set.
+    """
+    weights = {layer.name: layer.get_weights() for layer in keras_model.layers}
+    for layer in keras_model.layers:
+        bn = _inner_layer(layer)
+        if not isinstance(bn, modellib.BatchNorm):
+            continue
+        conv = _nodes(layer, "inbound")[0].inbound_layers[0]
+        foldable = isinstance(_inner_layer(conv), KL.Conv2D) and \
+            not isinstance(_inner_layer(conv), KL.Conv2DTranspose) and \
+            _inner_layer(conv).use_bias and bn.axis in [-1, 3] and \
+            all(node.outbound_layer is layer for node in _nodes(conv, "outbound"))
+        if not foldable:
+            raise ValueError("Can't fold {} into {}: it must be the only layer "
+                             "after a Conv2D with bias".format(layer.name, conv.name))
+        kernel, bias = weights[conv.name]
+        gamma, beta, mean, variance = weights[layer.name]
+        scale = gamma / np.sqrt(variance + bn.epsilon)
+        weights[conv.name] = [kernel * scale, (bias - mean) * scale + beta]
+    return weights
+
+
+############################################################
+#  Export
+############################################################
+
+def export_frozen_graph(model, path, fold_batch_norm=True, transforms=None):
+    """Writes the inference graph of the model, with the weights embedded as
+    constants, to a binary GraphDef file.
+
+    The graph is rebuilt in a new TensorFlow graph with the BatchNorm layers
+    folded into the convolutions, and the current weights of the model.
+    Then the variables are replaced by constants and the graph is optimized
+    with the TensorFlow Graph Transform Tool, if available.
+
+    model: MaskRCNN model in inference mode with its weights loaded. Only
+        one GPU is supported.
+    path: Path of the .pb file to write.
+    fold_batch_norm: Fold the BatchNorm layers into the convolutions.
+    transforms: List of Graph Transform Tool transforms. The default folds
+        the constant subgraphs and strips the unused nodes.
+
+    Returns: The frozen GraphDef.
+    """
+    assert model.mode == "inference", "Create model in inference mode."
+    assert model.config.GPU_COUNT == 1, "Export with GPU_COUNT = 1."
+    if transforms is None:
+        transforms = ["fold_constants(ignore_errors=true)",
+                      "strip_unused_nodes",
+                      "sort_by_execution_order"]
+
+    if fold_batch_norm:
+        weights = fold_batch_norms(model.keras_model)
+    else:
+        weights = {layer.name: layer.get_weights()
+                   for layer in model.keras_model.layers}
+
+    graph = tf.Graph()
+    session = tf.Session(graph=graph)
+    previous_session = K.get_session()
+    K.set_session(session)
+    try:
+        with graph.as_default():
+            K.set_learning_phase(0)
+            # Build the BatchNorm layers as identities
+            modellib.BatchNorm.folded = fold_batch_norm
+            try:
+                export_model = modellib.MaskRCNN(mode="inference", config=model.config,
+                                                 model_dir=model.model_dir)
+            finally:
+                modellib.BatchNorm.folded = False
+            keras_model = export_model.keras_model
+            assert [t.op.name for t in keras_model.inputs] == INPUT_NAMES
+            for layer in keras_model.layers:
+                if layer.weights:
+                    layer.set_weights(weights[layer.name])
+            # Fixed names for the outputs, independent of the Keras version
+            for name, tensor in zip(OUTPUT_NAMES, keras_model.outputs):
+                tf.identity(tensor, name=name)
+            graph_def = tf.graph_util.convert_variables_to_constants(
+                session, graph.as_graph_def(), OUTPUT_NAMES)
+    finally:
+        K.set_session(previous_session)
+        session.close()
+
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+        graph_def = TransformGraph(graph_def, INPUT_NAMES, OUTPUT_NAMES, transforms)
+    except ImportError:
+        # TensorFlow still folds the constants when it loads the graph
+        modellib.log("Graph Transform Tool not available, skipping: {}".format(transforms))
+
+    with tf.gfile.GFile(path, "wb") as f:
+        f.write(graph_def.SerializeToString())
+    return graph_def
+
+
+############################################################
+#  Frozen Model
+############################################################
+
+class FrozenGraph(object):
+    """Runs an exported graph with the predict() interface of the Keras
+    model, in its own graph and session.
+    """
+
+    def __init__(self, graph_def, session_config=None):
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.inputs = [self.graph.get_tensor_by_name(name + ":0")
+                       for name in INPUT_NAMES]
+        self.outputs = [self.graph.get_tensor_by_name(name + ":0")
+                        for name in OUTPUT_NAMES]
+        self.session = tf.Session(graph=self.graph, config=session_config)
+
+    def predict(self, inputs, batch_size=None, verbose=0):
+        """Runs the whole batch at once. batch_size and verbose are ignored."""
+        return self.session.run(self.outputs, dict(zip(self.inputs, inputs)))
+
+    def close(self):
+        self.session.close()
+
+
+class FrozenMaskRCNN(modellib.MaskRCNN):
+    """Mask R-CNN inference from a graph written by export_frozen_graph().
+
+    Loads much faster than building the model and loading the weights, and
+    has the same detect(), detect_molded(), detect_tiled() and detect_tta()
+    methods. The methods that need the Keras layers, like run_graph(),
+    compute_features() and detect_with_rois(), raise NotImplementedError.
+
+    path: Path of the exported .pb file.
+    config: The config the graph was exported with, or one with the same
+        inference settings.
+    session_config: Optional tf.ConfigProto of the session, e.g. to limit
+        the GPU memory.
+    """
+
+    def __init__(self, path, config, session_config=None):
+        # The Keras model isn't built, so MaskRCNN.__init__() isn't called
+        self.mode = "inference"
+        self.config = config
+        self.model_dir = None
+        self._native_inputs = OrderedDict()
+        self.feature_cache = None
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(path, "rb") as f:
+            graph_def.ParseFromString(f.read())
+        self.keras_model = FrozenGraph(graph_def, session_config)
+
+    def _unsupported(self, name):
+        raise NotImplementedError(
+            "{}() needs the Keras model, which FrozenMaskRCNN doesn't build. "
+            "Use a MaskRCNN model instead.".format(name))
+
+    def load_weights(self, *args, **kwargs):
+        self._unsupported("load_weights")
+
+    def run_features(self, *args, **kwargs):
+        self._unsupported("run_features")
+
+    def compute_features(self, *args, **kwargs):
+        self._unsupported("compute_features")
+
+    def detect_with_rois(self, *args, **kwargs):
+        self._unsupported("detect_with_rois")
+
+    def run_graph(self, *args, **kwargs):
+        self._unsupported("run_graph")
+
+
+def compare_outputs(model, frozen_model, images, atol=1e-3, rtol=1e-3):
+    """Runs a MaskRCNN model and its exported graph on the same images to
+    check the export. Run it on the CPU to compare the same kernels.
+
+    model: MaskRCNN model in inference mode.
+    frozen_model: FrozenMaskRCNN exported from it.
+    images: List of images, of the batch size of the config.
+    atol, rtol: Absolute and relative tolerance of each value, as in
+        np.allclose(). Folding the batch normalization only changes the
+        rounding. Detections with almost equal scores may swap places,
+        so check images without ties.
+
+    Returns: OrderedDict of the largest absolute difference of each output.
+    Raises AssertionError if an output is out of the tolerance.
+    """
+    molded_images, image_metas, _ = model.mold_inputs(images)
+    expected = model.keras_model.predict([molded_images, image_metas],
+                                         batch_size=len(images), verbose=0)
+    actual = frozen_model.keras_model.predict([molded_images, image_metas])
+    differences = OrderedDict()
+    failed = []
+    for name, a, e in zip(OUTPUT_NAMES, actual, expected):
+        assert a.shape == e.shape, \
+            "{} has shape {}, expected {}".format(name, a.shape, e.shape)
+        differences[name] = float(np.abs(a - e).max()) if a.size else 0.
+        if not np.allclose(a, e, atol=atol, rtol=rtol):
+            failed.append(name)
+    assert not failed, "Exported graph differs from the Keras model in {}: {}".format(
+        ", ".join(failed), dict(differences))
+    return differences
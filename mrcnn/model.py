@@ -12,6 +12,7 @@ import random
 import datetime
 import re
 import math
+import hashlib
 import logging
 from collections import OrderedDict
 import multiprocessing
@@ -57,7 +58,13 @@ class BatchNorm(KL.BatchNormalization):
     Batch normalization has a negative effect on training if batches are small
     so this layer is often frozen (via setting in Config class) and functions
     as linear layer.
+
+    While the folded class attribute is True, the layers that are built pass
+    their inputs through. export.py sets it to build graphs with the batch
+    normalization folded into the convolutions.
     """
+    folded = False
+
     def call(self, inputs, training=None):
         """
         Note about training values:
@@ -65,9 +72,29 @@ class BatchNorm(KL.BatchNormalization):
             False: Freeze BN layers. Good when batch size is small
             True: (don't use). Set layer in training mode even when making inferences
         """
+        if self.folded:
+            return inputs
         return super(self.__class__, self).call(inputs, training=training)
 
 
+def depends_on(tensors, sources):
+    """Returns True if any of the tensors is computed from any of the
+    source tensors, walking the graph back from the tensors.
+    """
+    sources = set(sources)
+    visited = set()
+    stack = list(tensors)
+    while stack:
+        tensor = stack.pop()
+        if tensor in sources:
+            return True
+        if tensor.op in visited:
+            continue
+        visited.add(tensor.op)
+        stack.extend(tensor.op.inputs)
+    return False
+
+
 def compute_backbone_shapes(config, image_shape):
     """Computes the width and height of each stage of the backbone network.
 
@@ -85,6 +112,34 @@ def compute_backbone_shapes(config, image_shape):
             for stride in config.BACKBONE_STRIDES])
 
 
+def compute_molded_shape(config, image_shape):
+    """Returns the [height, width, channels] shape that an image of the
+    given shape has after mold_inputs() or load_image_gt(), without
+    loading or resizing it.
+    """
+    h, w = utils.compute_resized_shape(image_shape[0], image_shape[1],
+                                       min_dim=config.IMAGE_MIN_DIM,
+                                       max_dim=config.IMAGE_MAX_DIM,
+                                       min_scale=config.IMAGE_MIN_SCALE,
+                                       mode=config.IMAGE_RESIZE_MODE)
+    return (h, w, config.IMAGE_CHANNEL_COUNT)
+
+
+def get_anchor_pyramid(config, image_shape):
+    """Returns the utils.PyramidAnchors of the given image shape. They're
+    generated once and shared by all models and data generators in the
+    process, and memory-mapped from config.ANCHOR_CACHE_DIR if it's set.
+    """
+    backbone_shapes = compute_backbone_shapes(config, image_shape)
+    return utils.get_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                     config.RPN_ANCHOR_RATIOS,
+                                     backbone_shapes,
+                                     config.BACKBONE_STRIDES,
+                                     config.RPN_ANCHOR_STRIDE,
+                                     image_shape,
+                                     cache_dir=config.ANCHOR_CACHE_DIR)
+
+
 ############################################################
 #  Resnet Graph
 ############################################################
@@ -212,43 +267,44 @@ def resnet_graph(input_image, architecture, stage5=False, train_bn=True):
 
 def apply_box_deltas_graph(boxes, deltas):
     """Applies the given deltas to the given boxes.
-    boxes: [N, (y1, x1, y2, x2)] boxes to update
-    deltas: [N, (dy, dx, log(dh), log(dw))] refinements to apply
+    boxes: [..., N, (y1, x1, y2, x2)] boxes to update
+    deltas: [..., N, (dy, dx, log(dh), log(dw))] refinements to apply
     """
     # Convert to y, x, h, w
-    height = boxes[:, 2] - boxes[:, 0]
-    width = boxes[:, 3] - boxes[:, 1]
-    center_y = boxes[:, 0] + 0.5 * height
-    center_x = boxes[:, 1] + 0.5 * width
+    height = boxes[..., 2] - boxes[..., 0]
+    width = boxes[..., 3] - boxes[..., 1]
+    center_y = boxes[..., 0] + 0.5 * height
+    center_x = boxes[..., 1] + 0.5 * width
     # Apply deltas
-    center_y += deltas[:, 0] * height
-    center_x += deltas[:, 1] * width
-    height *= tf.exp(deltas[:, 2])
-    width *= tf.exp(deltas[:, 3])
+    center_y += deltas[..., 0] * height
+    center_x += deltas[..., 1] * width
+    height *= tf.exp(deltas[..., 2])
+    width *= tf.exp(deltas[..., 3])
     # Convert back to y1, x1, y2, x2
     y1 = center_y - 0.5 * height
     x1 = center_x - 0.5 * width
     y2 = y1 + height
     x2 = x1 + width
-    result = tf.stack([y1, x1, y2, x2], axis=1, name="apply_box_deltas_out")
+    result = tf.stack([y1, x1, y2, x2], axis=-1, name="apply_box_deltas_out")
     return result
 
 
 def clip_boxes_graph(boxes, window):
     """
-    boxes: [N, (y1, x1, y2, x2)]
-    window: [4] in the form y1, x1, y2, x2
+    boxes: [..., N, (y1, x1, y2, x2)]
+    window: [4] in the form y1, x1, y2, x2, or [..., 1, 4] to clip each
+        item in a batch to its own window.
     """
     # Split
-    wy1, wx1, wy2, wx2 = tf.split(window, 4)
-    y1, x1, y2, x2 = tf.split(boxes, 4, axis=1)
+    wy1, wx1, wy2, wx2 = tf.split(window, 4, axis=-1)
+    y1, x1, y2, x2 = tf.split(boxes, 4, axis=-1)
     # Clip
     y1 = tf.maximum(tf.minimum(y1, wy2), wy1)
     x1 = tf.maximum(tf.minimum(x1, wx2), wx1)
     y2 = tf.maximum(tf.minimum(y2, wy2), wy1)
     x2 = tf.maximum(tf.minimum(x2, wx2), wx1)
-    clipped = tf.concat([y1, x1, y2, x2], axis=1, name="clipped_boxes")
-    clipped.set_shape((clipped.shape[0], 4))
+    clipped = tf.concat([y1, x1, y2, x2], axis=-1, name="clipped_boxes")
+    clipped.set_shape(boxes.shape)
     return clipped
 
 
@@ -261,7 +317,12 @@ class ProposalLayer(KE.Layer):
     Inputs:
         rpn_probs: [batch, num_anchors, (bg prob, fg prob)]
         rpn_bbox: [batch, num_anchors, (dy, dx, log(dh), log(dw))]
-        anchors: [batch, num_anchors, (y1, x1, y2, x2)] anchors in normalized coordinates
+        anchors: [num_anchors, (y1, x1, y2, x2)] anchors in normalized coordinates,
+            shared by all images in the batch. Or [batch, num_anchors, 4] to
+            use different anchors for each image.
+        level_probs: (optional) rpn_probs of each pyramid level, in the same
+            order they're concatenated in. Only their shapes are used. Needed
+            if config.PRE_NMS_LIMIT_PER_LEVEL is set.
 
     Returns:
         Proposals in normalized coordinates [batch, rois, (y1, x1, y2, x2)]
@@ -283,51 +344,94 @@ class ProposalLayer(KE.Layer):
         anchors = inputs[2]
 
         # Improve performance by trimming to top anchors by score
-        # and doing the rest on the smaller subset.
-        pre_nms_limit = tf.minimum(self.config.PRE_NMS_LIMIT, tf.shape(anchors)[1])
-        ix = tf.nn.top_k(scores, pre_nms_limit, sorted=True,
-                         name="top_anchors").indices
-        scores = utils.batch_slice([scores, ix], lambda x, y: tf.gather(x, y),
-                                   self.config.IMAGES_PER_GPU)
-        deltas = utils.batch_slice([deltas, ix], lambda x, y: tf.gather(x, y),
-                                   self.config.IMAGES_PER_GPU)
-        pre_nms_anchors = utils.batch_slice([anchors, ix], lambda a, x: tf.gather(a, x),
-                                    self.config.IMAGES_PER_GPU,
-                                    names=["pre_nms_anchors"])
+        # and doing the rest on the smaller subset. All the ops below work
+        # on the whole batch at once, so the graph size doesn't depend on
+        # the number of images.
+        if self.config.PRE_NMS_LIMIT_PER_LEVEL:
+            scores, ix = self.top_anchors_per_level(scores, inputs[3:])
+        else:
+            pre_nms_limit = tf.minimum(self.config.PRE_NMS_LIMIT, tf.shape(scores)[1])
+            scores, ix = tf.nn.top_k(scores, pre_nms_limit, sorted=True,
+                                     name="top_anchors")
+        deltas = batch_gather_graph(deltas, ix)
+        if len(anchors.shape) == 2:
+            pre_nms_anchors = tf.gather(anchors, ix, name="pre_nms_anchors")
+        else:
+            pre_nms_anchors = batch_gather_graph(anchors, ix, name="pre_nms_anchors")
 
         # Apply deltas to anchors to get refined anchors.
         # [batch, N, (y1, x1, y2, x2)]
-        boxes = utils.batch_slice([pre_nms_anchors, deltas],
-                                  lambda x, y: apply_box_deltas_graph(x, y),
-                                  self.config.IMAGES_PER_GPU,
-                                  names=["refined_anchors"])
+        boxes = apply_box_deltas_graph(pre_nms_anchors, deltas)
+        boxes = tf.identity(boxes, name="refined_anchors")
 
         # Clip to image boundaries. Since we're in normalized coordinates,
         # clip to 0..1 range. [batch, N, (y1, x1, y2, x2)]
         window = np.array([0, 0, 1, 1], dtype=np.float32)
-        boxes = utils.batch_slice(boxes,
-                                  lambda x: clip_boxes_graph(x, window),
-                                  self.config.IMAGES_PER_GPU,
-                                  names=["refined_anchors_clipped"])
+        boxes = clip_boxes_graph(boxes, window)
+        boxes = tf.identity(boxes, name="refined_anchors_clipped")
 
         # Filter out small boxes
         # According to Xinlei Chen's paper, this reduces detection accuracy
         # for small objects, so we're skipping it.
 
         # Non-max suppression
+        # Anchors scoring below PRE_NMS_MIN_SCORE, if set, are dropped by NMS
+        # before it compares any boxes.
+        nms_kwargs = {}
+        if self.config.PRE_NMS_MIN_SCORE is not None:
+            nms_kwargs["score_threshold"] = self.config.PRE_NMS_MIN_SCORE
+        if hasattr(tf.image, "combined_non_max_suppression"):
+            # TF 1.14+: one op for the whole batch. The output is sorted by
+            # score and padded with zeros, same as the per-image path below.
+            proposals = tf.image.combined_non_max_suppression(
+                tf.expand_dims(boxes, 2), tf.expand_dims(scores, 2),
+                self.proposal_count, self.proposal_count,
+                self.nms_threshold, name="rpn_non_max_suppression",
+                **nms_kwargs).nmsed_boxes
+            return proposals
+
         def nms(boxes, scores):
             indices = tf.image.non_max_suppression(
                 boxes, scores, self.proposal_count,
-                self.nms_threshold, name="rpn_non_max_suppression")
+                self.nms_threshold, name="rpn_non_max_suppression",
+                **nms_kwargs)
             proposals = tf.gather(boxes, indices)
             # Pad if needed
             padding = tf.maximum(self.proposal_count - tf.shape(proposals)[0], 0)
             proposals = tf.pad(proposals, [(0, padding), (0, 0)])
+            proposals.set_shape([self.proposal_count, 4])
             return proposals
-        proposals = utils.batch_slice([boxes, scores], nms,
-                                      self.config.IMAGES_PER_GPU)
+        proposals = utils.batch_slice([boxes, scores], nms, None,
+                                      dtype=tf.float32)
         return proposals
 
+    def top_anchors_per_level(self, scores, level_probs):
+        """Picks the top PRE_NMS_LIMIT_PER_LEVEL anchors of each pyramid level,
+        as in Detectron. Many small top_k ops are cheaper than one over all
+        the anchors, and large objects aren't crowded out by the many
+        anchors of the fine levels.
+
+        scores: [batch, num_anchors] foreground scores of all levels.
+        level_probs: List of the per-level RPN probs. Used for their shapes.
+
+        Returns scores and indices into num_anchors, both [batch, N].
+        """
+        assert level_probs, "ProposalLayer needs the per-level RPN probs " \
+                            "when PRE_NMS_LIMIT_PER_LEVEL is set"
+        level_counts = [tf.shape(p)[1] for p in level_probs]
+        level_scores = tf.split(scores, tf.stack(level_counts), axis=1)
+        top_scores = []
+        top_ix = []
+        offset = 0
+        for i, (count, s) in enumerate(zip(level_counts, level_scores)):
+            k = tf.minimum(self.config.PRE_NMS_LIMIT_PER_LEVEL, count)
+            level_top = tf.nn.top_k(s, k, sorted=False,
+                                    name="top_anchors_level{}".format(i))
+            top_scores.append(level_top.values)
+            top_ix.append(level_top.indices + offset)
+            offset += count
+        return tf.concat(top_scores, axis=1), tf.concat(top_ix, axis=1)
+
     def compute_output_shape(self, input_shape):
         return (None, self.proposal_count, 4)
 
@@ -346,6 +450,10 @@ class PyramidROIAlign(KE.Layer):
 
     Params:
     - pool_shape: [pool_height, pool_width] of the output pooled regions. Usually [7, 7]
+    - sampling_ratio: Number of sampling points per bin along each axis. 1
+                      interpolates a single value per bin (the default). 2
+                      averages a regular 2x2 grid of points in each bin, as
+                      in the Mask R-CNN paper.
 
     Inputs:
     - boxes: [batch, num_boxes, (y1, x1, y2, x2)] in normalized
@@ -361,9 +469,10 @@ class PyramidROIAlign(KE.Layer):
     constructor.
     """
 
-    def __init__(self, pool_shape, **kwargs):
+    def __init__(self, pool_shape, sampling_ratio=1, **kwargs):
         super(PyramidROIAlign, self).__init__(**kwargs)
         self.pool_shape = tuple(pool_shape)
+        self.sampling_ratio = sampling_ratio
 
     def call(self, inputs):
         # Crop boxes [batch, num_boxes, (y1, x1, y2, x2)] in normalized coords
@@ -392,6 +501,24 @@ class PyramidROIAlign(KE.Layer):
             2, 4 + tf.cast(tf.round(roi_level), tf.int32)))
         roi_level = tf.squeeze(roi_level, 2)
 
+        # Crop size and box inset for the sampling grid
+        # From Mask R-CNN paper: "We sample four regular locations, so
+        # that we can evaluate either max or average pooling. In fact,
+        # interpolating only a single value at each bin center (without
+        # pooling) is nearly as effective."
+        #
+        # With sampling_ratio 1 we use the simplified approach of a single
+        # value per bin, which is how it's done in tf.crop_and_resize().
+        # Otherwise, crop sampling_ratio times more points and average them
+        # per bin. crop_and_resize() samples the box edges, so boxes are
+        # shrunk by half a sample spacing to put the points inside the bins.
+        s = self.sampling_ratio
+        crop_shape = (self.pool_shape[0] * s, self.pool_shape[1] * s)
+        if s > 1:
+            inset = tf.concat([h / (2. * crop_shape[0]), w / (2. * crop_shape[1])],
+                              axis=2)
+            boxes = boxes + tf.concat([inset, -inset], axis=2)
+
         # Loop through levels and apply ROI pooling to each. P2 to P5.
         pooled = []
         box_to_level = []
@@ -410,36 +537,25 @@ class PyramidROIAlign(KE.Layer):
             box_indices = tf.stop_gradient(box_indices)
 
             # Crop and Resize
-            # From Mask R-CNN paper: "We sample four regular locations, so
-            # that we can evaluate either max or average pooling. In fact,
-            # interpolating only a single value at each bin center (without
-            # pooling) is nearly as effective."
-            #
-            # Here we use the simplified approach of a single value per bin,
-            # which is how it's done in tf.crop_and_resize()
-            # Result: [batch * num_boxes, pool_height, pool_width, channels]
+            # Result: [level_boxes, crop_height, crop_width, channels]
             pooled.append(tf.image.crop_and_resize(
-                feature_maps[i], level_boxes, box_indices, self.pool_shape,
+                feature_maps[i], level_boxes, box_indices, crop_shape,
                 method="bilinear"))
 
         # Pack pooled features into one tensor
         pooled = tf.concat(pooled, axis=0)
-
-        # Pack box_to_level mapping into one array and add another
-        # column representing the order of pooled boxes
-        box_to_level = tf.concat(box_to_level, axis=0)
-        box_range = tf.expand_dims(tf.range(tf.shape(box_to_level)[0]), 1)
-        box_to_level = tf.concat([tf.cast(box_to_level, tf.int32), box_range],
-                                 axis=1)
-
-        # Rearrange pooled features to match the order of the original boxes
-        # Sort box_to_level by batch then box index
-        # TF doesn't have a way to sort by two columns, so merge them and sort.
-        sorting_tensor = box_to_level[:, 0] * 100000 + box_to_level[:, 1]
-        ix = tf.nn.top_k(sorting_tensor, k=tf.shape(
-            box_to_level)[0]).indices[::-1]
-        ix = tf.gather(box_to_level[:, 2], ix)
-        pooled = tf.gather(pooled, ix)
+        if s > 1:
+            pooled = tf.nn.avg_pool(pooled, [1, s, s, 1], [1, s, s, 1], "VALID")
+
+        # Every box is assigned to exactly one level, so scatter the pooled
+        # features straight back to the position of their box in the batch.
+        # This avoids sorting all the boxes to restore the original order.
+        box_to_level = tf.cast(tf.concat(box_to_level, axis=0), tf.int32)
+        batch_size = tf.shape(boxes)[0]
+        num_boxes = tf.shape(boxes)[1]
+        ix = box_to_level[:, 0] * num_boxes + box_to_level[:, 1]
+        shape = tf.concat([[batch_size * num_boxes], tf.shape(pooled)[1:]], axis=0)
+        pooled = tf.scatter_nd(tf.expand_dims(ix, 1), pooled, shape)
 
         # Re-add the batch dimension
         shape = tf.concat([tf.shape(boxes)[:2], tf.shape(pooled)[1:]], axis=0)
@@ -494,6 +610,9 @@ def detection_targets_graph(proposals, gt_class_ids, gt_boxes, gt_masks, config)
     gt_boxes: [MAX_GT_INSTANCES, (y1, x1, y2, x2)] in normalized coordinates.
     gt_masks: [height, width, MAX_GT_INSTANCES] of boolean type.
 
+    The GT arrays are zero padded, and the padded width (MAX_GT_INSTANCES)
+    can vary from batch to batch. See GT_INSTANCE_BUCKETS.
+
     Returns: Target ROIs and corresponding class IDs, bounding box shifts,
     and masks.
     rois: [TRAIN_ROIS_PER_IMAGE, (y1, x1, y2, x2)] in normalized coordinates
@@ -616,6 +735,12 @@ def detection_targets_graph(proposals, gt_class_ids, gt_boxes, gt_masks, config)
     deltas = tf.pad(deltas, [(0, N + P), (0, 0)])
     masks = tf.pad(masks, [[0, N + P], (0, 0), (0, 0)])
 
+    # Set shapes so tf.map_fn() can infer the output shapes
+    rois.set_shape([config.TRAIN_ROIS_PER_IMAGE, 4])
+    roi_gt_class_ids.set_shape([config.TRAIN_ROIS_PER_IMAGE])
+    deltas.set_shape([config.TRAIN_ROIS_PER_IMAGE, 4])
+    masks.set_shape([config.TRAIN_ROIS_PER_IMAGE] + list(config.MASK_SHAPE))
+
     return rois, roi_gt_class_ids, deltas, masks
 
 
@@ -630,6 +755,7 @@ class DetectionTargetLayer(KE.Layer):
     gt_boxes: [batch, MAX_GT_INSTANCES, (y1, x1, y2, x2)] in normalized
               coordinates.
     gt_masks: [batch, height, width, MAX_GT_INSTANCES] of boolean type
+    The GT inputs are zero padded to a width that can change between batches.
 
     Returns: Target ROIs and corresponding class IDs, bounding box shifts,
     and masks.
@@ -654,14 +780,16 @@ class DetectionTargetLayer(KE.Layer):
         gt_boxes = inputs[2]
         gt_masks = inputs[3]
 
-        # Slice the batch and run a graph for each slice
+        # Run the graph on each item in the batch with tf.map_fn() rather
+        # than unrolling it once per image.
         # TODO: Rename target_bbox to target_deltas for clarity
         names = ["rois", "target_class_ids", "target_bbox", "target_mask"]
         outputs = utils.batch_slice(
             [proposals, gt_class_ids, gt_boxes, gt_masks],
             lambda w, x, y, z: detection_targets_graph(
                 w, x, y, z, self.config),
-            self.config.IMAGES_PER_GPU, names=names)
+            None, names=names,
+            dtype=[tf.float32, gt_class_ids.dtype, tf.float32, tf.float32])
         return outputs
 
     def compute_output_shape(self, input_shape):
@@ -699,7 +827,7 @@ def refine_detections_graph(rois, probs, deltas, window, config):
     # Class IDs per ROI
     class_ids = tf.argmax(probs, axis=1, output_type=tf.int32)
     # Class probability of the top class of each ROI
-    indices = tf.stack([tf.range(probs.shape[0]), class_ids], axis=1)
+    indices = tf.stack([tf.range(tf.shape(probs)[0]), class_ids], axis=1)
     class_scores = tf.gather_nd(probs, indices)
     # Class-specific bounding box deltas
     deltas_specific = tf.gather_nd(deltas, indices)
@@ -710,60 +838,50 @@ def refine_detections_graph(rois, probs, deltas, window, config):
     # Clip boxes to image window
     refined_rois = clip_boxes_graph(refined_rois, window)
 
+    return filter_detections_graph(refined_rois, class_ids, class_scores, config)
+
+
+def filter_detections_graph(refined_rois, class_ids, class_scores, config):
+    """Second half of refine_detections_graph(). Removes background and low
+    confidence boxes, applies per-class NMS and returns the top detections.
+
+    Inputs:
+        refined_rois: [N, (y1, x1, y2, x2)] refined and clipped boxes in
+            normalized coordinates.
+        class_ids: [N] int32. The top class ID of each box.
+        class_scores: [N]. The probability of the top class of each box.
+
+    Returns detections shaped: [num_detections, (y1, x1, y2, x2, class_id, score)] where
+        coordinates are normalized.
+    """
     # TODO: Filter out boxes with zero area
 
-    # Filter out background boxes
-    keep = tf.where(class_ids > 0)[:, 0]
-    # Filter out low confidence boxes
+    # Filter out background and low confidence boxes. Combining the two
+    # conditions as a mask keeps the indices sorted without set operations.
+    keep_mask = class_ids > 0
     if config.DETECTION_MIN_CONFIDENCE:
-        conf_keep = tf.where(class_scores >= config.DETECTION_MIN_CONFIDENCE)[:, 0]
-        keep = tf.sets.set_intersection(tf.expand_dims(keep, 0),
-                                        tf.expand_dims(conf_keep, 0))
-        keep = tf.sparse_tensor_to_dense(keep)[0]
+        keep_mask = tf.logical_and(
+            keep_mask, class_scores >= config.DETECTION_MIN_CONFIDENCE)
+    keep = tf.where(keep_mask)[:, 0]
 
     # Apply per-class NMS
     # 1. Prepare variables
     pre_nms_class_ids = tf.gather(class_ids, keep)
     pre_nms_scores = tf.gather(class_scores, keep)
     pre_nms_rois = tf.gather(refined_rois,   keep)
-    unique_pre_nms_class_ids = tf.unique(pre_nms_class_ids)[0]
-
-    def nms_keep_map(class_id):
-        """Apply Non-Maximum Suppression on ROIs of the given class."""
-        # Indices of ROIs of the given class
-        ixs = tf.where(tf.equal(pre_nms_class_ids, class_id))[:, 0]
-        # Apply NMS
-        class_keep = tf.image.non_max_suppression(
-                tf.gather(pre_nms_rois, ixs),
-                tf.gather(pre_nms_scores, ixs),
-                max_output_size=config.DETECTION_MAX_INSTANCES,
-                iou_threshold=config.DETECTION_NMS_THRESHOLD)
-        # Map indices
-        class_keep = tf.gather(keep, tf.gather(ixs, class_keep))
-        # Pad with -1 so returned tensors have the same shape
-        gap = config.DETECTION_MAX_INSTANCES - tf.shape(class_keep)[0]
-        class_keep = tf.pad(class_keep, [(0, gap)],
-                            mode='CONSTANT', constant_values=-1)
-        # Set shape so map_fn() can infer result shape
-        class_keep.set_shape([config.DETECTION_MAX_INSTANCES])
-        return class_keep
-
-    # 2. Map over class IDs
-    nms_keep = tf.map_fn(nms_keep_map, unique_pre_nms_class_ids,
-                         dtype=tf.int64)
-    # 3. Merge results into one list, and remove -1 padding
-    nms_keep = tf.reshape(nms_keep, [-1])
-    nms_keep = tf.gather(nms_keep, tf.where(nms_keep > -1)[:, 0])
-    # 4. Compute intersection between keep and nms_keep
-    keep = tf.sets.set_intersection(tf.expand_dims(keep, 0),
-                                    tf.expand_dims(nms_keep, 0))
-    keep = tf.sparse_tensor_to_dense(keep)[0]
-    # Keep top detections
-    roi_count = config.DETECTION_MAX_INSTANCES
-    class_scores_keep = tf.gather(class_scores, keep)
-    num_keep = tf.minimum(tf.shape(class_scores_keep)[0], roi_count)
-    top_ids = tf.nn.top_k(class_scores_keep, k=num_keep, sorted=True)[1]
-    keep = tf.gather(keep, top_ids)
+    # 2. Shift the boxes of each class by a class-specific offset so boxes
+    # of different classes never overlap. Then a single NMS call is the same
+    # as running NMS on each class separately. Boxes are clipped to the
+    # window, which is within 0..1, so an offset of 2 per class is enough.
+    offsets = tf.to_float(pre_nms_class_ids) * 2.0
+    nms_keep = tf.image.non_max_suppression(
+            pre_nms_rois + offsets[:, tf.newaxis],
+            pre_nms_scores,
+            max_output_size=config.DETECTION_MAX_INSTANCES,
+            iou_threshold=config.DETECTION_NMS_THRESHOLD)
+    # 3. Map indices. NMS returns them sorted by score, so these are the
+    # top detections already.
+    keep = tf.gather(keep, nms_keep)
 
     # Arrange output as [N, (y1, x1, y2, x2, class_id, score)]
     # Coordinates are normalized.
@@ -776,6 +894,7 @@ def refine_detections_graph(rois, probs, deltas, window, config):
     # Pad with zeros if detections < DETECTION_MAX_INSTANCES
     gap = config.DETECTION_MAX_INSTANCES - tf.shape(detections)[0]
     detections = tf.pad(detections, [(0, gap), (0, 0)], "CONSTANT")
+    detections.set_shape([config.DETECTION_MAX_INSTANCES, 6])
     return detections
 
 
@@ -806,18 +925,39 @@ class DetectionLayer(KE.Layer):
         image_shape = m['image_shape'][0]
         window = norm_boxes_graph(m['window'], image_shape[:2])
 
-        # Run detection refinement graph on each item in the batch
+        # Pick the top class of each ROI along with its score and deltas,
+        # and refine the boxes. Done on the whole batch at once.
+        # [batch, num_rois]
+        class_ids = tf.argmax(mrcnn_class, axis=2, output_type=tf.int32)
+        class_scores = tf.reduce_max(mrcnn_class, axis=2)
+        # Class-specific bounding box deltas [batch, num_rois, 4]
+        batch_ix = tf.tile(tf.expand_dims(tf.range(tf.shape(rois)[0]), 1),
+                           [1, tf.shape(rois)[1]])
+        roi_ix = tf.tile(tf.expand_dims(tf.range(tf.shape(rois)[1]), 0),
+                         [tf.shape(rois)[0], 1])
+        deltas_specific = tf.gather_nd(
+            mrcnn_bbox, tf.stack([batch_ix, roi_ix, class_ids], axis=2))
+        # Apply bounding box deltas and clip to the window of each image
+        # Shape: [batch, num_rois, (y1, x1, y2, x2)] in normalized coordinates
+        refined_rois = apply_box_deltas_graph(
+            rois, deltas_specific * self.config.BBOX_STD_DEV)
+        refined_rois = clip_boxes_graph(refined_rois,
+                                        tf.expand_dims(window, 1))
+
+        # Filtering and NMS keep a different number of boxes per image, so
+        # they run per image. The batch size is read at runtime so any
+        # number of images can be processed.
         detections_batch = utils.batch_slice(
-            [rois, mrcnn_class, mrcnn_bbox, window],
-            lambda x, y, w, z: refine_detections_graph(x, y, w, z, self.config),
-            self.config.IMAGES_PER_GPU)
+            [refined_rois, class_ids, class_scores],
+            lambda x, y, z: filter_detections_graph(x, y, z, self.config),
+            None, dtype=tf.float32)
 
         # Reshape output
         # [batch, num_detections, (y1, x1, y2, x2, class_id, class_score)] in
         # normalized coordinates
         return tf.reshape(
             detections_batch,
-            [self.config.BATCH_SIZE, self.config.DETECTION_MAX_INSTANCES, 6])
+            [-1, self.config.DETECTION_MAX_INSTANCES, 6])
 
     def compute_output_shape(self, input_shape):
         return (None, self.config.DETECTION_MAX_INSTANCES, 6)
@@ -897,9 +1037,20 @@ def build_rpn_model(anchor_stride, anchors_per_location, depth):
 #  Feature Pyramid Network Heads
 ############################################################
 
+def shared_layer(layers, layer):
+    """Returns the layer of the same name in the layers dict, or adds the
+    given layer to it. Lets the head graphs be built a second time on other
+    inputs with the weights of the first build. If layers is None, the layer
+    is returned as is.
+    """
+    if layers is None:
+        return layer
+    return layers.setdefault(layer.name, layer)
+
+
 def fpn_classifier_graph(rois, feature_maps, image_meta,
                          pool_size, num_classes, train_bn=True,
-                         fc_layers_size=1024):
+                         fc_layers_size=1024, sampling_ratio=1, layers=None):
     """Builds the computation graph of the feature pyramid network classifier
     and regressor heads.
 
@@ -912,6 +1063,10 @@ def fpn_classifier_graph(rois, feature_maps, image_meta,
     num_classes: number of classes, which determines the depth of the results
     train_bn: Boolean. Train or freeze Batch Norm layers
     fc_layers_size: Size of the 2 FC layers
+    sampling_ratio: Sampling points per bin and axis in ROIAlign. See
+                    PyramidROIAlign.
+    layers: Optional dict of layers by name, shared between builds. See
+            shared_layer().
 
     Returns:
         logits: [batch, num_rois, NUM_CLASSES] classifier logits (before softmax)
@@ -921,40 +1076,47 @@ def fpn_classifier_graph(rois, feature_maps, image_meta,
     """
     # ROI Pooling
     # Shape: [batch, num_rois, POOL_SIZE, POOL_SIZE, channels]
-    x = PyramidROIAlign([pool_size, pool_size],
-                        name="roi_align_classifier")([rois, image_meta] + feature_maps)
+    x = shared_layer(layers, PyramidROIAlign(
+        [pool_size, pool_size], sampling_ratio=sampling_ratio,
+        name="roi_align_classifier"))([rois, image_meta] + feature_maps)
     # Two 1024 FC layers (implemented with Conv2D for consistency)
-    x = KL.TimeDistributed(KL.Conv2D(fc_layers_size, (pool_size, pool_size), padding="valid"),
-                           name="mrcnn_class_conv1")(x)
-    x = KL.TimeDistributed(BatchNorm(), name='mrcnn_class_bn1')(x, training=train_bn)
+    x = shared_layer(layers, KL.TimeDistributed(
+        KL.Conv2D(fc_layers_size, (pool_size, pool_size), padding="valid"),
+        name="mrcnn_class_conv1"))(x)
+    x = shared_layer(layers, KL.TimeDistributed(
+        BatchNorm(), name='mrcnn_class_bn1'))(x, training=train_bn)
     x = KL.Activation('relu')(x)
-    x = KL.TimeDistributed(KL.Conv2D(fc_layers_size, (1, 1)),
-                           name="mrcnn_class_conv2")(x)
-    x = KL.TimeDistributed(BatchNorm(), name='mrcnn_class_bn2')(x, training=train_bn)
+    x = shared_layer(layers, KL.TimeDistributed(
+        KL.Conv2D(fc_layers_size, (1, 1)), name="mrcnn_class_conv2"))(x)
+    x = shared_layer(layers, KL.TimeDistributed(
+        BatchNorm(), name='mrcnn_class_bn2'))(x, training=train_bn)
     x = KL.Activation('relu')(x)
 
-    shared = KL.Lambda(lambda x: K.squeeze(K.squeeze(x, 3), 2),
-                       name="pool_squeeze")(x)
+    shared = shared_layer(layers, KL.Lambda(
+        lambda x: K.squeeze(K.squeeze(x, 3), 2), name="pool_squeeze"))(x)
 
     # Classifier head
-    mrcnn_class_logits = KL.TimeDistributed(KL.Dense(num_classes),
-                                            name='mrcnn_class_logits')(shared)
-    mrcnn_probs = KL.TimeDistributed(KL.Activation("softmax"),
-                                     name="mrcnn_class")(mrcnn_class_logits)
+    mrcnn_class_logits = shared_layer(layers, KL.TimeDistributed(
+        KL.Dense(num_classes), name='mrcnn_class_logits'))(shared)
+    mrcnn_probs = shared_layer(layers, KL.TimeDistributed(
+        KL.Activation("softmax"), name="mrcnn_class"))(mrcnn_class_logits)
 
     # BBox head
     # [batch, num_rois, NUM_CLASSES * (dy, dx, log(dh), log(dw))]
-    x = KL.TimeDistributed(KL.Dense(num_classes * 4, activation='linear'),
-                           name='mrcnn_bbox_fc')(shared)
+    x = shared_layer(layers, KL.TimeDistributed(
+        KL.Dense(num_classes * 4, activation='linear'),
+        name='mrcnn_bbox_fc'))(shared)
     # Reshape to [batch, num_rois, NUM_CLASSES, (dy, dx, log(dh), log(dw))]
-    s = K.int_shape(x)
-    mrcnn_bbox = KL.Reshape((s[1], num_classes, 4), name="mrcnn_bbox")(x)
+    # The number of ROIs is inferred, so it can vary between builds.
+    mrcnn_bbox = shared_layer(layers, KL.Reshape(
+        (-1, num_classes, 4), name="mrcnn_bbox"))(x)
 
     return mrcnn_class_logits, mrcnn_probs, mrcnn_bbox
 
 
 def build_fpn_mask_graph(rois, feature_maps, image_meta,
-                         pool_size, num_classes, train_bn=True):
+                         pool_size, num_classes, train_bn=True,
+                         sampling_ratio=1, layers=None):
     """Builds the computation graph of the mask head of Feature Pyramid Network.
 
     rois: [batch, num_rois, (y1, x1, y2, x2)] Proposal boxes in normalized
@@ -965,43 +1127,50 @@ def build_fpn_mask_graph(rois, feature_maps, image_meta,
     pool_size: The width of the square feature map generated from ROI Pooling.
     num_classes: number of classes, which determines the depth of the results
     train_bn: Boolean. Train or freeze Batch Norm layers
+    sampling_ratio: Sampling points per bin and axis in ROIAlign. See
+                    PyramidROIAlign.
+    layers: Optional dict of layers by name, shared between builds. See
+            shared_layer().
 
     Returns: Masks [batch, num_rois, MASK_POOL_SIZE, MASK_POOL_SIZE, NUM_CLASSES]
     """
     # ROI Pooling
     # Shape: [batch, num_rois, MASK_POOL_SIZE, MASK_POOL_SIZE, channels]
-    x = PyramidROIAlign([pool_size, pool_size],
-                        name="roi_align_mask")([rois, image_meta] + feature_maps)
+    x = shared_layer(layers, PyramidROIAlign(
+        [pool_size, pool_size], sampling_ratio=sampling_ratio,
+        name="roi_align_mask"))([rois, image_meta] + feature_maps)
 
     # Conv layers
-    x = KL.TimeDistributed(KL.Conv2D(256, (3, 3), padding="same"),
-                           name="mrcnn_mask_conv1")(x)
-    x = KL.TimeDistributed(BatchNorm(),
-                           name='mrcnn_mask_bn1')(x, training=train_bn)
+    x = shared_layer(layers, KL.TimeDistributed(
+        KL.Conv2D(256, (3, 3), padding="same"), name="mrcnn_mask_conv1"))(x)
+    x = shared_layer(layers, KL.TimeDistributed(
+        BatchNorm(), name='mrcnn_mask_bn1'))(x, training=train_bn)
     x = KL.Activation('relu')(x)
 
-    x = KL.TimeDistributed(KL.Conv2D(256, (3, 3), padding="same"),
-                           name="mrcnn_mask_conv2")(x)
-    x = KL.TimeDistributed(BatchNorm(),
-                           name='mrcnn_mask_bn2')(x, training=train_bn)
+    x = shared_layer(layers, KL.TimeDistributed(
+        KL.Conv2D(256, (3, 3), padding="same"), name="mrcnn_mask_conv2"))(x)
+    x = shared_layer(layers, KL.TimeDistributed(
+        BatchNorm(), name='mrcnn_mask_bn2'))(x, training=train_bn)
     x = KL.Activation('relu')(x)
 
-    x = KL.TimeDistributed(KL.Conv2D(256, (3, 3), padding="same"),
-                           name="mrcnn_mask_conv3")(x)
-    x = KL.TimeDistributed(BatchNorm(),
-                           name='mrcnn_mask_bn3')(x, training=train_bn)
+    x = shared_layer(layers, KL.TimeDistributed(
+        KL.Conv2D(256, (3, 3), padding="same"), name="mrcnn_mask_conv3"))(x)
+    x = shared_layer(layers, KL.TimeDistributed(
+        BatchNorm(), name='mrcnn_mask_bn3'))(x, training=train_bn)
     x = KL.Activation('relu')(x)
 
-    x = KL.TimeDistributed(KL.Conv2D(256, (3, 3), padding="same"),
-                           name="mrcnn_mask_conv4")(x)
-    x = KL.TimeDistributed(BatchNorm(),
-                           name='mrcnn_mask_bn4')(x, training=train_bn)
+    x = shared_layer(layers, KL.TimeDistributed(
+        KL.Conv2D(256, (3, 3), padding="same"), name="mrcnn_mask_conv4"))(x)
+    x = shared_layer(layers, KL.TimeDistributed(
+        BatchNorm(), name='mrcnn_mask_bn4'))(x, training=train_bn)
     x = KL.Activation('relu')(x)
 
-    x = KL.TimeDistributed(KL.Conv2DTranspose(256, (2, 2), strides=2, activation="relu"),
-                           name="mrcnn_mask_deconv")(x)
-    x = KL.TimeDistributed(KL.Conv2D(num_classes, (1, 1), strides=1, activation="sigmoid"),
-                           name="mrcnn_mask")(x)
+    x = shared_layer(layers, KL.TimeDistributed(
+        KL.Conv2DTranspose(256, (2, 2), strides=2, activation="relu"),
+        name="mrcnn_mask_deconv"))(x)
+    x = shared_layer(layers, KL.TimeDistributed(
+        KL.Conv2D(num_classes, (1, 1), strides=1, activation="sigmoid"),
+        name="mrcnn_mask"))(x)
     return x
 
 
@@ -1324,18 +1493,8 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
     gt_boxes = gt_boxes[instance_ids]
     gt_masks = gt_masks[:, :, instance_ids]
 
-    # Compute areas of ROIs and ground truth boxes.
-    rpn_roi_area = (rpn_rois[:, 2] - rpn_rois[:, 0]) * \
-        (rpn_rois[:, 3] - rpn_rois[:, 1])
-    gt_box_area = (gt_boxes[:, 2] - gt_boxes[:, 0]) * \
-        (gt_boxes[:, 3] - gt_boxes[:, 1])
-
     # Compute overlaps [rpn_rois, gt_boxes]
-    overlaps = np.zeros((rpn_rois.shape[0], gt_boxes.shape[0]))
-    for i in range(overlaps.shape[1]):
-        gt = gt_boxes[i]
-        overlaps[:, i] = utils.compute_iou(
-            gt, rpn_rois, gt_box_area[i], rpn_roi_area)
+    overlaps = utils.compute_overlaps(rpn_rois, gt_boxes)
 
     # Assign ROIs to GT boxes
     rpn_roi_iou_argmax = np.argmax(overlaps, axis=1)
@@ -1412,32 +1571,30 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
     bboxes /= config.BBOX_STD_DEV
 
     # Generate class-specific target masks
+    # Same as detection_targets_graph(): crop all the positive ROIs from
+    # their GT masks in one step, without pasting mini-masks back into
+    # image sized placeholders.
     masks = np.zeros((config.TRAIN_ROIS_PER_IMAGE, config.MASK_SHAPE[0], config.MASK_SHAPE[1], config.NUM_CLASSES),
                      dtype=np.float32)
-    for i in pos_ids:
-        class_id = roi_gt_class_ids[i]
-        assert class_id > 0, "class id must be greater than 0"
-        gt_id = roi_gt_assignment[i]
-        class_mask = gt_masks[:, :, gt_id]
-
-        if config.USE_MINI_MASK:
-            # Create a mask placeholder, the size of the image
-            placeholder = np.zeros(config.IMAGE_SHAPE[:2], dtype=bool)
-            # GT box
-            gt_y1, gt_x1, gt_y2, gt_x2 = gt_boxes[gt_id]
-            gt_w = gt_x2 - gt_x1
-            gt_h = gt_y2 - gt_y1
-            # Resize mini mask to size of GT box
-            placeholder[gt_y1:gt_y2, gt_x1:gt_x2] = \
-                np.round(utils.resize(class_mask, (gt_h, gt_w))).astype(bool)
-            # Place the mini batch in the placeholder
-            class_mask = placeholder
-
-        # Pick part of the mask and resize it
-        y1, x1, y2, x2 = rois[i].astype(np.int32)
-        m = class_mask[y1:y2, x1:x2]
-        mask = utils.resize(m, config.MASK_SHAPE)
-        masks[i, :, :, class_id] = mask
+    pos_class_ids = roi_gt_class_ids[pos_ids]
+    assert np.all(pos_class_ids > 0), "class id must be greater than 0"
+    pos_gt_ids = roi_gt_assignment[pos_ids]
+    # The image size cancels out in mini-mask space, but not with full masks
+    image_shape = config.IMAGE_SHAPE[:2] if config.USE_MINI_MASK \
+        else gt_masks.shape[:2]
+    boxes = utils.norm_boxes(rois[pos_ids], image_shape)
+    if config.USE_MINI_MASK:
+        # Transform ROI coordinates from normalized image space
+        # to normalized mini-mask space.
+        gt = utils.norm_boxes(gt_boxes[pos_gt_ids], image_shape)
+        gt_hw = np.tile(gt[:, 2:] - gt[:, :2], 2)
+        boxes = (boxes - np.tile(gt[:, :2], 2)) / gt_hw
+    # [instances, height, width, 1] view of the GT masks. No copy.
+    mask_images = np.moveaxis(gt_masks, 2, 0)[..., np.newaxis]
+    crops = utils.crop_and_resize(mask_images, boxes, pos_gt_ids,
+                                  config.MASK_SHAPE)
+    # Threshold mask pixels at 0.5 to have GT masks be 0 or 1
+    masks[pos_ids, :, :, pos_class_ids] = np.round(crops[..., 0])
 
     return rois, roi_gt_class_ids, bboxes, masks
 
@@ -1446,7 +1603,8 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
     """Given the anchors and GT boxes, compute overlaps and identify positive
     anchors and deltas to refine them to match their corresponding GT boxes.
 
-    anchors: [num_anchors, (y1, x1, y2, x2)]
+    anchors: [num_anchors, (y1, x1, y2, x2)], or a utils.PyramidAnchors to
+        reuse its precomputed areas, centers and sizes.
     gt_class_ids: [num_gt_boxes] Integer class IDs.
     gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
 
@@ -1455,6 +1613,16 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
                1 = positive anchor, -1 = negative anchor, 0 = neutral
     rpn_bbox: [N, (dy, dx, log(dh), log(dw))] Anchor bbox deltas.
     """
+    if isinstance(anchors, utils.PyramidAnchors):
+        anchor_areas = anchors.areas
+        anchor_centers = anchors.centers
+        anchor_sizes = anchors.sizes
+        anchors = anchors.boxes
+    else:
+        anchor_areas = None
+        anchor_sizes = anchors[:, 2:] - anchors[:, :2]
+        anchor_centers = anchors[:, :2] + 0.5 * anchor_sizes
+
     # RPN Match: 1 = positive anchor, -1 = negative anchor, 0 = neutral
     rpn_match = np.zeros([anchors.shape[0]], dtype=np.int32)
     # RPN bounding boxes: [max anchors per image, (dy, dx, log(dh), log(dw))]
@@ -1471,7 +1639,8 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
         gt_class_ids = gt_class_ids[non_crowd_ix]
         gt_boxes = gt_boxes[non_crowd_ix]
         # Compute overlaps with crowd boxes [anchors, crowds]
-        crowd_overlaps = utils.compute_overlaps(anchors, crowd_boxes)
+        crowd_overlaps = utils.compute_overlaps(anchors, crowd_boxes,
+                                                anchor_areas)
         crowd_iou_max = np.amax(crowd_overlaps, axis=1)
         no_crowd_bool = (crowd_iou_max < 0.001)
     else:
@@ -1479,7 +1648,7 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
         no_crowd_bool = np.ones([anchors.shape[0]], dtype=bool)
 
     # Compute overlaps [num_anchors, num_gt_boxes]
-    overlaps = utils.compute_overlaps(anchors, gt_boxes)
+    overlaps = utils.compute_overlaps(anchors, gt_boxes, anchor_areas)
 
     # Match anchors to GT Boxes
     # If an anchor overlaps a GT box with IoU >= 0.7 then it's positive.
@@ -1521,39 +1690,33 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
     # For positive anchors, compute shift and scale needed to transform them
     # to match the corresponding GT boxes.
     ids = np.where(rpn_match == 1)[0]
-    ix = 0  # index into rpn_bbox
-    # TODO: use box_refinement() rather than duplicating the code here
-    for i, a in zip(ids, anchors[ids]):
-        # Closest gt box (it might have IoU < 0.7)
-        gt = gt_boxes[anchor_iou_argmax[i]]
-
-        # Convert coordinates to center plus width/height.
-        # GT Box
-        gt_h = gt[2] - gt[0]
-        gt_w = gt[3] - gt[1]
-        gt_center_y = gt[0] + 0.5 * gt_h
-        gt_center_x = gt[1] + 0.5 * gt_w
-        # Anchor
-        a_h = a[2] - a[0]
-        a_w = a[3] - a[1]
-        a_center_y = a[0] + 0.5 * a_h
-        a_center_x = a[1] + 0.5 * a_w
-
-        # Compute the bbox refinement that the RPN should predict.
-        rpn_bbox[ix] = [
-            (gt_center_y - a_center_y) / a_h,
-            (gt_center_x - a_center_x) / a_w,
-            np.log(gt_h / a_h),
-            np.log(gt_w / a_w),
-        ]
-        # Normalize
-        rpn_bbox[ix] /= config.RPN_BBOX_STD_DEV
-        ix += 1
+    # Closest gt box of each positive anchor (it might have IoU < 0.7)
+    gt = gt_boxes[anchor_iou_argmax[ids]]
+
+    # Convert coordinates to center plus width/height.
+    # GT Box
+    gt_h = gt[:, 2] - gt[:, 0]
+    gt_w = gt[:, 3] - gt[:, 1]
+    gt_center_y = gt[:, 0] + 0.5 * gt_h
+    gt_center_x = gt[:, 1] + 0.5 * gt_w
+    # Anchor
+    a_h, a_w = anchor_sizes[ids, 0], anchor_sizes[ids, 1]
+    a_center_y, a_center_x = anchor_centers[ids, 0], anchor_centers[ids, 1]
+
+    # Compute the bbox refinement that the RPN should predict.
+    rpn_bbox[:len(ids)] = np.stack([
+        (gt_center_y - a_center_y) / a_h,
+        (gt_center_x - a_center_x) / a_w,
+        np.log(gt_h / a_h),
+        np.log(gt_w / a_w),
+    ], axis=1)
+    # Normalize
+    rpn_bbox[:len(ids)] /= config.RPN_BBOX_STD_DEV
 
     return rpn_match, rpn_bbox
 
 
-def generate_random_rois(image_shape, count, gt_class_ids, gt_boxes):
+def generate_random_rois(image_shape, count, gt_class_ids, gt_boxes, rng=None):
     """Generates ROI proposals similar to what a region proposal network
     would generate.
 
@@ -1561,75 +1724,189 @@ def generate_random_rois(image_shape, count, gt_class_ids, gt_boxes):
     count: Number of ROIs to generate
     gt_class_ids: [N] Integer ground truth class IDs
     gt_boxes: [N, (y1, x1, y2, x2)] Ground truth boxes in pixels.
+    rng: Optional. A np.random.Generator to draw from. If None, one is
+        seeded from the global np.random state, so np.random.seed() still
+        makes the results reproducible.
 
     Returns: [count, (y1, x1, y2, x2)] ROI boxes in pixels.
     """
-    # placeholder
-    rois = np.zeros((count, 4), dtype=np.int32)
+    if rng is None:
+        rng = np.random.default_rng(np.random.randint(2 ** 31))
 
-    # Generate random ROIs around GT boxes (90% of count)
+    # Random ROIs around GT boxes (90% of count) and anywhere in the
+    # image (10% of count). Find the sampling range of each ROI.
     rois_per_box = int(0.9 * count / gt_boxes.shape[0])
-    for i in range(gt_boxes.shape[0]):
-        gt_y1, gt_x1, gt_y2, gt_x2 = gt_boxes[i]
-        h = gt_y2 - gt_y1
-        w = gt_x2 - gt_x1
-        # random boundaries
-        r_y1 = max(gt_y1 - h, 0)
-        r_y2 = min(gt_y2 + h, image_shape[0])
-        r_x1 = max(gt_x1 - w, 0)
-        r_x2 = min(gt_x2 + w, image_shape[1])
-
-        # To avoid generating boxes with zero area, we generate double what
-        # we need and filter out the extra. If we get fewer valid boxes
-        # than we need, we loop and try again.
-        while True:
-            y1y2 = np.random.randint(r_y1, r_y2, (rois_per_box * 2, 2))
-            x1x2 = np.random.randint(r_x1, r_x2, (rois_per_box * 2, 2))
-            # Filter out zero area boxes
-            threshold = 1
-            y1y2 = y1y2[np.abs(y1y2[:, 0] - y1y2[:, 1]) >=
-                        threshold][:rois_per_box]
-            x1x2 = x1x2[np.abs(x1x2[:, 0] - x1x2[:, 1]) >=
-                        threshold][:rois_per_box]
-            if y1y2.shape[0] == rois_per_box and x1x2.shape[0] == rois_per_box:
-                break
-
-        # Sort on axis 1 to ensure x1 <= x2 and y1 <= y2 and then reshape
-        # into x1, y1, x2, y2 order
-        x1, x2 = np.split(np.sort(x1x2, axis=1), 2, axis=1)
-        y1, y2 = np.split(np.sort(y1y2, axis=1), 2, axis=1)
-        box_rois = np.hstack([y1, x1, y2, x2])
-        rois[rois_per_box * i:rois_per_box * (i + 1)] = box_rois
-
-    # Generate random ROIs anywhere in the image (10% of count)
     remaining_count = count - (rois_per_box * gt_boxes.shape[0])
-    # To avoid generating boxes with zero area, we generate double what
-    # we need and filter out the extra. If we get fewer valid boxes
-    # than we need, we loop and try again.
-    while True:
-        y1y2 = np.random.randint(0, image_shape[0], (remaining_count * 2, 2))
-        x1x2 = np.random.randint(0, image_shape[1], (remaining_count * 2, 2))
-        # Filter out zero area boxes
-        threshold = 1
-        y1y2 = y1y2[np.abs(y1y2[:, 0] - y1y2[:, 1]) >=
-                    threshold][:remaining_count]
-        x1x2 = x1x2[np.abs(x1x2[:, 0] - x1x2[:, 1]) >=
-                    threshold][:remaining_count]
-        if y1y2.shape[0] == remaining_count and x1x2.shape[0] == remaining_count:
-            break
-
-    # Sort on axis 1 to ensure x1 <= x2 and y1 <= y2 and then reshape
-    # into x1, y1, x2, y2 order
-    x1, x2 = np.split(np.sort(x1x2, axis=1), 2, axis=1)
-    y1, y2 = np.split(np.sort(y1y2, axis=1), 2, axis=1)
-    global_rois = np.hstack([y1, x1, y2, x2])
-    rois[-remaining_count:] = global_rois
+    h = gt_boxes[:, 2] - gt_boxes[:, 0]
+    w = gt_boxes[:, 3] - gt_boxes[:, 1]
+    r_y1 = np.concatenate([np.repeat(np.maximum(gt_boxes[:, 0] - h, 0), rois_per_box),
+                           np.zeros(remaining_count, dtype=np.int64)])
+    r_y2 = np.concatenate([np.repeat(np.minimum(gt_boxes[:, 2] + h, image_shape[0]), rois_per_box),
+                           np.full(remaining_count, image_shape[0], dtype=np.int64)])
+    r_x1 = np.concatenate([np.repeat(np.maximum(gt_boxes[:, 1] - w, 0), rois_per_box),
+                           np.zeros(remaining_count, dtype=np.int64)])
+    r_x2 = np.concatenate([np.repeat(np.minimum(gt_boxes[:, 3] + w, image_shape[1]), rois_per_box),
+                           np.full(remaining_count, image_shape[1], dtype=np.int64)])
+
+    def random_intervals(low, high):
+        """Picks two distinct integers in [low, high) for each range and
+        returns them sorted. Drawing the second one from the values left
+        over avoids zero size intervals without rejection sampling.
+        """
+        # Widen ranges of degenerate GT boxes to fit two distinct values
+        low = np.maximum(np.minimum(low, high - 2), 0)
+        high = np.maximum(high, low + 2)
+        a = rng.integers(low, high)
+        b = rng.integers(low, high - 1)
+        b += (b >= a)
+        return np.minimum(a, b), np.maximum(a, b)
+
+    y1, y2 = random_intervals(r_y1, r_y2)
+    x1, x2 = random_intervals(r_x1, r_x2)
+    rois = np.stack([y1, x1, y2, x2], axis=1).astype(np.int32)
     return rois
 
 
+class BatchAssembler(object):
+    """Assembles the batches of data_generator() in preallocated arrays.
+
+    Buffers are allocated once per combination of array shapes and reused
+    in a ring of buffer_count sets, so a batch is only overwritten after
+    buffer_count more batches are assembled. The consumer must be done with
+    a batch by then. With buffer_count=0, new arrays are allocated for
+    every batch, which is safe with any consumer.
+
+    Arrays padded to a fixed size (e.g. MAX_GT_INSTANCES) only get their
+    valid part copied, and only the slots left over from the previous use
+    of the buffer are cleared.
+    """
+
+    def __init__(self, batch_size, buffer_count=2):
+        self.batch_size = batch_size
+        self.buffer_count = buffer_count
+        # Ring of buffer sets for each shape signature: [position, [sets]]
+        self._rings = {}
+        self.buffers = None
+        self.counts = None
+
+    def allocate(self, specs):
+        """Selects the buffers for a new batch.
+
+        specs: OrderedDict of name -> (item shape, dtype).
+
+        Returns an OrderedDict of name -> [batch, item shape] arrays.
+        """
+        def new_buffers():
+            buffers = OrderedDict([
+                (name, np.zeros((self.batch_size,) + tuple(shape), dtype=dtype))
+                for name, (shape, dtype) in specs.items()])
+            # Valid length of each padded item in the buffers
+            counts = {name: np.zeros(self.batch_size, dtype=np.int32)
+                      for name in specs}
+            return buffers, counts
+
+        if not self.buffer_count:
+            self.buffers, self.counts = new_buffers()
+            return self.buffers
+
+        key = tuple((name, tuple(shape), np.dtype(dtype).str)
+                    for name, (shape, dtype) in specs.items())
+        ring = self._rings.setdefault(key, [0, []])
+        position, sets = ring
+        if len(sets) < self.buffer_count:
+            sets.append(new_buffers())
+        self.buffers, self.counts = sets[position]
+        ring[0] = (position + 1) % self.buffer_count
+        return self.buffers
+
+    def copy(self, name, b, value):
+        """Copies value to item b of the named buffer."""
+        self.buffers[name][b] = value
+
+    def copy_padded(self, name, b, value, axis=0):
+        """Copies value to the start of item b of the named buffer along
+        the given axis, and zeroes what's left of the previous item.
+        """
+        item = self.buffers[name][b]
+        axis = axis % item.ndim
+        count = value.shape[axis]
+        previous = self.counts[name][b]
+        index = [slice(None)] * item.ndim
+        index[axis] = slice(0, count)
+        item[tuple(index)] = value
+        if previous > count:
+            index[axis] = slice(count, previous)
+            item[tuple(index)] = 0
+        self.counts[name][b] = count
+
+    def mold_image(self, name, b, image, config):
+        """Same as mold_image(), but writes the result straight to item b of
+        the named buffer without intermediate copies.
+        """
+        np.subtract(image, config.MEAN_PIXEL, out=self.buffers[name][b],
+                    casting="unsafe")
+
+
+def compute_gt_instance_width(instance_count, config):
+    """Returns the number of instances to pad the GT arrays of a batch to.
+
+    instance_count: The largest number of instances of an image in the batch.
+
+    Pads to MAX_GT_INSTANCES unless GT_INSTANCE_BUCKETS is set, in which case
+    it picks the smallest bucket that fits the instances.
+    """
+    if config.GT_INSTANCE_BUCKETS:
+        for size in sorted(config.GT_INSTANCE_BUCKETS):
+            if size >= instance_count:
+                return min(size, config.MAX_GT_INSTANCES)
+    return config.MAX_GT_INSTANCES
+
+
+def group_image_ids_by_shape(dataset, config, image_ids=None):
+    """Groups images by the shape they're molded to. With IMAGE_RESIZE_MODE
+    "pad64" or "none", images of different sizes or aspect ratios end up with
+    different shapes and can't share a batch.
+
+    The image sizes are read from the "height" and "width" of the image info
+    in the dataset, so the images are not loaded.
+
+    image_ids: Optional. The images to group. Defaults to all of them.
+
+    Returns an OrderedDict of molded shape -> list of image IDs.
+    """
+    image_ids = dataset.image_ids if image_ids is None else image_ids
+    groups = OrderedDict()
+    for image_id in image_ids:
+        info = dataset.image_info[image_id]
+        shape = compute_molded_shape(config, (info["height"], info["width"]))
+        groups.setdefault(shape, []).append(image_id)
+    return groups
+
+
+def batch_image_ids_by_shape(dataset, config, batch_size, image_ids=None,
+                             shuffle=False):
+    """Splits images into batches of up to batch_size images that are molded
+    to the same shape. See group_image_ids_by_shape().
+
+    shuffle: If True, shuffles the images within each shape and the order
+        of the batches.
+
+    Returns a list of lists of image IDs.
+    """
+    batches = []
+    for ids in group_image_ids_by_shape(dataset, config, image_ids).values():
+        if shuffle:
+            np.random.shuffle(ids)
+        batches.extend(ids[i:i + batch_size]
+                       for i in range(0, len(ids), batch_size))
+    if shuffle:
+        np.random.shuffle(batches)
+    return batches
+
+
 def data_generator(dataset, config, shuffle=True, augment=False, augmentation=None,
                    random_rois=0, batch_size=1, detection_targets=False,
-                   no_augmentation_sources=None):
+                   no_augmentation_sources=None, buffer_count=0):
     """A generator that returns images and corresponding target class ids,
     bounding box deltas, and masks.
 
@@ -1651,6 +1928,15 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
     no_augmentation_sources: Optional. List of sources to exclude for
         augmentation. A source is string that identifies a dataset and is
         defined in the Dataset class.
+    buffer_count: Number of sets of batch arrays to reuse in turn. The
+        arrays of a batch are overwritten buffer_count batches later, so
+        only use it if each batch is consumed before then. 0 allocates new
+        arrays for each batch. See BatchAssembler.
+
+    Images are batched with other images of the same shape. With
+    IMAGE_RESIZE_MODE "pad64", images of different aspect ratios are padded
+    to different shapes, so each shape fills its own batches rather than
+    all images being padded to one square.
 
     Returns a Python generator. Upon calling next() on it, the
     generator returns two lists, inputs and outputs. The contents
@@ -1665,25 +1951,22 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
     - gt_masks: [batch, height, width, MAX_GT_INSTANCES]. The height and width
                 are those of the image unless use_mini_mask is True, in which
                 case they are defined in MINI_MASK_SHAPE.
+      If config.GT_INSTANCE_BUCKETS is set, the GT arrays are padded to the
+      bucket that fits the instances of the batch rather than MAX_GT_INSTANCES.
 
     outputs list: Usually empty in regular training. But if detection_targets
         is True then the outputs list contains target class_ids, bbox deltas,
         and masks.
     """
-    b = 0  # batch item index
     image_index = -1
     image_ids = np.copy(dataset.image_ids)
     error_count = 0
     no_augmentation_sources = no_augmentation_sources or []
 
-    # Anchors
-    # [anchor_count, (y1, x1, y2, x2)]
-    backbone_shapes = compute_backbone_shapes(config, config.IMAGE_SHAPE)
-    anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
-                                             config.RPN_ANCHOR_RATIOS,
-                                             backbone_shapes,
-                                             config.BACKBONE_STRIDES,
-                                             config.RPN_ANCHOR_STRIDE)
+    # Batch arrays
+    assembler = BatchAssembler(batch_size, buffer_count)
+    # Images waiting for a batch, keyed by image shape
+    pending = {}
 
     # Keras requires a generator to run indefinitely.
     while True:
@@ -1714,6 +1997,10 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
             if not np.any(gt_class_ids > 0):
                 continue
 
+            # Anchors of this image shape.
+            # Shared with the rest of the process. See get_anchor_pyramid()
+            anchors = get_anchor_pyramid(config, image.shape)
+
             # RPN Targets
             rpn_match, rpn_bbox = build_rpn_targets(image.shape, anchors,
                                                     gt_class_ids, gt_boxes, config)
@@ -1727,36 +2014,6 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
                         build_detection_targets(
                             rpn_rois, gt_class_ids, gt_boxes, gt_masks, config)
 
-            # Init batch arrays
-            if b == 0:
-                batch_image_meta = np.zeros(
-                    (batch_size,) + image_meta.shape, dtype=image_meta.dtype)
-                batch_rpn_match = np.zeros(
-                    [batch_size, anchors.shape[0], 1], dtype=rpn_match.dtype)
-                batch_rpn_bbox = np.zeros(
-                    [batch_size, config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4], dtype=rpn_bbox.dtype)
-                batch_images = np.zeros(
-                    (batch_size,) + image.shape, dtype=np.float32)
-                batch_gt_class_ids = np.zeros(
-                    (batch_size, config.MAX_GT_INSTANCES), dtype=np.int32)
-                batch_gt_boxes = np.zeros(
-                    (batch_size, config.MAX_GT_INSTANCES, 4), dtype=np.int32)
-                batch_gt_masks = np.zeros(
-                    (batch_size, gt_masks.shape[0], gt_masks.shape[1],
-                     config.MAX_GT_INSTANCES), dtype=gt_masks.dtype)
-                if random_rois:
-                    batch_rpn_rois = np.zeros(
-                        (batch_size, rpn_rois.shape[0], 4), dtype=rpn_rois.dtype)
-                    if detection_targets:
-                        batch_rois = np.zeros(
-                            (batch_size,) + rois.shape, dtype=rois.dtype)
-                        batch_mrcnn_class_ids = np.zeros(
-                            (batch_size,) + mrcnn_class_ids.shape, dtype=mrcnn_class_ids.dtype)
-                        batch_mrcnn_bbox = np.zeros(
-                            (batch_size,) + mrcnn_bbox.shape, dtype=mrcnn_bbox.dtype)
-                        batch_mrcnn_mask = np.zeros(
-                            (batch_size,) + mrcnn_mask.shape, dtype=mrcnn_mask.dtype)
-
             # If more instances than fits in the array, sub-sample from them.
             if gt_boxes.shape[0] > config.MAX_GT_INSTANCES:
                 ids = np.random.choice(
@@ -1765,43 +2022,74 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
                 gt_boxes = gt_boxes[ids]
                 gt_masks = gt_masks[:, :, ids]
 
-            # Add to batch
-            batch_image_meta[b] = image_meta
-            batch_rpn_match[b] = rpn_match[:, np.newaxis]
-            batch_rpn_bbox[b] = rpn_bbox
-            batch_images[b] = mold_image(image.astype(np.float32), config)
-            batch_gt_class_ids[b, :gt_class_ids.shape[0]] = gt_class_ids
-            batch_gt_boxes[b, :gt_boxes.shape[0]] = gt_boxes
-            batch_gt_masks[b, :, :, :gt_masks.shape[-1]] = gt_masks
+            # Add to the batch of images of the same shape
+            item = {"images": image, "image_meta": image_meta,
+                    "rpn_match": rpn_match[:, np.newaxis], "rpn_bbox": rpn_bbox,
+                    "gt_class_ids": gt_class_ids, "gt_boxes": gt_boxes,
+                    "gt_masks": gt_masks}
             if random_rois:
-                batch_rpn_rois[b] = rpn_rois
+                item["rpn_rois"] = rpn_rois
                 if detection_targets:
-                    batch_rois[b] = rois
-                    batch_mrcnn_class_ids[b] = mrcnn_class_ids
-                    batch_mrcnn_bbox[b] = mrcnn_bbox
-                    batch_mrcnn_mask[b] = mrcnn_mask
-            b += 1
+                    item.update(rois=rois, mrcnn_class_ids=mrcnn_class_ids,
+                                mrcnn_bbox=mrcnn_bbox, mrcnn_mask=mrcnn_mask)
+            items = pending.setdefault(image.shape, [])
+            items.append(item)
 
             # Batch full?
-            if b >= batch_size:
-                inputs = [batch_images, batch_image_meta, batch_rpn_match, batch_rpn_bbox,
-                          batch_gt_class_ids, batch_gt_boxes, batch_gt_masks]
-                outputs = []
-
-                if random_rois:
-                    inputs.extend([batch_rpn_rois])
-                    if detection_targets:
-                        inputs.extend([batch_rois])
-                        # Keras requires that output and targets have the same number of dimensions
-                        batch_mrcnn_class_ids = np.expand_dims(
-                            batch_mrcnn_class_ids, -1)
-                        outputs.extend(
-                            [batch_mrcnn_class_ids, batch_mrcnn_bbox, batch_mrcnn_mask])
-
-                yield inputs, outputs
-
-                # start a new batch
-                b = 0
+            if len(items) < batch_size:
+                continue
+            del pending[image.shape]
+
+            # Init batch arrays. The GT arrays are padded to the same number
+            # of instances, which depends on all the images in the batch.
+            width = compute_gt_instance_width(
+                max(len(item["gt_class_ids"]) for item in items), config)
+            specs = OrderedDict([
+                ("images", (image.shape, np.float32)),
+                ("image_meta", (image_meta.shape, image_meta.dtype)),
+                ("rpn_match", ((len(anchors), 1), rpn_match.dtype)),
+                ("rpn_bbox", ((config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4), rpn_bbox.dtype)),
+                ("gt_class_ids", ((width,), np.int32)),
+                ("gt_boxes", ((width, 4), np.int32)),
+                ("gt_masks", (gt_masks.shape[:2] + (width,), gt_masks.dtype)),
+            ])
+            if random_rois:
+                specs["rpn_rois"] = (rpn_rois.shape, rpn_rois.dtype)
+                if detection_targets:
+                    specs["rois"] = (rois.shape, rois.dtype)
+                    specs["mrcnn_class_ids"] = (mrcnn_class_ids.shape, mrcnn_class_ids.dtype)
+                    specs["mrcnn_bbox"] = (mrcnn_bbox.shape, mrcnn_bbox.dtype)
+                    specs["mrcnn_mask"] = (mrcnn_mask.shape, mrcnn_mask.dtype)
+            batch = assembler.allocate(specs)
+
+            # Fill them
+            for b, item in enumerate(items):
+                for name, value in item.items():
+                    if name == "images":
+                        assembler.mold_image(name, b, value, config)
+                    elif name == "gt_masks":
+                        assembler.copy_padded(name, b, value, axis=-1)
+                    elif name in ("gt_class_ids", "gt_boxes"):
+                        assembler.copy_padded(name, b, value)
+                    else:
+                        assembler.copy(name, b, value)
+
+            inputs = [batch["images"], batch["image_meta"], batch["rpn_match"],
+                      batch["rpn_bbox"], batch["gt_class_ids"], batch["gt_boxes"],
+                      batch["gt_masks"]]
+            outputs = []
+
+            if random_rois:
+                inputs.extend([batch["rpn_rois"]])
+                if detection_targets:
+                    inputs.extend([batch["rois"]])
+                    # Keras requires that output and targets have the same number of dimensions
+                    batch_mrcnn_class_ids = np.expand_dims(
+                        batch["mrcnn_class_ids"], -1)
+                    outputs.extend(
+                        [batch_mrcnn_class_ids, batch["mrcnn_bbox"], batch["mrcnn_mask"]])
+
+            yield inputs, outputs
         except (GeneratorExit, KeyboardInterrupt):
             raise
         except:
@@ -1813,6 +2101,65 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
                 raise
 
 
+############################################################
+#  Feature Cache
+############################################################
+
+class FeatureCache(object):
+    """Least recently used cache of the per-image outputs of the backbone
+    and the RPN, bounded by the total size of the cached arrays.
+
+    max_bytes: Maximum size of the cached arrays, in bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def key(image):
+        """Returns the cache key of an image: its shape, type and a hash of
+        its pixels.
+        """
+        image = np.ascontiguousarray(image)
+        return (image.shape, image.dtype.str, hashlib.sha1(image).hexdigest())
+
+    def get(self, key):
+        """Returns the dict of arrays cached for key, or None."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        """Caches a dict of arrays, evicting the least recently used entries
+        to make room. Entries larger than the cache aren't cached.
+        """
+        size = sum(a.nbytes for a in entry.values())
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self.nbytes -= sum(a.nbytes for a in self._entries.pop(key).values())
+        while self._entries and self.nbytes + size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= sum(a.nbytes for a in evicted.values())
+        self._entries[key] = entry
+        self.nbytes += size
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
 ############################################################
 #  MaskRCNN Class
 ############################################################
@@ -1835,6 +2182,14 @@ class MaskRCNN():
         self.model_dir = model_dir
         self.set_log_dir()
         self.keras_model = self.build(mode=mode, config=config)
+        # Image meta and window of the "native" resize mode, by image shape
+        self._native_inputs = OrderedDict()
+        # Keras functions of run_features() and detect_with_rois()
+        self._feature_function = None
+        self._roi_heads_function = None
+        # Backbone and RPN outputs by image. See FeatureCache.
+        self.feature_cache = FeatureCache(config.FEATURE_CACHE_BYTES)\
+            if config.FEATURE_CACHE_BYTES else None
 
     def build(self, mode, config):
         """Build Mask R-CNN architecture.
@@ -1882,12 +2237,10 @@ class MaskRCNN():
                            config.MINI_MASK_SHAPE[1], None],
                     name="input_gt_masks", dtype=bool)
             else:
+                # Image sized. The size varies with the image shape.
                 input_gt_masks = KL.Input(
-                    shape=[config.IMAGE_SHAPE[0], config.IMAGE_SHAPE[1], None],
+                    shape=[None, None, None],
                     name="input_gt_masks", dtype=bool)
-        elif mode == "inference":
-            # Anchors in normalized coordinates
-            input_anchors = KL.Input(shape=[None, 4], name="input_anchors")
 
         # Build the shared convolutional layers.
         # Bottom-up Layers
@@ -1924,16 +2277,15 @@ class MaskRCNN():
         rpn_feature_maps = [P2, P3, P4, P5, P6]
         mrcnn_feature_maps = [P2, P3, P4, P5]
 
-        # Anchors
-        if mode == "training":
-            anchors = self.get_anchors(config.IMAGE_SHAPE)
-            # Duplicate across the batch dimension because Keras requires it
-            # TODO: can this be optimized to avoid duplicating the anchors?
-            anchors = np.broadcast_to(anchors, (config.BATCH_SIZE,) + anchors.shape)
-            # A hack to get around Keras's bad support for constants
-            anchors = KL.Lambda(lambda x: tf.Variable(anchors), name="anchors")(input_image)
-        else:
-            anchors = input_anchors
+        # Anchors [anchor_count, (y1, x1, y2, x2)] in normalized coordinates
+        # Generated in the graph from the shapes of the feature maps, so they
+        # don't need to be fed and adapt to the size of the input images.
+        # All images in a batch have the same size, so they share the anchors.
+        anchors = KL.Lambda(
+            lambda x: generate_pyramid_anchors_graph(
+                x[1:], tf.shape(x[0])[1:3], config),
+            output_shape=lambda s: (None, 4),
+            name="anchors")([input_image] + rpn_feature_maps)
 
         # RPN Model
         rpn = build_rpn_model(config.RPN_ANCHOR_STRIDE,
@@ -1953,16 +2305,26 @@ class MaskRCNN():
 
         rpn_class_logits, rpn_class, rpn_bbox = outputs
 
+        # Outputs of the backbone and the RPN, computed by run_features().
+        # Feeding them back to the graph skips the layers that compute them.
+        self._feature_tensors = OrderedDict(
+            [("P{}".format(i), p) for i, p in enumerate(rpn_feature_maps, 2)] +
+            [("rpn_class", rpn_class), ("rpn_bbox", rpn_bbox)])
+
         # Generate proposals
         # Proposals are [batch, N, (y1, x1, y2, x2)] in normalized coordinates
         # and zero padded.
         proposal_count = config.POST_NMS_ROIS_TRAINING if mode == "training"\
             else config.POST_NMS_ROIS_INFERENCE
+        proposal_inputs = [rpn_class, rpn_bbox, anchors]
+        if config.PRE_NMS_LIMIT_PER_LEVEL:
+            # Per-level top-k needs to know where each level starts
+            proposal_inputs += [o[1] for o in layer_outputs]
         rpn_rois = ProposalLayer(
             proposal_count=proposal_count,
             nms_threshold=config.RPN_NMS_THRESHOLD,
             name="ROI",
-            config=config)([rpn_class, rpn_bbox, anchors])
+            config=config)(proposal_inputs)
 
         if mode == "training":
             # Class ID mask to mark class IDs supported by the dataset the image
@@ -1995,13 +2357,15 @@ class MaskRCNN():
                 fpn_classifier_graph(rois, mrcnn_feature_maps, input_image_meta,
                                      config.POOL_SIZE, config.NUM_CLASSES,
                                      train_bn=config.TRAIN_BN,
-                                     fc_layers_size=config.FPN_CLASSIF_FC_LAYERS_SIZE)
+                                     fc_layers_size=config.FPN_CLASSIF_FC_LAYERS_SIZE,
+                                     sampling_ratio=config.ROI_ALIGN_SAMPLING_RATIO)
 
             mrcnn_mask = build_fpn_mask_graph(rois, mrcnn_feature_maps,
                                               input_image_meta,
                                               config.MASK_POOL_SIZE,
                                               config.NUM_CLASSES,
-                                              train_bn=config.TRAIN_BN)
+                                              train_bn=config.TRAIN_BN,
+                                              sampling_ratio=config.ROI_ALIGN_SAMPLING_RATIO)
 
             # TODO: clean up (use tf.identify if necessary)
             output_rois = KL.Lambda(lambda x: x * 1, name="output_rois")(rois)
@@ -2031,11 +2395,15 @@ class MaskRCNN():
         else:
             # Network Heads
             # Proposal classifier and BBox regressor heads
+            # Their layers are kept to build the ROI heads below.
+            head_layers = {}
             mrcnn_class_logits, mrcnn_class, mrcnn_bbox =\
                 fpn_classifier_graph(rpn_rois, mrcnn_feature_maps, input_image_meta,
                                      config.POOL_SIZE, config.NUM_CLASSES,
                                      train_bn=config.TRAIN_BN,
-                                     fc_layers_size=config.FPN_CLASSIF_FC_LAYERS_SIZE)
+                                     fc_layers_size=config.FPN_CLASSIF_FC_LAYERS_SIZE,
+                                     sampling_ratio=config.ROI_ALIGN_SAMPLING_RATIO,
+                                     layers=head_layers)
 
             # Detections
             # output is [batch, num_detections, (y1, x1, y2, x2, class_id, score)] in
@@ -2049,13 +2417,41 @@ class MaskRCNN():
                                               input_image_meta,
                                               config.MASK_POOL_SIZE,
                                               config.NUM_CLASSES,
-                                              train_bn=config.TRAIN_BN)
+                                              train_bn=config.TRAIN_BN,
+                                              sampling_ratio=config.ROI_ALIGN_SAMPLING_RATIO,
+                                              layers=head_layers)
 
-            model = KM.Model([input_image, input_image_meta, input_anchors],
+            model = KM.Model([input_image, input_image_meta],
                              [detections, mrcnn_class, mrcnn_bbox,
                                  mrcnn_mask, rpn_rois, rpn_class, rpn_bbox],
                              name='mask_rcnn')
 
+            # ROI heads
+            # The classifier and mask heads again, with the same layers, on
+            # boxes given in input_rois instead of the RPN proposals. They're
+            # not part of the Keras model. detect_with_rois() runs them and
+            # feeds the feature maps directly to skip the backbone.
+            input_rois = KL.Input(shape=[None, 4], name="input_rois")
+            _, roi_class, roi_bbox = \
+                fpn_classifier_graph(input_rois, mrcnn_feature_maps, input_image_meta,
+                                     config.POOL_SIZE, config.NUM_CLASSES,
+                                     train_bn=config.TRAIN_BN,
+                                     fc_layers_size=config.FPN_CLASSIF_FC_LAYERS_SIZE,
+                                     sampling_ratio=config.ROI_ALIGN_SAMPLING_RATIO,
+                                     layers=head_layers)
+            roi_mask = build_fpn_mask_graph(input_rois, mrcnn_feature_maps,
+                                            input_image_meta,
+                                            config.MASK_POOL_SIZE,
+                                            config.NUM_CLASSES,
+                                            train_bn=config.TRAIN_BN,
+                                            sampling_ratio=config.ROI_ALIGN_SAMPLING_RATIO,
+                                            layers=head_layers)
+            self._roi_heads = {
+                "feature_maps": mrcnn_feature_maps,
+                "input_rois": input_rois,
+                "outputs": [roi_class, roi_bbox, roi_mask],
+            }
+
         # Add multi-GPU support.
         if config.GPU_COUNT > 1:
             from mrcnn.parallel_model import ParallelModel
@@ -2136,6 +2532,10 @@ class MaskRCNN():
         # Update the log directory
         self.set_log_dir(filepath)
 
+        # Cached features were computed with the previous weights
+        if self.feature_cache is not None:
+            self.feature_cache.clear()
+
     def get_imagenet_weights(self):
         """Downloads ImageNet trained weights from Keras.
         Returns path to weights file.
@@ -2298,7 +2698,8 @@ class MaskRCNN():
             "*epoch*", "{epoch:04d}")
 
     def train(self, train_dataset, val_dataset, learning_rate, epochs, layers,
-              augmentation=None, custom_callbacks=None, no_augmentation_sources=None):
+              augmentation=None, custom_callbacks=None, no_augmentation_sources=None,
+              max_queue_size=100):
         """Train the model.
         train_dataset, val_dataset: Training and validation Dataset objects.
         learning_rate: The learning rate to train with
@@ -2330,6 +2731,8 @@ class MaskRCNN():
         no_augmentation_sources: Optional. List of sources to exclude for
             augmentation. A source is string that identifies a dataset and is
             defined in the Dataset class.
+        max_queue_size: Maximum number of batches queued up by the data
+            generator workers.
         """
         assert self.mode == "training", "Create model in training mode."
 
@@ -2347,13 +2750,39 @@ class MaskRCNN():
         if layers in layer_regex.keys():
             layers = layer_regex[layers]
 
+        # Generate the anchors of every image shape before the data generator
+        # workers are forked so they all share the same read-only copies.
+        if self.config.IMAGE_RESIZE_MODE in ["square", "crop"]:
+            image_shapes = [self.config.IMAGE_SHAPE]
+        else:
+            image_shapes = group_image_ids_by_shape(train_dataset, self.config)
+        for image_shape in image_shapes:
+            get_anchor_pyramid(self.config, image_shape)
+
+        # Work-around for Windows: Keras fails on Windows when using
+        # multiprocessing workers. See discussion here:
+        # https://github.com/matterport/Mask_RCNN/issues/13#issuecomment-353124009
+        if os.name is 'nt':
+            workers = 0
+        else:
+            workers = multiprocessing.cpu_count()
+
         # Data generators
+        # Without workers, Keras consumes each batch before asking for the
+        # next one, so the batch arrays can be double buffered. Workers
+        # queue batches up, and any worker can fill the whole queue. The
+        # multiprocessing queue also pickles the batches later, in a feeder
+        # thread, so a reused array could be overwritten before it's sent.
+        # Workers get new arrays for each batch.
+        buffer_count = 2 if workers == 0 else 0
         train_generator = data_generator(train_dataset, self.config, shuffle=True,
                                          augmentation=augmentation,
                                          batch_size=self.config.BATCH_SIZE,
-                                         no_augmentation_sources=no_augmentation_sources)
+                                         no_augmentation_sources=no_augmentation_sources,
+                                         buffer_count=buffer_count)
         val_generator = data_generator(val_dataset, self.config, shuffle=True,
-                                       batch_size=self.config.BATCH_SIZE)
+                                       batch_size=self.config.BATCH_SIZE,
+                                       buffer_count=buffer_count)
 
         # Create log_dir if it does not exist
         if not os.path.exists(self.log_dir):
@@ -2377,14 +2806,6 @@ class MaskRCNN():
         self.set_trainable(layers)
         self.compile(learning_rate, self.config.LEARNING_MOMENTUM)
 
-        # Work-around for Windows: Keras fails on Windows when using
-        # multiprocessing workers. See discussion here:
-        # https://github.com/matterport/Mask_RCNN/issues/13#issuecomment-353124009
-        if os.name is 'nt':
-            workers = 0
-        else:
-            workers = multiprocessing.cpu_count()
-
         self.keras_model.fit_generator(
             train_generator,
             initial_epoch=self.epoch,
@@ -2393,7 +2814,7 @@ class MaskRCNN():
             callbacks=callbacks,
             validation_data=val_generator,
             validation_steps=self.config.VALIDATION_STEPS,
-            max_queue_size=100,
+            max_queue_size=max_queue_size,
             workers=workers,
             use_multiprocessing=True,
         )
@@ -2410,7 +2831,14 @@ class MaskRCNN():
         image_metas: [N, length of meta data]. Details about each image.
         windows: [N, (y1, x1, y2, x2)]. The portion of the image that has the
             original image (padding excluded).
+
+        In the "native" resize mode, images of the same shape take a faster
+        path. See mold_native_inputs().
         """
+        if self.config.IMAGE_RESIZE_MODE == "native" and \
+                all(image.shape == images[0].shape for image in images):
+            return self.mold_native_inputs(images)
+
         molded_images = []
         image_metas = []
         windows = []
@@ -2438,6 +2866,38 @@ class MaskRCNN():
         windows = np.stack(windows)
         return molded_images, image_metas, windows
 
+    def mold_native_inputs(self, images):
+        """Same as mold_inputs() for images of the same shape in the "native"
+        resize mode. The images are only padded, so the image meta and
+        window depend on the shape alone and are computed once per shape.
+        The images are normalized straight into the new batch array, and
+        only its padding is filled separately.
+        """
+        image_shape = tuple(images[0].shape)
+        h, w = image_shape[:2]
+        molded_shape = compute_molded_shape(self.config, image_shape)
+        if image_shape not in self._native_inputs:
+            window = np.array([0, 0, h, w])
+            image_meta = compose_image_meta(
+                0, image_shape, molded_shape, window, 1,
+                np.zeros([self.config.NUM_CLASSES], dtype=np.int32))
+            self._native_inputs[image_shape] = (image_meta, window)
+            # Only keep the most recent shapes
+            if len(self._native_inputs) > 8:
+                self._native_inputs.popitem(last=False)
+        image_meta, window = self._native_inputs[image_shape]
+
+        molded_images = np.empty((len(images),) + molded_shape, dtype=np.float32)
+        # The padding is zero before the mean pixel is subtracted
+        molded_images[:, h:] = -self.config.MEAN_PIXEL
+        molded_images[:, :h, w:] = -self.config.MEAN_PIXEL
+        for i, image in enumerate(images):
+            np.subtract(image, self.config.MEAN_PIXEL,
+                        out=molded_images[i, :h, :w], casting="unsafe")
+        image_metas = np.tile(image_meta, (len(images), 1))
+        windows = np.tile(window, (len(images), 1))
+        return molded_images, image_metas, windows
+
     def unmold_detections(self, detections, mrcnn_mask, original_image_shape,
                           image_shape, window):
         """Reformats the detections of one image from the format of the neural
@@ -2470,16 +2930,7 @@ class MaskRCNN():
 
         # Translate normalized coordinates in the resized image to pixel
         # coordinates in the original image before resizing
-        window = utils.norm_boxes(window, image_shape[:2])
-        wy1, wx1, wy2, wx2 = window
-        shift = np.array([wy1, wx1, wy1, wx1])
-        wh = wy2 - wy1  # window height
-        ww = wx2 - wx1  # window width
-        scale = np.array([wh, ww, wh, ww])
-        # Convert boxes to normalized coordinates on the window
-        boxes = np.divide(boxes - shift, scale)
-        # Convert boxes to pixel coordinates on the original image
-        boxes = utils.denorm_boxes(boxes, original_image_shape[:2])
+        boxes = unmold_boxes(boxes, original_image_shape, image_shape, window)
 
         # Filter out detections with zero area. Happens in early training when
         # network weights are still random
@@ -2506,7 +2957,12 @@ class MaskRCNN():
     def detect(self, images, verbose=0):
         """Runs the detection pipeline.
 
-        images: List of images, potentially of different sizes.
+        images: List of images, potentially of different sizes. The inference
+            graph accepts a variable batch size, so the list doesn't need to
+            match BATCH_SIZE. With multiple GPUs, the length must be a
+            multiple of GPU_COUNT. Images that are molded to different shapes
+            (e.g. with IMAGE_RESIZE_MODE "pad64") are run in one batch per
+            shape.
 
         Returns a list of dicts, one dict per image. The dict contains:
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
@@ -2515,50 +2971,51 @@ class MaskRCNN():
         masks: [H, W, N] instance binary masks
         """
         assert self.mode == "inference", "Create model in inference mode."
-        assert len(
-            images) == self.config.BATCH_SIZE, "len(images) must be equal to BATCH_SIZE"
+        assert len(images) > 0, "len(images) must be greater than zero"
+        assert len(images) % self.config.GPU_COUNT == 0,\
+            "len(images) must be a multiple of GPU_COUNT"
 
         if verbose:
             log("Processing {} images".format(len(images)))
             for image in images:
                 log("image", image)
 
-        # Mold inputs to format expected by the neural network
-        molded_images, image_metas, windows = self.mold_inputs(images)
-
-        # Validate image sizes
-        # All images in a batch MUST be of the same size
-        image_shape = molded_images[0].shape
-        for g in molded_images[1:]:
-            assert g.shape == image_shape,\
-                "After resizing, all images must have the same size. Check IMAGE_RESIZE_MODE and image sizes."
-
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
-
-        if verbose:
-            log("molded_images", molded_images)
-            log("image_metas", image_metas)
-            log("anchors", anchors)
-        # Run object detection
-        detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
-        # Process detections
-        results = []
+        # Group images by the shape they're molded to. All images in a
+        # batch MUST be of the same size.
+        groups = OrderedDict()
         for i, image in enumerate(images):
-            final_rois, final_class_ids, final_scores, final_masks =\
-                self.unmold_detections(detections[i], mrcnn_mask[i],
-                                       image.shape, molded_images[i].shape,
-                                       windows[i])
-            results.append({
-                "rois": final_rois,
-                "class_ids": final_class_ids,
-                "scores": final_scores,
-                "masks": final_masks,
-            })
+            shape = compute_molded_shape(self.config, image.shape)
+            groups.setdefault(shape, []).append(i)
+
+        results = [None] * len(images)
+        for ids in groups.values():
+            # With multiple GPUs, pad the batch to a multiple of GPU_COUNT
+            # by repeating its last image.
+            padded_ids = ids + ids[-1:] * (-len(ids) % self.config.GPU_COUNT)
+
+            # Mold inputs to format expected by the neural network
+            molded_images, image_metas, windows = self.mold_inputs(
+                [images[i] for i in padded_ids])
+
+            if verbose:
+                log("molded_images", molded_images)
+                log("image_metas", image_metas)
+            # Run object detection. Anchors are generated in the graph.
+            detections, _, _, mrcnn_mask, _, _, _ =\
+                self.keras_model.predict([molded_images, image_metas],
+                                         batch_size=len(padded_ids), verbose=0)
+            # Process detections
+            for j, i in enumerate(ids):
+                final_rois, final_class_ids, final_scores, final_masks =\
+                    self.unmold_detections(detections[j], mrcnn_mask[j],
+                                           images[i].shape, molded_images[j].shape,
+                                           windows[j])
+                results[i] = {
+                    "rois": final_rois,
+                    "class_ids": final_class_ids,
+                    "scores": final_scores,
+                    "masks": final_masks,
+                }
         return results
 
     def detect_molded(self, molded_images, image_metas, verbose=0):
@@ -2576,8 +3033,9 @@ class MaskRCNN():
         masks: [H, W, N] instance binary masks
         """
         assert self.mode == "inference", "Create model in inference mode."
-        assert len(molded_images) == self.config.BATCH_SIZE,\
-            "Number of images must be equal to BATCH_SIZE"
+        assert len(molded_images) > 0, "Number of images must be greater than zero"
+        assert len(molded_images) % self.config.GPU_COUNT == 0,\
+            "Number of images must be a multiple of GPU_COUNT"
 
         if verbose:
             log("Processing {} images".format(len(molded_images)))
@@ -2590,19 +3048,13 @@ class MaskRCNN():
         for g in molded_images[1:]:
             assert g.shape == image_shape, "Images must have the same size"
 
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
-
         if verbose:
             log("molded_images", molded_images)
             log("image_metas", image_metas)
-            log("anchors", anchors)
-        # Run object detection
+        # Run object detection. Anchors are generated in the graph.
         detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+            self.keras_model.predict([molded_images, image_metas],
+                                     batch_size=len(molded_images), verbose=0)
         # Process detections
         results = []
         for i, image in enumerate(molded_images):
@@ -2619,27 +3071,390 @@ class MaskRCNN():
             })
         return results
 
+    def detect_tiled(self, image, tile_size=None, overlap=None,
+                     merge_threshold=0.5, verbose=0):
+        """Runs the detection pipeline on overlapping tiles of an image,
+        instead of downscaling the image to IMAGE_MAX_DIM. Keeps the small
+        objects of high resolution images. Tiles are detected BATCH_SIZE at
+        a time, so the memory used by the model doesn't depend on the size
+        of the image.
+
+        image: An image of any size.
+        tile_size: Side of the square tiles in pixels. Defaults to
+            IMAGE_MAX_DIM, which runs the tiles at their native resolution
+            in the "square" resize mode.
+        overlap: Minimum number of pixels shared by neighboring tiles.
+            Objects smaller than this are whole in at least one tile, and
+            larger ones are stitched together. Defaults to tile_size / 4.
+        merge_threshold: Mask IoU above which the detections of two tiles
+            are the same object. See utils.merge_tiled_detections().
+
+        Returns a dict like detect(), with the detections of all tiles.
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        tile_size = tile_size or self.config.IMAGE_MAX_DIM
+        overlap = tile_size // 4 if overlap is None else overlap
+        tiles = utils.compute_tiles(image.shape[0], image.shape[1],
+                                    tile_size, overlap)
+        if verbose:
+            log("Processing {} tiles".format(len(tiles)))
+            log("image", image)
+
+        boxes, class_ids, scores, masks, tile_ids = [], [], [], [], []
+        for start in range(0, len(tiles), self.config.BATCH_SIZE):
+            batch = tiles[start:start + self.config.BATCH_SIZE]
+            crops = [image[y1:y2, x1:x2] for y1, x1, y2, x2 in batch]
+            # With multiple GPUs, pad the last batch to a multiple of
+            # GPU_COUNT by repeating its last tile.
+            padding = -len(crops) % self.config.GPU_COUNT
+            results = self.detect(crops + crops[-1:] * padding)
+            for t, r in enumerate(results[:len(crops)]):
+                # Keep copies of the masks in their boxes only, so that the
+                # memory doesn't grow with the number of tiles. A slice would
+                # keep the full mask array of the tile alive.
+                for k, (y1, x1, y2, x2) in enumerate(r["rois"]):
+                    masks.append(r["masks"][y1:y2, x1:x2, k].copy())
+                ty1, tx1 = batch[t][:2]
+                boxes.append(r["rois"] + np.array([ty1, tx1, ty1, tx1]))
+                class_ids.append(r["class_ids"])
+                scores.append(r["scores"])
+                tile_ids.append(np.full([len(r["rois"])], start + t))
+            # Free the full masks of the batch before detecting the next one
+            del results, r
+
+        boxes, class_ids, scores, masks = utils.merge_tiled_detections(
+            np.concatenate(boxes).astype(np.int32), np.concatenate(class_ids),
+            np.concatenate(scores), masks, np.concatenate(tile_ids), tiles,
+            image.shape, threshold=merge_threshold)
+        return {
+            "rois": boxes,
+            "class_ids": class_ids,
+            "scores": scores,
+            "masks": masks,
+        }
+
+    def detect_tta(self, image, scales=(1.0,), flip=True, merge="wbf",
+                   iou_threshold=0.55, verbose=0):
+        """Runs the detection pipeline with test-time augmentation. Scaled
+        and horizontally flipped versions of the image are detected in a
+        single batch, and their detections are mapped back to the image
+        and merged.
+
+        image: An image.
+        scales: Scale factors applied on top of the resizing of the image
+            set by the config. Values above 1 help with small objects.
+        flip: If True, a flipped version of each scale is added.
+        merge: How to merge the detections of the same object:
+            wbf: Weighted box fusion. The box and the mask are averaged,
+                 weighted by the scores. The score is averaged over all
+                 the versions, so objects detected in a few of them score
+                 lower and are dropped below DETECTION_MIN_CONFIDENCE.
+            nms: Non-maximum suppression. Keeps the top scoring detection.
+        iou_threshold: IoU above which detections are of the same object.
+
+        Returns a dict like detect().
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        assert merge in ["wbf", "nms"], "merge must be 'wbf' or 'nms'"
+        config = self.config
+        h, w = image.shape[:2]
+
+        # Versions of the image and their size
+        base_scale = utils.compute_resize_scale(
+            h, w, min_dim=config.IMAGE_MIN_DIM, max_dim=config.IMAGE_MAX_DIM,
+            min_scale=config.IMAGE_MIN_SCALE, mode=config.IMAGE_RESIZE_MODE)
+        versions = [(scale, flipped) for scale in scales
+                    for flipped in ([False, True] if flip else [False])]
+        sizes = [(int(round(h * base_scale * scale)), int(round(w * base_scale * scale)))
+                 for scale, _ in versions]
+
+        # Mold the versions to one batch. They're padded at the bottom and
+        # right to a common shape, a multiple of 64. With multiple GPUs, the
+        # batch is padded to a multiple of GPU_COUNT with the last version.
+        molded_shape = (int(math.ceil(max(s[0] for s in sizes) / 64) * 64),
+                        int(math.ceil(max(s[1] for s in sizes) / 64) * 64),
+                        image.shape[2])
+        count = len(versions) + (-len(versions) % config.GPU_COUNT)
+        molded_images = np.empty((count,) + molded_shape, dtype=np.float32)
+        # The padding is zero before the mean pixel is subtracted
+        molded_images[:] = -config.MEAN_PIXEL
+        image_metas = np.zeros([count, config.IMAGE_META_SIZE])
+        resized = {}
+        for v, ((scale, flipped), (vh, vw)) in enumerate(zip(versions, sizes)):
+            if (vh, vw) not in resized:
+                resized[(vh, vw)] = image if (vh, vw) == (h, w) else \
+                    utils.resize(image, (vh, vw), preserve_range=True)
+            version = resized[(vh, vw)][:, ::-1] if flipped else resized[(vh, vw)]
+            np.subtract(version, config.MEAN_PIXEL,
+                        out=molded_images[v, :vh, :vw], casting="unsafe")
+            image_metas[v] = compose_image_meta(
+                0, image.shape, molded_shape, (0, 0, vh, vw), base_scale * scale,
+                np.zeros([config.NUM_CLASSES], dtype=np.int32))
+        molded_images[len(versions):] = molded_images[len(versions) - 1]
+        image_metas[len(versions):] = image_metas[len(versions) - 1]
+        if verbose:
+            log("molded_images", molded_images)
+            log("image_metas", image_metas)
+
+        detections, _, _, mrcnn_mask, _, _, _ =\
+            self.keras_model.predict([molded_images, image_metas],
+                                     batch_size=count, verbose=0)
+
+        # Detections of all the versions in image coordinates. Masks stay
+        # at the size of the mask head until the merge.
+        boxes, class_ids, scores, masks = [], [], [], []
+        for v, (scale, flipped) in enumerate(versions):
+            # Detections are padded with zeros. Find the first class_id == 0.
+            zero_ix = np.where(detections[v, :, 4] == 0)[0]
+            n = zero_ix[0] if zero_ix.shape[0] > 0 else detections.shape[1]
+            ids = detections[v, :n, 4].astype(np.int32)
+            version_boxes = unmold_boxes(detections[v, :n, :4], image.shape,
+                                         molded_shape, (0, 0) + sizes[v])
+            version_masks = mrcnn_mask[v, np.arange(n), :, :, ids]
+            if flipped:
+                version_boxes = np.stack([version_boxes[:, 0], w - version_boxes[:, 3],
+                                          version_boxes[:, 2], w - version_boxes[:, 1]],
+                                         axis=1)
+                version_masks = version_masks[:, :, ::-1]
+            boxes.append(version_boxes)
+            class_ids.append(ids)
+            scores.append(detections[v, :n, 5])
+            masks.append(version_masks)
+        boxes = np.concatenate(boxes)
+        class_ids = np.concatenate(class_ids)
+        scores = np.concatenate(scores)
+        masks = np.concatenate(masks)
+        # Filter out detections with zero area
+        keep = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+        boxes, class_ids, scores, masks = \
+            boxes[keep], class_ids[keep], scores[keep], masks[keep]
+
+        # Merge the detections of each object
+        clusters = utils.cluster_detections(boxes, class_ids, scores, iou_threshold)
+        final_rois = np.zeros([len(clusters), 4], dtype=np.int32)
+        final_class_ids = np.zeros([len(clusters)], dtype=np.int32)
+        final_scores = np.zeros([len(clusters)], dtype=np.float32)
+        final_masks = np.zeros([h, w, len(clusters)], dtype=bool)
+        for c, members in enumerate(clusters):
+            top = members[0]
+            final_class_ids[c] = class_ids[top]
+            if merge == "nms":
+                final_rois[c] = boxes[top]
+                final_scores[c] = scores[top]
+                final_masks[:, :, c] = utils.unmold_mask(masks[top], boxes[top], image.shape)
+                continue
+            weights = scores[members]
+            final_rois[c] = np.round(np.average(boxes[members], axis=0,
+                                                weights=weights))
+            y1, x1, y2, x2 = final_rois[c]
+            final_scores[c] = weights.mean() * \
+                min(len(members), len(versions)) / len(versions)
+            # Average the masks of the members in the fused box
+            fused = np.zeros([y2 - y1, x2 - x1], dtype=np.float32)
+            for k, weight in zip(members, weights):
+                ky1, kx1, ky2, kx2 = boxes[k]
+                mask = utils.resize(masks[k], (ky2 - ky1, kx2 - kx1))
+                iy1, ix1, iy2, ix2 = max(ky1, y1), max(kx1, x1), min(ky2, y2), min(kx2, x2)
+                if iy2 > iy1 and ix2 > ix1:
+                    fused[iy1 - y1:iy2 - y1, ix1 - x1:ix2 - x1] += \
+                        weight * mask[iy1 - ky1:iy2 - ky1, ix1 - kx1:ix2 - kx1]
+            final_masks[y1:y2, x1:x2, c] = fused >= 0.5 * weights.sum()
+
+        # Sort by score and keep the confident ones
+        order = np.argsort(final_scores)[::-1]
+        order = order[final_scores[order] >= config.DETECTION_MIN_CONFIDENCE]
+        order = order[:config.DETECTION_MAX_INSTANCES]
+        return {
+            "rois": final_rois[order],
+            "class_ids": final_class_ids[order],
+            "scores": final_scores[order],
+            "masks": final_masks[:, :, order],
+        }
+
+    def build_function(self, inputs, outputs):
+        """Returns a Keras function that computes the outputs from the given
+        input tensors, in inference mode. The inputs can be any tensors of
+        the graph, which are then fed instead of computed.
+        """
+        model = self.keras_model
+        if model.uses_learning_phase and not isinstance(K.learning_phase(), int):
+            kf = K.function(inputs + [K.learning_phase()], outputs)
+            return lambda values: kf(values + [0.])
+        return K.function(inputs, outputs)
+
+    def run_features(self, molded_images, image_metas, keys=None):
+        """Runs the backbone, the FPN and the RPN heads, without the proposal
+        layer and the network heads.
+
+        molded_images, image_metas: Molded inputs, see mold_inputs().
+        keys: Optional feature cache key of each image, see FeatureCache.
+            If given and the cache is enabled, the outputs of the cached
+            images are reused and those of the other images are cached.
+
+        Returns an ordered dict of the outputs, P2 to P6 feature maps,
+        rpn_class and rpn_bbox, each with the batch dimension first.
+        """
+        names = list(self._feature_tensors.keys())
+        if self._feature_function is None:
+            self._feature_function = self.build_function(
+                self.keras_model.inputs[:2], list(self._feature_tensors.values()))
+        if keys is None or self.feature_cache is None:
+            outputs = self._feature_function([molded_images, image_metas])
+            return OrderedDict(zip(names, outputs))
+
+        entries = [self.feature_cache.get(key) for key in keys]
+        missing = [i for i, entry in enumerate(entries) if entry is None]
+        if missing:
+            outputs = self._feature_function(
+                [np.asarray(molded_images)[missing], np.asarray(image_metas)[missing]])
+            for j, i in enumerate(missing):
+                # Copy the outputs of batches, so that a cached image doesn't
+                # keep the outputs of the whole batch in memory.
+                entries[i] = OrderedDict(
+                    (name, output[j].copy() if len(missing) > 1 else output[j])
+                    for name, output in zip(names, outputs))
+                self.feature_cache.put(keys[i], entries[i])
+        if len(entries) == 1:
+            return OrderedDict((name, entries[0][name][np.newaxis]) for name in names)
+        return OrderedDict((name, np.stack([entry[name] for entry in entries]))
+                           for name in names)
+
+    def compute_features(self, images):
+        """Runs the backbone and the FPN, without the heads. With the feature
+        cache enabled, the features of images seen before are reused.
+
+        images: List of images that are molded to the same shape.
+
+        Returns a dict to pass to detect_with_rois(), to query several sets
+        of boxes on the same images with a single run of the backbone:
+        feature_maps: [P2, P3, P4, P5] feature maps, [N, height, width, depth]
+        image_metas: [N, length of meta data]
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        assert len(set(compute_molded_shape(self.config, image.shape)
+                       for image in images)) == 1,\
+            "Images must be molded to the same shape"
+
+        molded_images, image_metas, _ = self.mold_inputs(images)
+        keys = [FeatureCache.key(image) for image in images]\
+            if self.feature_cache is not None else None
+        features = self.run_features(molded_images, image_metas, keys)
+        return {
+            "feature_maps": [features[name] for name in ["P2", "P3", "P4", "P5"]],
+            "image_metas": image_metas,
+        }
+
+    def detect_with_rois(self, images, rois, class_ids=None, refine=False,
+                         features=None, verbose=0):
+        """Runs the classifier and mask heads on the given boxes instead of
+        the RPN proposals. Used to segment objects whose boxes are known,
+        e.g. from tracking, without running the RPN and the proposal layer.
+
+        images: List of images that are molded to the same shape.
+        rois: List of [N, (y1, x1, y2, x2)] boxes in pixels, one per image.
+            N can differ between images.
+        class_ids: Optional list of [N] class IDs, one per image. The scores,
+            box refinements and masks are those of these classes. By default,
+            those of the highest scoring class of each box, which can be the
+            background (0).
+        refine: If True, the masks are computed on the boxes refined by the
+            bounding box head. Runs the heads twice.
+        features: The output of compute_features() for the images. If given,
+            the backbone isn't run again.
+
+        Returns a list of dicts, one dict per image, with the results of the
+        boxes in the order they were given:
+        rois: [N, (y1, x1, y2, x2)] boxes the masks are computed on
+        refined_rois: [N, (y1, x1, y2, x2)] boxes refined by the bbox head
+        class_ids: [N] int class IDs
+        scores: [N] float probability scores for the class IDs
+        probs: [N, NUM_CLASSES] float probability scores of all classes
+        masks: [H, W, N] instance binary masks
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        assert len(images) == len(rois), "Give a list of boxes per image"
+
+        if features is None:
+            features = self.compute_features(images)
+        if self._roi_heads_function is None:
+            self._roi_heads_function = self.build_function(
+                self._roi_heads["feature_maps"] +
+                [self.keras_model.inputs[1], self._roi_heads["input_rois"]],
+                self._roi_heads["outputs"])
+        image_metas = features["image_metas"]
+        m = parse_image_meta(image_metas)
+
+        # Boxes in normalized coordinates of the molded images, zero padded
+        # to the same number of boxes for all images.
+        counts = [len(boxes) for boxes in rois]
+        molded_rois = np.zeros([len(rois), max(counts + [1]), 4], dtype=np.float32)
+        for i, boxes in enumerate(rois):
+            if counts[i]:
+                molded_rois[i, :counts[i]] = mold_boxes(
+                    np.asarray(boxes), m["original_image_shape"][i],
+                    m["image_shape"][i], m["window"][i])
+        if verbose:
+            log("molded_rois", molded_rois)
+
+        def run_heads(molded_rois):
+            return self._roi_heads_function(
+                features["feature_maps"] + [image_metas, molded_rois])
+
+        probs, deltas, masks = run_heads(molded_rois)
+
+        # Class of each box and its refined box, clipped to the window
+        selected = []
+        refined_rois = np.zeros_like(molded_rois)
+        for i, n in enumerate(counts):
+            ix = np.arange(n)
+            ids = np.argmax(probs[i, :n], axis=1) if class_ids is None \
+                else np.asarray(class_ids[i], dtype=np.int32)
+            selected.append(ids)
+            refined = utils.apply_box_deltas(
+                molded_rois[i, :n], deltas[i, ix, ids] * self.config.BBOX_STD_DEV)
+            window = utils.norm_boxes(m["window"][i], m["image_shape"][i][:2])
+            refined_rois[i, :n] = np.clip(refined, np.tile(window[:2], 2),
+                                          np.tile(window[2:], 2))
+        if refine:
+            _, _, masks = run_heads(refined_rois)
+
+        results = []
+        for i, n in enumerate(counts):
+            ix = np.arange(n)
+            ids = selected[i]
+            original_image_shape = m["original_image_shape"][i]
+            unmold = lambda boxes: unmold_boxes(
+                boxes, original_image_shape, m["image_shape"][i], m["window"][i])
+            final_refined_rois = unmold(refined_rois[i, :n])
+            final_rois = final_refined_rois if refine else unmold(molded_rois[i, :n])
+            # Resize masks to original image size. Empty boxes get empty masks.
+            full_masks = np.zeros(tuple(original_image_shape[:2]) + (n,), dtype=bool)
+            for j in ix:
+                y1, x1, y2, x2 = final_rois[j]
+                if y2 > y1 and x2 > x1:
+                    full_masks[:, :, j] = utils.unmold_mask(
+                        masks[i, j, :, :, ids[j]], final_rois[j], original_image_shape)
+            results.append({
+                "rois": final_rois,
+                "refined_rois": final_refined_rois,
+                "class_ids": ids,
+                "scores": probs[i, ix, ids],
+                "probs": probs[i, :n],
+                "masks": full_masks,
+            })
+        return results
+
     def get_anchors(self, image_shape):
-        """Returns anchor pyramid for the given image size."""
-        backbone_shapes = compute_backbone_shapes(self.config, image_shape)
-        # Cache anchors and reuse if image shape is the same
-        if not hasattr(self, "_anchor_cache"):
-            self._anchor_cache = {}
-        if not tuple(image_shape) in self._anchor_cache:
-            # Generate Anchors
-            a = utils.generate_pyramid_anchors(
-                self.config.RPN_ANCHOR_SCALES,
-                self.config.RPN_ANCHOR_RATIOS,
-                backbone_shapes,
-                self.config.BACKBONE_STRIDES,
-                self.config.RPN_ANCHOR_STRIDE)
-            # Keep a copy of the latest anchors in pixel coordinates because
-            # it's used in inspect_model notebooks.
-            # TODO: Remove this after the notebook are refactored to not use it
-            self.anchors = a
-            # Normalize coordinates
-            self._anchor_cache[tuple(image_shape)] = utils.norm_boxes(a, image_shape[:2])
-        return self._anchor_cache[tuple(image_shape)]
+        """Returns anchor pyramid for the given image size in normalized
+        coordinates. Anchors are cached and shared with other models in the
+        process. See get_anchor_pyramid().
+        """
+        anchors = get_anchor_pyramid(self.config, image_shape)
+        # Keep a copy of the latest anchors in pixel coordinates because
+        # it's used in inspect_model notebooks.
+        # TODO: Remove this after the notebook are refactored to not use it
+        self.anchors = anchors.boxes
+        return anchors.norm_boxes
 
     def ancestor(self, tensor, name, checked=None):
         """Finds the ancestor of a TF tensor in the computation graph.
@@ -2700,6 +3515,12 @@ class MaskRCNN():
         outputs: List of tuples (name, tensor) to compute. The tensors are
             symbolic TensorFlow tensors and the names are for easy tracking.
 
+        If the feature cache is enabled (see FEATURE_CACHE_BYTES), outputs
+        computed from the feature maps and the RPN outputs reuse those of
+        the previous calls on the same images. The cache is keyed by the
+        original images, the same as in compute_features(), so images that
+        are already molded bypass it.
+
         Returns an ordered dict of results. Keys are the names received in the
         input and values are Numpy arrays.
         """
@@ -2710,28 +3531,29 @@ class MaskRCNN():
         for o in outputs.values():
             assert o is not None
 
-        # Build a Keras function to run parts of the computation graph
-        inputs = model.inputs
-        if model.uses_learning_phase and not isinstance(K.learning_phase(), int):
-            inputs += [K.learning_phase()]
-        kf = K.function(model.inputs, list(outputs.values()))
-
         # Prepare inputs
+        use_cache = self.feature_cache is not None and image_metas is None
         if image_metas is None:
             molded_images, image_metas, _ = self.mold_inputs(images)
         else:
             molded_images = images
-        image_shape = molded_images[0].shape
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
-        model_in = [molded_images, image_metas, anchors]
+        # Anchors are generated in the graph
+        inputs = model.inputs[:2]
+        model_in = [molded_images, image_metas]
+
+        # With the feature cache, feed the backbone and RPN outputs of the
+        # images so that they're only computed the first time. Skipped if
+        # the outputs come before them, e.g. backbone layers.
+        if use_cache and depends_on(outputs.values(), self._feature_tensors.values()):
+            keys = [FeatureCache.key(image) for image in images]
+            features = self.run_features(molded_images, image_metas, keys)
+            inputs += list(self._feature_tensors.values())
+            model_in += list(features.values())
+
+        # Build a Keras function to run parts of the computation graph
+        kf = self.build_function(inputs, list(outputs.values()))
 
         # Run inference
-        if model.uses_learning_phase and not isinstance(K.learning_phase(), int):
-            model_in.append(0.)
         outputs_np = kf(model_in)
 
         # Pack the generated Numpy arrays into a a dict and log the results.
@@ -2819,6 +3641,56 @@ def parse_image_meta_graph(meta):
     }
 
 
+def mold_boxes(boxes, original_image_shape, image_shape, window):
+    """Converts boxes in pixel coordinates of the original image to
+    normalized coordinates in the resized and padded image. The inverse
+    of unmold_boxes().
+
+    boxes: [N, (y1, x1, y2, x2)] in pixels of the original image
+    original_image_shape: [H, W, C] Original image shape before resizing
+    image_shape: [H, W, C] Shape of the image after resizing and padding
+    window: [y1, x1, y2, x2] Pixel coordinates of box in the image where the real
+            image is excluding the padding.
+
+    Returns: [N, (y1, x1, y2, x2)] in normalized coordinates
+    """
+    # Normalized coordinates on the window
+    boxes = utils.norm_boxes(boxes, original_image_shape[:2])
+    wy1, wx1, wy2, wx2 = utils.norm_boxes(window, image_shape[:2])
+    shift = np.array([wy1, wx1, wy1, wx1])
+    scale = np.array([wy2 - wy1, wx2 - wx1, wy2 - wy1, wx2 - wx1])
+    # Normalized coordinates on the image
+    return (boxes * scale + shift).astype(np.float32)
+
+
+def unmold_boxes(boxes, original_image_shape, image_shape, window):
+    """Converts boxes in normalized coordinates of the resized and padded
+    image to pixel coordinates in the original image.
+
+    boxes: [N, (y1, x1, y2, x2)] in normalized coordinates
+    original_image_shape: [H, W, C] Original image shape before resizing
+    image_shape: [H, W, C] Shape of the image after resizing and padding
+    window: [y1, x1, y2, x2] Pixel coordinates of box in the image where the real
+            image is excluding the padding.
+
+    Returns: [N, (y1, x1, y2, x2)] in pixels of the original image
+    """
+    if tuple(window) == (0, 0) + tuple(original_image_shape[:2]):
+        # Padded at the bottom and right only, without scaling (e.g. the
+        # "native" resize mode). Pixel coordinates are the same.
+        return utils.denorm_boxes(boxes, image_shape[:2])
+    window = utils.norm_boxes(window, image_shape[:2])
+    wy1, wx1, wy2, wx2 = window
+    shift = np.array([wy1, wx1, wy1, wx1])
+    wh = wy2 - wy1  # window height
+    ww = wx2 - wx1  # window width
+    scale = np.array([wh, ww, wh, ww])
+    # Convert boxes to normalized coordinates on the window
+    boxes = np.divide(boxes - shift, scale)
+    # Convert boxes to pixel coordinates on the original image
+    return utils.denorm_boxes(boxes, original_image_shape[:2])
+
+
 def mold_image(images, config):
     """Expects an RGB image (or array of images) and subtracts
     the mean pixel and converts it to float. Expects image
@@ -2848,6 +3720,67 @@ def trim_zeros_graph(boxes, name='trim_zeros'):
     return boxes, non_zeros
 
 
+def generate_pyramid_anchors_graph(feature_maps, image_shape, config):
+    """Graph version of utils.generate_pyramid_anchors(). Generates the
+    anchors from the runtime shapes of the feature maps, so they always
+    match the size of the input images.
+
+    feature_maps: List of RPN feature maps [P2, P3, P4, P5, P6]. Each is
+        [batch, height, width, channels]. Only their shapes are used.
+    image_shape: [2] (height, width) of the input images in pixels.
+
+    Returns: [anchor_count, (y1, x1, y2, x2)] in normalized coordinates.
+    """
+    anchors = []
+    for scale, feature_map, feature_stride in zip(
+            config.RPN_ANCHOR_SCALES, feature_maps, config.BACKBONE_STRIDES):
+        # Heights and widths of the anchors of each ratio
+        ratios = np.array(config.RPN_ANCHOR_RATIOS, dtype=np.float32)
+        heights = scale / np.sqrt(ratios)
+        widths = scale * np.sqrt(ratios)
+
+        # Enumerate shifts in feature space
+        shape = tf.shape(feature_map)[1:3]
+        stride = config.RPN_ANCHOR_STRIDE
+        shifts_y = tf.to_float(tf.range(0, shape[0], stride) * feature_stride)
+        shifts_x = tf.to_float(tf.range(0, shape[1], stride) * feature_stride)
+        shifts_x, shifts_y = tf.meshgrid(shifts_x, shifts_y)
+
+        # Enumerate combinations of shifts, widths, and heights
+        # [shifts, ratios]
+        box_centers_y = tf.reshape(shifts_y, [-1, 1]) + tf.zeros_like(heights)
+        box_centers_x = tf.reshape(shifts_x, [-1, 1]) + tf.zeros_like(widths)
+        box_heights = tf.zeros_like(box_centers_y) + heights
+        box_widths = tf.zeros_like(box_centers_x) + widths
+
+        # Reshape to get a list of (y, x) and a list of (h, w)
+        box_centers = tf.reshape(
+            tf.stack([box_centers_y, box_centers_x], axis=2), [-1, 2])
+        box_sizes = tf.reshape(
+            tf.stack([box_heights, box_widths], axis=2), [-1, 2])
+
+        # Convert to corner coordinates (y1, x1, y2, x2)
+        anchors.append(tf.concat([box_centers - 0.5 * box_sizes,
+                                  box_centers + 0.5 * box_sizes], axis=1))
+    anchors = tf.concat(anchors, axis=0)
+    return norm_boxes_graph(anchors, image_shape)
+
+
+def batch_gather_graph(params, indices, name=None):
+    """Gathers rows of each item in a batch with its own indices. Same as
+    calling tf.gather() on each item, but as a single op.
+
+    params: [batch, N, ...]
+    indices: [batch, K] int32 indices into the second dimension of params.
+
+    Returns: [batch, K, ...]
+    """
+    batch_ix = tf.tile(tf.expand_dims(tf.range(tf.shape(indices)[0]), 1),
+                       [1, tf.shape(indices)[1]])
+    return tf.gather_nd(params, tf.stack([batch_ix, indices], axis=2),
+                        name=name)
+
+
 def batch_pack_graph(x, counts, num_rows):
     """Picks different number of values from each row
     in x depending on the values in counts.
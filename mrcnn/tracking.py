@@ -0,0 +1,269 @@
+"""
+Mask R-CNN
+Tracking-assisted inference on video frames.
+
+Licensed under the MIT License (see LICENSE for details)
+
+------------------------------------------------------------
+
+Runs the full model on keyframes only: every keyframe_interval frames, or
+sooner when the scene changes. The detections of the other frames are
+propagated from the previous frame, shifted by the median optical flow
+of each object if OpenCV is available. Detections are associated across
+keyframes by IoU, so every object keeps a stable track ID.
+
+Usage:
+
+    detector = TrackingDetector(model, keyframe_interval=5)
+    for frame in frames:
+        r = detector.detect([frame])[0]
+        r["track_ids"]  # Stable ID of each detection
+"""
+
+import numpy as np
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+from mrcnn import utils
+
+
+############################################################
+#  Tracker
+############################################################
+
+class Tracker(object):
+    """Associates detections with tracks by IoU, keeping an ID per track.
+
+    iou_threshold: Minimum IoU of a detection with a track of the same
+        class to continue it.
+    max_age: Number of updates a track survives without a detection, so
+        that an object missed in one keyframe keeps its ID.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_age=2):
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.reset()
+
+    def reset(self):
+        self.next_id = 1
+        self.track_ids = np.zeros([0], dtype=np.int32)
+        self.boxes = np.zeros([0, 4], dtype=np.int32)
+        self.class_ids = np.zeros([0], dtype=np.int32)
+        self.ages = np.zeros([0], dtype=np.int32)
+
+    def update(self, boxes, class_ids):
+        """Associates detections with the tracks, greedily by decreasing
+        IoU, and starts new tracks for the detections left over.
+
+        boxes: [N, (y1, x1, y2, x2)] detection boxes.
+        class_ids: [N] class IDs.
+
+        Returns: [N] track ID of each detection.
+        """
+        track_ids = np.zeros([len(boxes)], dtype=np.int32)
+        matched = np.zeros([len(self.track_ids)], dtype=bool)
+        if len(boxes) and len(self.track_ids):
+            overlaps = utils.compute_overlaps(boxes.astype(np.float32),
+                                              self.boxes.astype(np.float32))
+            # Only continue tracks of the same class
+            overlaps[class_ids[:, None] != self.class_ids[None, :]] = 0
+            order = np.argsort(overlaps, axis=None)[::-1]
+            for d, t in zip(*np.unravel_index(order, overlaps.shape)):
+                if overlaps[d, t] < self.iou_threshold:
+                    break
+                if track_ids[d] or matched[t]:
+                    continue
+                track_ids[d] = self.track_ids[t]
+                matched[t] = True
+
+        # New tracks
+        new = track_ids == 0
+        track_ids[new] = np.arange(self.next_id, self.next_id + new.sum())
+        self.next_id += int(new.sum())
+
+        # Keep the unmatched tracks until they're too old
+        ages = self.ages + 1
+        keep = ~matched & (ages <= self.max_age)
+        self.track_ids = np.concatenate([track_ids, self.track_ids[keep]])
+        self.boxes = np.concatenate([boxes, self.boxes[keep]]).astype(np.int32)
+        self.class_ids = np.concatenate([class_ids, self.class_ids[keep]]).astype(np.int32)
+        self.ages = np.concatenate([np.zeros([len(boxes)], dtype=np.int32), ages[keep]])
+        return track_ids
+
+    def move(self, track_ids, boxes):
+        """Updates the boxes of the given tracks, e.g. after propagating
+        them to a new frame.
+        """
+        order = np.argsort(self.track_ids)
+        ix = order[np.searchsorted(self.track_ids, track_ids, sorter=order)]
+        self.boxes[ix] = boxes
+
+
+############################################################
+#  Propagation
+############################################################
+
+def shift_masks(masks, shifts):
+    """Translates instance masks, filling the uncovered pixels with zeros.
+
+    masks: [height, width, N]
+    shifts: [N, (dy, dx)] integer shifts in pixels.
+    """
+    height, width = masks.shape[:2]
+    shifted = np.zeros_like(masks)
+    for i, (dy, dx) in enumerate(shifts):
+        if abs(dy) >= height or abs(dx) >= width:
+            continue
+        shifted[max(dy, 0):height + min(dy, 0), max(dx, 0):width + min(dx, 0), i] = \
+            masks[max(-dy, 0):height + min(-dy, 0), max(-dx, 0):width + min(-dx, 0), i]
+    return shifted
+
+
+def estimate_shifts(previous_gray, gray, rois, masks, points_per_side=5):
+    """Estimates the motion of each instance between two frames as the
+    median Lucas-Kanade optical flow of a grid of points on its mask.
+    The points of all instances are tracked in one call. Requires OpenCV.
+
+    previous_gray, gray: [height, width] uint8 frames.
+    rois: [N, (y1, x1, y2, x2)] boxes in the previous frame.
+    masks: [height, width, N] masks in the previous frame.
+
+    Returns: [N, (dy, dx)] integer shifts. Zero for the instances that
+        couldn't be tracked.
+    """
+    shifts = np.zeros([len(rois), 2], dtype=np.int32)
+    points, instances = [], []
+    for i, (y1, x1, y2, x2) in enumerate(rois):
+        ys = np.linspace(y1, y2 - 1, points_per_side).astype(np.int32)
+        xs = np.linspace(x1, x2 - 1, points_per_side).astype(np.int32)
+        ys, xs = np.meshgrid(ys, xs, indexing="ij")
+        on_mask = masks[ys, xs, i]
+        points.append(np.stack([xs[on_mask], ys[on_mask]], axis=1))
+        instances.append(np.full([on_mask.sum()], i))
+    points = np.concatenate(points).astype(np.float32)
+    instances = np.concatenate(instances)
+    if not len(points):
+        return shifts
+
+    new_points, status, _ = cv2.calcOpticalFlowPyrLK(
+        previous_gray, gray, points.reshape([-1, 1, 2]), None)
+    tracked = status.ravel() == 1
+    flow = new_points.reshape([-1, 2]) - points
+    for i in np.unique(instances[tracked]):
+        dx, dy = np.median(flow[tracked & (instances == i)], axis=0)
+        shifts[i] = np.round([dy, dx])
+    return shifts
+
+
+############################################################
+#  Tracking Detector
+############################################################
+
+class TrackingDetector(object):
+    """Wraps a MaskRCNN model in inference mode to run the full detection
+    on keyframes only, and to propagate the detections to the frames in
+    between. Has the same detect() interface as the model, so it can be
+    used in its place on video streams.
+
+    model: MaskRCNN model in inference mode.
+    keyframe_interval: Run the full detection every this many frames.
+        1 runs it on every frame, which only adds the track IDs.
+    scene_change_threshold: Mean absolute difference, in intensity levels,
+        between a frame and the last keyframe that triggers a keyframe
+        earlier. None disables the trigger.
+    use_flow: Shift the propagated detections by their optical flow. Needs
+        OpenCV. Otherwise they're kept in place.
+    iou_threshold, max_age: See Tracker.
+    """
+
+    def __init__(self, model, keyframe_interval=5, scene_change_threshold=12,
+                 use_flow=True, iou_threshold=0.3, max_age=2):
+        self.model = model
+        self.config = model.config
+        self.keyframe_interval = keyframe_interval
+        self.scene_change_threshold = scene_change_threshold
+        self.use_flow = use_flow and cv2 is not None
+        self.tracker = Tracker(iou_threshold, max_age)
+        self.reset()
+
+    def reset(self):
+        """Forgets the previous frames, e.g. when the video changes."""
+        self.tracker.reset()
+        self._frames_since_keyframe = 0
+        self._keyframe_thumbnail = None
+        self._previous = None
+
+    def _thumbnail(self, image):
+        """Small grayscale version of the image to compare scenes."""
+        return image[::8, ::8].mean(axis=2, dtype=np.float32)
+
+    def _is_keyframe(self, image):
+        """Decides whether to run the full detection on the next frame."""
+        thumbnail = self._thumbnail(image)
+        keyframe = self._keyframe_thumbnail is None or \
+            self._keyframe_thumbnail.shape != thumbnail.shape or \
+            self._frames_since_keyframe + 1 >= self.keyframe_interval
+        if not keyframe and self.scene_change_threshold is not None:
+            change = np.abs(thumbnail - self._keyframe_thumbnail).mean()
+            keyframe = change > self.scene_change_threshold
+        if keyframe:
+            self._keyframe_thumbnail = thumbnail
+            self._frames_since_keyframe = 0
+        else:
+            self._frames_since_keyframe += 1
+        return keyframe
+
+    def _propagate(self, gray, image_shape):
+        """Moves the detections of the previous frame to the current one."""
+        previous_gray, previous = self._previous
+        rois = previous["rois"]
+        masks = previous["masks"]
+        if self.use_flow and len(rois) and previous_gray.shape == gray.shape:
+            shifts = estimate_shifts(previous_gray, gray, rois, masks)
+            height, width = image_shape[:2]
+            rois = rois + np.tile(shifts, 2)
+            rois = np.clip(rois, 0, [height, width, height, width]).astype(np.int32)
+            masks = shift_masks(masks, shifts)
+            self.tracker.move(previous["track_ids"], rois)
+        return {
+            "rois": rois,
+            "class_ids": previous["class_ids"],
+            "scores": previous["scores"],
+            "masks": masks,
+            "track_ids": previous["track_ids"],
+            "keyframe": False,
+        }
+
+    def detect(self, images, verbose=0):
+        """Same as MaskRCNN.detect() for consecutive frames of a video.
+
+        The keyframes among the images are detected in one batch. The dicts
+        of the results also contain:
+        track_ids: [N] stable ID of each detection across frames
+        keyframe: True if the full detection ran on the frame
+        """
+        keyframes = [i for i, image in enumerate(images) if self._is_keyframe(image)]
+        detections = {}
+        if keyframes:
+            batch = [images[i] for i in keyframes]
+            # With multiple GPUs, pad the batch to a multiple of GPU_COUNT
+            padding = -len(batch) % self.config.GPU_COUNT
+            results = self.model.detect(batch + batch[-1:] * padding, verbose=verbose)
+            detections = dict(zip(keyframes, results))
+
+        results = []
+        for i, image in enumerate(images):
+            gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY) if self.use_flow else None
+            if i in detections:
+                r = detections[i]
+                r["track_ids"] = self.tracker.update(r["rois"], r["class_ids"])
+                r["keyframe"] = True
+            else:
+                r = self._propagate(gray, image.shape)
+            self._previous = (gray, r)
+            results.append(r)
+        return results
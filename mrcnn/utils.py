@@ -20,6 +20,9 @@ import skimage.transform
 import urllib.request
 import shutil
 import warnings
+import hashlib
+import tempfile
+from collections import OrderedDict
 from distutils.version import LooseVersion
 
 # URL from which to download the latest COCO trained weights
@@ -77,14 +80,19 @@ def compute_iou(box, boxes, box_area, boxes_area):
     return iou
 
 
-def compute_overlaps(boxes1, boxes2):
+def compute_overlaps(boxes1, boxes2, boxes1_area=None):
     """Computes IoU overlaps between two sets of boxes.
     boxes1, boxes2: [N, (y1, x1, y2, x2)].
+    boxes1_area: Optional. [N] precomputed areas of boxes1, such as
+        PyramidAnchors.areas.
 
     For better performance, pass the largest set first and the smaller second.
     """
     # Areas of anchors and GT boxes
-    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    if boxes1_area is not None:
+        area1 = boxes1_area
+    else:
+        area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
     area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
 
     # Compute overlaps to generate matrix [boxes1 count, boxes2 count]
@@ -384,6 +392,48 @@ class Dataset(object):
         return mask, class_ids
 
 
+def compute_resize_scale(height, width, min_dim=None, max_dim=None,
+                         min_scale=None, mode="square"):
+    """Returns the scale factor that resize_image() applies to an image of
+    the given size. See resize_image() for the arguments.
+    """
+    scale = 1
+    if mode in ["none", "native"]:
+        return scale
+    if min_dim:
+        # Scale up but not down
+        scale = max(1, min_dim / min(height, width))
+    if min_scale and scale < min_scale:
+        scale = min_scale
+
+    # Does it exceed max dim?
+    if max_dim and mode == "square":
+        image_max = max(height, width)
+        if round(image_max * scale) > max_dim:
+            scale = max_dim / image_max
+    return scale
+
+
+def compute_resized_shape(height, width, min_dim=None, max_dim=None,
+                          min_scale=None, mode="square"):
+    """Returns the (height, width) of the image that resize_image() returns
+    for an image of the given size, without resizing anything. Useful to
+    group images by their padded shape. See resize_image() for the arguments.
+    """
+    if mode == "none":
+        return height, width
+    if mode == "square":
+        return max_dim, max_dim
+    if mode == "crop":
+        return min_dim, min_dim
+    if mode in ["pad64", "native"]:
+        scale = compute_resize_scale(height, width, min_dim, max_dim,
+                                     min_scale, mode)
+        h, w = round(height * scale), round(width * scale)
+        return int(math.ceil(h / 64) * 64), int(math.ceil(w / 64) * 64)
+    raise Exception("Mode {} not supported".format(mode))
+
+
 def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square"):
     """Resizes an image keeping the aspect ratio unchanged.
 
@@ -402,6 +452,9 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
                before padding. max_dim is ignored in this mode.
                The multiple of 64 is needed to ensure smooth scaling of feature
                maps up and down the 6 levels of the FPN pyramid (2**6=64).
+        native: Pads the bottom and right sides with zeros to make them
+                multiples of 64, without scaling. The image keeps its pixel
+                coordinates. min_dim, max_dim and min_scale are ignored.
         crop: Picks random crops from the image. First, scales the image based
               on min_dim and min_scale, then picks a random crop of
               size min_dim x min_dim. Can be used in training only.
@@ -429,17 +482,7 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
         return image, window, scale, padding, crop
 
     # Scale?
-    if min_dim:
-        # Scale up but not down
-        scale = max(1, min_dim / min(h, w))
-    if min_scale and scale < min_scale:
-        scale = min_scale
-
-    # Does it exceed max dim?
-    if max_dim and mode == "square":
-        image_max = max(h, w)
-        if round(image_max * scale) > max_dim:
-            scale = max_dim / image_max
+    scale = compute_resize_scale(h, w, min_dim, max_dim, min_scale, mode)
 
     # Resize image using bilinear interpolation
     if scale != 1:
@@ -478,6 +521,12 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
         padding = [(top_pad, bottom_pad), (left_pad, right_pad), (0, 0)]
         image = np.pad(image, padding, mode='constant', constant_values=0)
         window = (top_pad, left_pad, h + top_pad, w + left_pad)
+    elif mode == "native":
+        # Pad the bottom and right sides only, so the window starts at (0, 0)
+        h, w = image.shape[:2]
+        max_h, max_w = compute_resized_shape(h, w, mode=mode)
+        padding = [(0, max_h - h), (0, max_w - w), (0, 0)]
+        image = np.pad(image, padding, mode='constant', constant_values=0)
     elif mode == "crop":
         # Pick a random crop
         h, w = image.shape[:2]
@@ -575,6 +624,106 @@ def unmold_mask(mask, bbox, image_shape):
     return full_mask
 
 
+def crop_and_resize(images, boxes, box_indices, crop_size, extrapolation_value=0):
+    """NumPy version of tf.image.crop_and_resize() with bilinear sampling.
+    Crops all the boxes in one vectorized gather, so it's much faster than
+    cropping and resizing each box separately.
+
+    images: [batch, height, width, channels]. Any dtype. Only the sampled
+        pixels are converted to float, so large boolean masks can be passed
+        in as they are (e.g. np.moveaxis(masks, 2, 0)[..., None]).
+    boxes: [num_boxes, (y1, x1, y2, x2)] in normalized coordinates. Same
+        convention as TF: (y2, x2) are inside the box and points outside
+        the image are set to extrapolation_value.
+    box_indices: [num_boxes] index of the image of each box.
+    crop_size: (crop_height, crop_width)
+
+    Returns: [num_boxes, crop_height, crop_width, channels] float32
+    """
+    height, width = images.shape[1:3]
+    boxes = np.asarray(boxes, dtype=np.float32)
+    box_indices = np.asarray(box_indices)
+
+    def sample_points(start, end, size, length):
+        """Returns the sampling coordinates along one axis. [num_boxes, size]"""
+        if size > 1:
+            steps = np.arange(size, dtype=np.float32) / (size - 1)
+            return (start[:, None] + steps * (end - start)[:, None]) * (length - 1)
+        return (0.5 * (start + end) * (length - 1))[:, None]
+
+    in_y = sample_points(boxes[:, 0], boxes[:, 2], crop_size[0], height)
+    in_x = sample_points(boxes[:, 1], boxes[:, 3], crop_size[1], width)
+    valid = ((in_y >= 0) & (in_y <= height - 1))[:, :, None] & \
+        ((in_x >= 0) & (in_x <= width - 1))[:, None, :]
+
+    # Neighbouring pixels and interpolation weights
+    top = np.clip(np.floor(in_y), 0, height - 1).astype(np.int64)
+    bottom = np.clip(np.ceil(in_y), 0, height - 1).astype(np.int64)
+    left = np.clip(np.floor(in_x), 0, width - 1).astype(np.int64)
+    right = np.clip(np.ceil(in_x), 0, width - 1).astype(np.int64)
+    y_lerp = (in_y - np.floor(in_y))[:, :, None, None]
+    x_lerp = (in_x - np.floor(in_x))[:, None, :, None]
+
+    # Gather the 4 neighbours of every point. [num_boxes, crop_h, crop_w, C]
+    b = box_indices[:, None, None]
+    t, bt = top[:, :, None], bottom[:, :, None]
+    l, r = left[:, None, :], right[:, None, :]
+    top_left = images[b, t, l].astype(np.float32)
+    top_right = images[b, t, r].astype(np.float32)
+    bottom_left = images[b, bt, l].astype(np.float32)
+    bottom_right = images[b, bt, r].astype(np.float32)
+
+    top = top_left + (top_right - top_left) * x_lerp
+    bottom = bottom_left + (bottom_right - bottom_left) * x_lerp
+    crops = top + (bottom - top) * y_lerp
+    crops[~valid] = extrapolation_value
+    return crops.astype(np.float32)
+
+
+def mask_to_rle(mask):
+    """Encodes a binary mask with uncompressed COCO-style run-length
+    encoding (RLE).
+
+    mask: [height, width] of boolean type.
+
+    Returns a dict with:
+    size: [height, width]
+    counts: Lengths of the runs of the pixels in column-major order,
+        alternating background and foreground and starting with background.
+    """
+    pixels = np.asarray(mask, dtype=bool).ravel(order="F")
+    # Positions where the value changes, and both ends
+    changes = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+    counts = np.diff(np.concatenate([[0], changes, [pixels.size]]))
+    if pixels.size and pixels[0]:
+        counts = np.concatenate([[0], counts])
+    return {"size": [int(d) for d in mask.shape[:2]], "counts": counts.tolist()}
+
+
+def rle_to_indices(rle):
+    """Returns the column-major flat indices of the foreground pixels of an
+    RLE mask, without decoding the background. See mask_to_rle().
+    """
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    ends = np.cumsum(counts)
+    starts = (ends - counts)[1::2]
+    lengths = counts[1::2]
+    # Index of each foreground pixel within its run, plus the run start
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + offsets
+
+
+def rle_to_mask(rle):
+    """Decodes an RLE mask. See mask_to_rle().
+
+    Returns: [height, width] of boolean type.
+    """
+    height, width = rle["size"]
+    mask = np.zeros(height * width, dtype=bool)
+    mask[rle_to_indices(rle)] = True
+    return mask.reshape((height, width), order="F")
+
+
 ############################################################
 #  Anchors
 ############################################################
@@ -638,6 +787,261 @@ def generate_pyramid_anchors(scales, ratios, feature_shapes, feature_strides,
     return np.concatenate(anchors, axis=0)
 
 
+class PyramidAnchors(object):
+    """Read-only anchor pyramid of one image shape, along with the values
+    derived from it that the target builders need. Use get_pyramid_anchors()
+    to get an instance rather than creating it directly.
+
+    boxes: [N, (y1, x1, y2, x2)] anchors in pixel coordinates
+    norm_boxes: [N, (y1, x1, y2, x2)] anchors in normalized coordinates
+    centers: [N, (y, x)] anchor centers in pixels
+    sizes: [N, (height, width)] anchor sizes in pixels
+    areas: [N] anchor areas in pixels
+    """
+    FIELDS = ["boxes", "norm_boxes", "centers", "sizes", "areas"]
+
+    def __init__(self, **arrays):
+        for name in self.FIELDS:
+            array = arrays[name]
+            array.setflags(write=False)
+            setattr(self, name, array)
+
+    def __len__(self):
+        return self.boxes.shape[0]
+
+    @classmethod
+    def generate(cls, scales, ratios, feature_shapes, feature_strides,
+                 anchor_stride, image_shape):
+        """Generates the anchors and derived values. See
+        generate_pyramid_anchors() for the arguments.
+        """
+        boxes = generate_pyramid_anchors(scales, ratios, feature_shapes,
+                                         feature_strides, anchor_stride)
+        sizes = boxes[:, 2:] - boxes[:, :2]
+        return cls(boxes=boxes,
+                   norm_boxes=norm_boxes(boxes, image_shape[:2]),
+                   centers=boxes[:, :2] + 0.5 * sizes,
+                   sizes=sizes,
+                   areas=sizes[:, 0] * sizes[:, 1])
+
+
+# Anchor pyramids shared by all the models and data generators of the
+# process. Keyed by anchor settings and image shape. See get_pyramid_anchors()
+_pyramid_anchors_store = {}
+
+
+def get_pyramid_anchors(scales, ratios, feature_shapes, feature_strides,
+                        anchor_stride, image_shape, cache_dir=None):
+    """Returns the PyramidAnchors of the given anchor settings and image
+    shape. Anchors are generated once per process and shared read-only.
+    Processes forked after the first call (e.g. data generator workers)
+    inherit them without a copy.
+
+    cache_dir: Optional. Directory to save the anchors to as .npy files. The
+        files are memory-mapped read-only, so all processes share one copy
+        through the OS page cache and later runs skip the generation.
+
+    See generate_pyramid_anchors() for the other arguments.
+    """
+    key = (tuple(scales), tuple(ratios),
+           tuple(tuple(int(d) for d in s) for s in feature_shapes),
+           tuple(feature_strides), anchor_stride,
+           tuple(int(d) for d in image_shape[:2]))
+    if key in _pyramid_anchors_store:
+        return _pyramid_anchors_store[key]
+
+    if cache_dir is None:
+        anchors = PyramidAnchors.generate(scales, ratios, feature_shapes,
+                                          feature_strides, anchor_stride,
+                                          image_shape)
+    else:
+        name = "anchors_" + hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+        paths = {f: os.path.join(cache_dir, "{}_{}.npy".format(name, f))
+                 for f in PyramidAnchors.FIELDS}
+        if not all(os.path.exists(p) for p in paths.values()):
+            os.makedirs(cache_dir, exist_ok=True)
+            anchors = PyramidAnchors.generate(scales, ratios, feature_shapes,
+                                              feature_strides, anchor_stride,
+                                              image_shape)
+            # Write to a temporary file and rename it so concurrent readers
+            # never see a partially written file.
+            for field, path in paths.items():
+                fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".npy")
+                with os.fdopen(fd, "wb") as f:
+                    np.save(f, getattr(anchors, field))
+                os.replace(tmp_path, path)
+        anchors = PyramidAnchors(**{f: np.load(p, mmap_mode="r")
+                                    for f, p in paths.items()})
+
+    _pyramid_anchors_store[key] = anchors
+    return anchors
+
+
+############################################################
+#  Tiling
+############################################################
+
+def compute_tiles(height, width, tile_size, overlap):
+    """Computes square tiles that cover an image, for tiled inference.
+
+    height, width: Image size in pixels.
+    tile_size: Side of the tiles in pixels.
+    overlap: Minimum number of pixels shared by neighboring tiles.
+
+    The tiles are spread evenly, and the last tiles of each row and column
+    end at the image border, so all the tiles have the same size unless the
+    image is smaller than a tile.
+
+    Returns: [N, (y1, x1, y2, x2)] tile windows in pixels.
+    """
+    assert 0 <= overlap < tile_size, "The overlap must be smaller than the tiles"
+
+    def starts(length):
+        if length <= tile_size:
+            return np.array([0])
+        count = int(np.ceil((length - tile_size) / (tile_size - overlap))) + 1
+        return np.round(np.linspace(0, length - tile_size, count)).astype(np.int32)
+
+    y1, x1 = np.meshgrid(starts(height), starts(width), indexing="ij")
+    y1, x1 = y1.ravel(), x1.ravel()
+    return np.stack([y1, x1, np.minimum(y1 + tile_size, height),
+                     np.minimum(x1 + tile_size, width)], axis=1)
+
+
+def merge_tiled_detections(boxes, class_ids, scores, masks, tile_ids, tiles,
+                           image_shape, threshold=0.5, margin=2):
+    """Merges the detections of overlapping tiles into detections on the
+    whole image.
+
+    Two detections of the same class from different tiles are the same
+    object if the IoU of their masks, in the area seen by both tiles, is
+    above threshold. Of each object, the highest scoring detection that
+    isn't cut by the border of its tile is kept. If all of them are cut,
+    which happens to objects larger than the tile overlap, their masks are
+    stitched together.
+
+    boxes: [N, (y1, x1, y2, x2)] detection boxes in image pixels.
+    class_ids: [N] class IDs.
+    scores: [N] detection scores.
+    masks: List of N boolean masks, each the size of its box.
+    tile_ids: [N] index of the tile of each detection.
+    tiles: [T, (y1, x1, y2, x2)] tile windows, see compute_tiles().
+    image_shape: [height, width, ...] of the image.
+    threshold: Mask IoU above which two detections are merged.
+    margin: Distance in pixels to the border of a tile within which a
+        detection counts as cut by it.
+
+    Returns boxes, class_ids, scores and [height, width, M] full size masks
+    of the merged detections, sorted by score.
+    """
+    height, width = image_shape[:2]
+    N = len(boxes)
+
+    # Detections cut by a tile border that isn't an image border
+    t = tiles[tile_ids]
+    truncated = ((boxes[:, 0] <= t[:, 0] + margin) & (t[:, 0] > 0)) | \
+                ((boxes[:, 1] <= t[:, 1] + margin) & (t[:, 1] > 0)) | \
+                ((boxes[:, 2] >= t[:, 2] - margin) & (t[:, 2] < height)) | \
+                ((boxes[:, 3] >= t[:, 3] - margin) & (t[:, 3] < width))
+
+    def crop(k, region):
+        """Mask of detection k in region, zero outside of its box."""
+        ry1, rx1, ry2, rx2 = region
+        y1, x1, y2, x2 = boxes[k]
+        out = np.zeros([ry2 - ry1, rx2 - rx1], dtype=bool)
+        iy1, ix1, iy2, ix2 = max(y1, ry1), max(x1, rx1), min(y2, ry2), min(x2, rx2)
+        if iy2 > iy1 and ix2 > ix1:
+            out[iy1 - ry1:iy2 - ry1, ix1 - rx1:ix2 - rx1] = \
+                masks[k][iy1 - y1:iy2 - y1, ix1 - x1:ix2 - x1]
+        return out
+
+    # Group the detections of the same objects (union-find)
+    parent = np.arange(N)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    if N:
+        overlaps = compute_overlaps(boxes.astype(np.float32), boxes.astype(np.float32))
+        candidates = (overlaps > 0) & (class_ids[:, None] == class_ids[None, :]) & \
+            (tile_ids[:, None] != tile_ids[None, :])
+        for i, j in zip(*np.where(np.triu(candidates, 1))):
+            # Compare the masks where both tiles see the image, around the boxes
+            region = np.concatenate([
+                np.maximum(np.maximum(tiles[tile_ids[i], :2], tiles[tile_ids[j], :2]),
+                           np.minimum(boxes[i, :2], boxes[j, :2])),
+                np.minimum(np.minimum(tiles[tile_ids[i], 2:], tiles[tile_ids[j], 2:]),
+                           np.maximum(boxes[i, 2:], boxes[j, 2:]))])
+            if np.any(region[2:] <= region[:2]):
+                continue
+            a, b = crop(i, region), crop(j, region)
+            union = np.count_nonzero(a | b)
+            if union and np.count_nonzero(a & b) / union > threshold:
+                parent[find(i)] = find(j)
+
+    groups = OrderedDict()
+    for k in np.argsort(scores)[::-1]:
+        groups.setdefault(find(k), []).append(k)
+
+    merged_boxes = np.zeros([len(groups), 4], dtype=np.int32)
+    merged_masks = np.zeros([height, width, len(groups)], dtype=bool)
+    merged_class_ids = np.zeros([len(groups)], dtype=np.int32)
+    merged_scores = np.zeros([len(groups)], dtype=np.float32)
+    for g, members in enumerate(groups.values()):
+        # Members are sorted by score
+        complete = [k for k in members if not truncated[k]]
+        if complete:
+            box = boxes[complete[0]]
+            mask = masks[complete[0]]
+        else:
+            # Stitch the pieces
+            box = np.concatenate([boxes[members, :2].min(axis=0),
+                                  boxes[members, 2:].max(axis=0)])
+            mask = np.zeros(box[2:] - box[:2], dtype=bool)
+            for k in members:
+                mask |= crop(k, box)
+        y1, x1, y2, x2 = box
+        merged_boxes[g] = box
+        merged_masks[y1:y2, x1:x2, g] = mask
+        merged_class_ids[g] = class_ids[members[0]]
+        merged_scores[g] = scores[members[0]]
+    return merged_boxes, merged_class_ids, merged_scores, merged_masks
+
+
+def cluster_detections(boxes, class_ids, scores, threshold):
+    """Groups the detections of the same objects, e.g. from augmented
+    versions of an image. The highest scoring detection that isn't in a
+    cluster yet starts a new one, with the other free detections of its
+    class that overlap it with an IoU above threshold.
+
+    boxes: [N, (y1, x1, y2, x2)]
+    class_ids: [N] class IDs.
+    scores: [N] detection scores.
+    threshold: IoU above which detections are in the same cluster.
+
+    Returns: List of arrays of detection indices, one per cluster, sorted
+        by score. Clusters are sorted by their highest score.
+    """
+    order = np.argsort(scores)[::-1]
+    overlaps = compute_overlaps(boxes.astype(np.float32), boxes.astype(np.float32))
+    same_class = class_ids[:, None] == class_ids[None, :]
+    assigned = np.zeros([len(boxes)], dtype=bool)
+    clusters = []
+    for i in order:
+        if assigned[i]:
+            continue
+        members = ~assigned[order] & same_class[i, order] & \
+            (overlaps[i, order] > threshold)
+        members[order == i] = True
+        members = order[members]
+        assigned[members] = True
+        clusters.append(members)
+    return clusters
+
+
 ############################################################
 #  Miscellaneous
 ############################################################
@@ -799,7 +1203,7 @@ def compute_recall(pred_boxes, gt_boxes, iou):
 # an easy way to support batches > 1 quickly with little code modification.
 # In the long run, it's more efficient to modify the code to support large
 # batches and getting rid of this function. Consider this a temporary solution
-def batch_slice(inputs, graph_fn, batch_size, names=None):
+def batch_slice(inputs, graph_fn, batch_size, names=None, dtype=None):
     """Splits inputs into slices and feeds each slice to a copy of the given
     computation graph and then combines the results. It allows you to run a
     graph on a batch of inputs even if the graph is written to support one
@@ -807,12 +1211,28 @@ def batch_slice(inputs, graph_fn, batch_size, names=None):
 
     inputs: list of tensors. All must have the same first dimension length
     graph_fn: A function that returns a TF tensor that's part of a graph.
-    batch_size: number of slices to divide the data into.
+    batch_size: number of slices to divide the data into. If None, the batch
+        size is read from the inputs at runtime and graph_fn is run through
+        tf.map_fn() instead of being unrolled once per slice.
     names: If provided, assigns names to the resulting tensors.
+    dtype: Only used when batch_size is None. The dtype (or list of dtypes)
+        of the outputs of graph_fn, if they differ from the inputs. See
+        tf.map_fn().
     """
     if not isinstance(inputs, list):
         inputs = [inputs]
 
+    if batch_size is None:
+        outputs = tf.map_fn(lambda x: graph_fn(*x), inputs, dtype=dtype)
+        if not isinstance(outputs, (tuple, list)):
+            outputs = [outputs]
+        if names is None:
+            names = [None] * len(outputs)
+        result = [tf.identity(o, name=n) for o, n in zip(outputs, names)]
+        if len(result) == 1:
+            result = result[0]
+        return result
+
     outputs = []
     for i in range(batch_size):
         inputs_slice = [x[i] for x in inputs]
@@ -72,14 +72,76 @@ def random_colors(N, bright=True):
 def apply_mask(image, mask, color, alpha=0.5):
     """Apply the given mask to the image.
     """
-    for c in range(3):
-        image[:, :, c] = np.where(mask == 1,
-                                  image[:, :, c] *
-                                  (1 - alpha) + alpha * color[c] * 255,
-                                  image[:, :, c])
+    mask = mask == 1
+    image[mask] = image[mask] * (1 - alpha) + alpha * np.array(color) * 255
     return image
 
 
+def masks_to_labels(masks, shape=None):
+    """Converts instance masks to a label image. Each pixel holds 1 + the
+    index of the instance that covers it, or 0 for the background. Where
+    instances overlap, the last one wins.
+
+    masks: [height, width, num_instances] boolean masks, or a list of RLE
+        masks (see utils.mask_to_rle()).
+    shape: (height, width) of the label image. Only needed for an empty
+        list of RLE masks.
+
+    Returns: [height, width] int32 label image.
+    """
+    if isinstance(masks, np.ndarray):
+        count = masks.shape[-1]
+        if not count:
+            return np.zeros(masks.shape[:2], dtype=np.int32)
+        # Index of the last instance of each pixel, counted from 1
+        last = count - np.argmax(masks[..., ::-1], axis=-1)
+        return np.where(masks.any(axis=-1), last, 0).astype(np.int32)
+    # RLE masks. Only the foreground pixels are written.
+    if not len(masks):
+        assert shape is not None, "Pass the shape of the labels for no masks"
+        return np.zeros(shape[:2], dtype=np.int32)
+    height, width = masks[0]["size"]
+    labels = np.zeros((height, width), dtype=np.int32, order="F")
+    flat = labels.ravel(order="F")
+    for i, rle in enumerate(masks):
+        flat[utils.rle_to_indices(rle)] = i + 1
+    return labels
+
+
+def apply_masks(image, masks, colors, alpha=0.5, out=None):
+    """Blends the masks of all instances into the image in one pass.
+
+    image: [height, width, 3] image.
+    masks: One of:
+        [height, width] label image. See masks_to_labels().
+        [height, width, num_instances] boolean masks.
+        List of RLE masks. See utils.mask_to_rle().
+    colors: [num_instances, (r, g, b)] colors in the 0 to 1 range.
+    alpha: Opacity of the masks.
+    out: Optional. Array of the shape of the image to render into, such
+        as a buffer reused across frames. Can be the image itself.
+
+    Returns out, or a copy of the image if out is not given.
+    """
+    if isinstance(masks, np.ndarray) and masks.ndim == 2:
+        labels = masks
+    else:
+        labels = masks_to_labels(masks, image.shape[:2])
+    if out is None:
+        out = image.copy()
+    elif out is not image:
+        np.copyto(out, image, casting="unsafe")
+    if not len(colors):
+        return out
+
+    # Premultiplied mask colors, indexed by label
+    palette = np.zeros((len(colors) + 1, 3))
+    palette[1:] = np.asarray(colors)[:, :3] * 255 * alpha
+    foreground = labels > 0
+    out[foreground] = image[foreground] * (1 - alpha) + palette[labels[foreground]]
+    return out
+
+
 def display_instances(image, boxes, masks, class_ids, class_names,
                       scores=None, title="",
                       figsize=(16, 16), ax=None,
@@ -121,6 +183,7 @@ def display_instances(image, boxes, masks, class_ids, class_names,
     ax.set_title(title)
 
     masked_image = image.astype(np.uint32).copy()
+    shown = []
     for i in range(N):
         color = colors[i]
 
@@ -145,13 +208,10 @@ def display_instances(image, boxes, masks, class_ids, class_names,
             caption = captions[i]
         ax.text(x1, y1 + 8, caption,
                 color='w', size=11, backgroundcolor="none")
-
-        # Mask
-        mask = masks[:, :, i]
-        if show_mask:
-            masked_image = apply_mask(masked_image, mask, color)
+        shown.append(i)
 
         # Mask Polygon
+        mask = masks[:, :, i]
         # Pad to ensure proper polygons for masks that touch image edges.
         padded_mask = np.zeros(
             (mask.shape[0] + 2, mask.shape[1] + 2), dtype=np.uint8)
@@ -162,6 +222,11 @@ def display_instances(image, boxes, masks, class_ids, class_names,
             verts = np.fliplr(verts) - 1
             p = Polygon(verts, facecolor="none", edgecolor=color)
             ax.add_patch(p)
+
+    # Masks, all in one pass
+    if show_mask and shown:
+        apply_masks(masked_image, masks[:, :, shown],
+                    [colors[i] for i in shown], out=masked_image)
     ax.imshow(masked_image.astype(np.uint8))
     if auto_show:
         plt.show()
@@ -0,0 +1,122 @@
+"""
+Mask R-CNN
+Benchmark of the detection head (DetectionLayer) latency against the
+number of classes.
+
+Licensed under the MIT License (see LICENSE for details)
+
+------------------------------------------------------------
+
+The detection layer refines the classifier boxes and runs per-class
+non-maximum suppression. This script feeds it random proposals, class
+probabilities and box deltas and times it for a range of class counts.
+No weights are needed.
+
+Usage:
+
+    python3 detection_head.py --classes=2,5,11,21,41,81 --images=1 --runs=50
+"""
+
+import os
+import sys
+import time
+import numpy as np
+import tensorflow as tf
+
+# Root directory of the project
+ROOT_DIR = os.path.abspath("../../")
+sys.path.append(ROOT_DIR)  # To find local version of the library
+
+from mrcnn.config import Config
+from mrcnn import model as modellib
+
+
+class BenchmarkConfig(Config):
+    NAME = "benchmark"
+    GPU_COUNT = 1
+    DETECTION_MIN_CONFIDENCE = 0.0
+
+
+def random_inputs(config, num_images, num_rois, rng):
+    """Returns random inputs for the DetectionLayer.
+
+    The class probabilities are peaked so that most ROIs get a foreground
+    class and survive the confidence filter, which is the worst case for NMS.
+    """
+    # Random boxes in normalized coordinates, clustered so NMS has work to do
+    centers = rng.uniform(0.1, 0.9, size=(num_images, num_rois, 2))
+    sizes = rng.uniform(0.05, 0.3, size=(num_images, num_rois, 2))
+    rois = np.concatenate([centers - sizes / 2, centers + sizes / 2], axis=2)
+    rois = np.clip(rois, 0, 1).astype(np.float32)
+    # Class probabilities
+    logits = rng.normal(size=(num_images, num_rois, config.NUM_CLASSES)) * 4
+    probs = np.exp(logits - logits.max(axis=2, keepdims=True))
+    probs = (probs / probs.sum(axis=2, keepdims=True)).astype(np.float32)
+    # Box deltas
+    deltas = rng.normal(scale=0.1, size=(num_images, num_rois, config.NUM_CLASSES, 4))
+    deltas = deltas.astype(np.float32)
+    # Image metas. The window covers the whole image.
+    image_shape = config.IMAGE_SHAPE
+    metas = np.stack([
+        modellib.compose_image_meta(i, image_shape, image_shape,
+                                    (0, 0, image_shape[0], image_shape[1]), 1.0,
+                                    np.zeros([config.NUM_CLASSES], dtype=np.int32))
+        for i in range(num_images)]).astype(np.float32)
+    return rois, probs, deltas, metas
+
+
+def benchmark(num_classes, num_images, num_rois, runs, rng):
+    """Builds the detection layer for the given number of classes and
+    returns the mean and standard deviation of its latency in seconds.
+    """
+    class ClassCountConfig(BenchmarkConfig):
+        NUM_CLASSES = num_classes
+    config = ClassCountConfig()
+
+    graph = tf.Graph()
+    with graph.as_default():
+        rois = tf.placeholder(tf.float32, [None, None, 4])
+        probs = tf.placeholder(tf.float32, [None, None, num_classes])
+        deltas = tf.placeholder(tf.float32, [None, None, num_classes, 4])
+        metas = tf.placeholder(tf.float32, [None, config.IMAGE_META_SIZE])
+        detections = modellib.DetectionLayer(config)([rois, probs, deltas, metas])
+
+        inputs = random_inputs(config, num_images, num_rois, rng)
+        feed = dict(zip([rois, probs, deltas, metas], inputs))
+        with tf.Session(graph=graph) as sess:
+            # Warm up
+            for _ in range(3):
+                sess.run(detections, feed)
+            timings = []
+            for _ in range(runs):
+                start = time.time()
+                sess.run(detections, feed)
+                timings.append(time.time() - start)
+    return np.mean(timings), np.std(timings)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the Mask R-CNN detection head against the number of classes.')
+    parser.add_argument('--classes', required=False,
+                        default="2,5,11,21,41,81",
+                        metavar="2,5,11,...",
+                        help='Comma separated list of class counts (including background)')
+    parser.add_argument('--images', required=False, type=int,
+                        default=1,
+                        help='Number of images per batch')
+    parser.add_argument('--rois', required=False, type=int,
+                        default=BenchmarkConfig.POST_NMS_ROIS_INFERENCE,
+                        help='Number of ROIs per image')
+    parser.add_argument('--runs', required=False, type=int,
+                        default=50,
+                        help='Number of timed runs per class count')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    print("{:>8} {:>12} {:>12}".format("classes", "mean (ms)", "std (ms)"))
+    for num_classes in [int(c) for c in args.classes.split(",")]:
+        mean, std = benchmark(num_classes, args.images, args.rois, args.runs, rng)
+        print("{:>8} {:>12.2f} {:>12.2f}".format(num_classes, mean * 1000, std * 1000))
@@ -0,0 +1,116 @@
+"""
+Mask R-CNN
+Benchmark of visualize.display_instances() rendering time against the
+number of instances.
+
+Licensed under the MIT License (see LICENSE for details)
+
+------------------------------------------------------------
+
+Draws random instances on a random image with display_instances() and
+times it, including the rendering of the figure. The mask overlay alone is
+timed as well, both with the batched visualize.apply_masks() and with one
+visualize.apply_mask() call per instance. No model is needed.
+
+Usage:
+
+    python3 display_instances.py --instances=1,5,10,25,50,100 --runs=5
+"""
+
+import os
+import sys
+import time
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+# Root directory of the project
+ROOT_DIR = os.path.abspath("../../")
+sys.path.append(ROOT_DIR)  # To find local version of the library
+
+from mrcnn import visualize
+
+
+def random_instances(height, width, count, rng):
+    """Returns random boxes, elliptic masks and class IDs."""
+    sizes = rng.randint(20, min(height, width) // 3, size=(count, 2))
+    y1 = rng.randint(0, height - sizes[:, 0])
+    x1 = rng.randint(0, width - sizes[:, 1])
+    boxes = np.stack([y1, x1, y1 + sizes[:, 0], x1 + sizes[:, 1]], axis=1)
+    masks = np.zeros((height, width, count), dtype=bool)
+    for i, (y1, x1, y2, x2) in enumerate(boxes):
+        y, x = np.ogrid[-1:1:complex(0, y2 - y1), -1:1:complex(0, x2 - x1)]
+        masks[y1:y2, x1:x2, i] = y ** 2 + x ** 2 <= 1
+    class_ids = rng.randint(1, 10, size=count)
+    return boxes, masks, class_ids
+
+
+def time_it(fn, runs):
+    """Returns the mean latency of fn() in seconds."""
+    timings = []
+    for _ in range(runs):
+        start = time.time()
+        fn()
+        timings.append(time.time() - start)
+    return np.mean(timings)
+
+
+def benchmark(count, height, width, runs, rng):
+    """Returns the mean time in seconds of display_instances() and of the
+    batched and per-instance mask overlays for count instances.
+    """
+    image = rng.randint(0, 256, size=(height, width, 3)).astype(np.uint8)
+    boxes, masks, class_ids = random_instances(height, width, count, rng)
+    class_names = ["BG"] + ["class_{}".format(i) for i in range(1, 10)]
+    scores = rng.uniform(0.5, 1, size=count)
+    colors = visualize.random_colors(count)
+
+    def display():
+        fig, ax = plt.subplots(1, figsize=(width / 100, height / 100))
+        visualize.display_instances(image, boxes, masks, class_ids, class_names,
+                                    scores=scores, ax=ax, colors=colors)
+        fig.canvas.draw()
+        plt.close(fig)
+
+    buffer = np.empty(image.shape, dtype=np.uint32)
+
+    def batched():
+        visualize.apply_masks(image, masks, colors, out=buffer)
+
+    def per_instance():
+        masked_image = image.astype(np.uint32).copy()
+        for i in range(count):
+            visualize.apply_mask(masked_image, masks[:, :, i], colors[i])
+
+    return time_it(display, runs), time_it(batched, runs), time_it(per_instance, runs)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark display_instances() against the number of instances.')
+    parser.add_argument('--instances', required=False,
+                        default="1,5,10,25,50,100",
+                        metavar="1,5,10,...",
+                        help='Comma separated list of instance counts')
+    parser.add_argument('--height', required=False, type=int,
+                        default=480,
+                        help='Image height')
+    parser.add_argument('--width', required=False, type=int,
+                        default=640,
+                        help='Image width')
+    parser.add_argument('--runs', required=False, type=int,
+                        default=5,
+                        help='Number of timed runs per instance count')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    print("{:>10} {:>14} {:>14} {:>14}".format(
+        "instances", "display (ms)", "batched (ms)", "per-inst (ms)"))
+    for count in [int(c) for c in args.instances.split(",")]:
+        display, batched, per_instance = benchmark(
+            count, args.height, args.width, args.runs, rng)
+        print("{:>10} {:>14.2f} {:>14.2f} {:>14.2f}".format(
+            count, display * 1000, batched * 1000, per_instance * 1000))
@@ -27,6 +27,9 @@ Usage: import the module (see Jupyter notebooks for examples), or run from
 
     # Splash results to video using the last weights you trained
     python3 tabletop.py splash --weights=last --video=<URL or path to file>
+
+    # Export a frozen inference graph, checked against the Keras model on the CPU
+    python3 tabletop.py export --weights=/path/to/weights/file.h5 --graph=/path/to/graph.pb [--image=<path to file>]
 """
 
 import os
@@ -44,9 +47,10 @@ sys.path.append(ROOT_DIR)  # To find local version of the library
 # Import config and dataset files
 from samples.humanoids_pouring import configurations
 from samples.humanoids_pouring import datasets
+from samples.tabletop import pipelines
 
 # Import Mask RCNN
-from mrcnn import model as modellib, utils
+from mrcnn import model as modellib, utils, tracking, export
 
 # Path to trained weights file
 COCO_WEIGHTS_PATH = os.path.join(ROOT_DIR, "mask_rcnn_coco.h5")
@@ -127,31 +131,39 @@ def apply_detection_results(image, masks, bboxes, class_ids, class_names, colors
     :return: result (image): image with detection results splashed on it, 3-channel, 8-bit RGB image
     """
 
-    # Opacity of masks: 0.5
-    opacity = 0.5
-
-    result = image.astype(float)/255
-
-    for detection_idx in range(masks.shape[2]):
-
-        if not np.any(bboxes[detection_idx]):
-            # Skip this instance. Has no bbox. Likely lost in image cropping.
-            continue
-
-        # Get the color in float form
+    # Opacity of masks: 0.5, as 8-bit fixed point
+    opacity = 128
+
+    result = image.copy()
+
+    # Label image: 1 + index of the detection that colors each pixel, 0 for
+    # none. Only the pixels inside the bounding boxes are written, and later
+    # detections are drawn over earlier ones.
+    labels = np.zeros(image.shape[:2], dtype=np.uint16)
+    palette = np.zeros((masks.shape[2] + 1, 3), dtype=np.uint16)
+    detection_ids = [i for i in range(masks.shape[2]) if np.any(bboxes[i])]
+    for detection_idx in detection_ids:
+        y1, x1, y2, x2 = np.maximum(bboxes[detection_idx], 0)
+        mask = masks[y1:y2, x1:x2, detection_idx]
+        labels[y1:y2, x1:x2][mask] = detection_idx + 1
+        # Get the color in 8-bit form
         color = colors[class_names[class_ids[detection_idx]]]
-
-        # Draw the segmentation mask
-        mask = masks[:,:,detection_idx]
-        alpha_mask = np.stack((mask, mask, mask), axis=2)
-        alpha_mask = alpha_mask.astype(np.float) * opacity
-        assert alpha_mask.shape == image.shape
-
-        foreground = np.ones(image.shape, dtype=float) * color
-        _background = cv2.multiply(1.0 - alpha_mask, result)
-        _foreground = cv2.multiply(alpha_mask, foreground)
-
-        result = cv2.add(_foreground, _background)
+        palette[detection_idx + 1] = np.round(np.array(color) * 255)
+
+    # Blend all the masks in one pass, within the union of the boxes
+    if detection_ids:
+        boxes = np.maximum(np.array([bboxes[i] for i in detection_ids]), 0)
+        region = (slice(boxes[:, 0].min(), boxes[:, 2].max()),
+                  slice(boxes[:, 1].min(), boxes[:, 3].max()))
+        region_labels = labels[region]
+        foreground = region_labels > 0
+        pixels = result[region][foreground].astype(np.uint16)
+        blended = (pixels * (256 - opacity) +
+                   palette[region_labels[foreground]] * opacity + 128) >> 8
+        result[region][foreground] = blended
+
+    for detection_idx in detection_ids:
+        color = tuple(int(c) for c in palette[detection_idx + 1])
 
         # Draw the bounding box
         y1, x1, y2, x2 = bboxes[detection_idx]
@@ -167,14 +179,12 @@ def apply_detection_results(image, masks, bboxes, class_ids, class_names, colors
         caption = "{} {:.3f}".format(label, scores[detection_idx]) if scores.any() else label
 
         cv2.putText(result, caption, (x1 + offset_x_text, y2 + offset_y_text), fontFace=font, fontScale=fontScale,
-                    color=(1.0, 1.0, 1.0), lineType=lineType)
-
-    result *= 255
-    result = result.astype(np.uint8)
+                    color=(255, 255, 255), lineType=lineType)
 
     return result
 
-def detect_and_splash_results(model, config, dataset, class_colors, image_path=None, video_path=None):
+def detect_and_splash_results(model, config, dataset, class_colors, image_path=None, video_path=None,
+                              keyframe_interval=1):
 
     assert image_path or video_path
 
@@ -196,37 +206,16 @@ def detect_and_splash_results(model, config, dataset, class_colors, image_path=N
         file_name = image_path + "_splash_{:%Y%m%dT%H%M%S}.png".format(datetime.datetime.now())
         cv2.imwrite(file_name, splash)
     elif video_path:
-        # Video capture
-        vcapture = cv2.VideoCapture(video_path)
-        width = int(vcapture.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(vcapture.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        fps = vcapture.get(cv2.CAP_PROP_FPS)
-
-        # Define codec and create video writer
+        # Decode, detect, composite and encode the frames in separate stages
         file_name = os.path.basename(video_path) + "_splash_{:%Y%m%dT%H%M%S}.avi".format(datetime.datetime.now())
-        vwriter = cv2.VideoWriter(file_name,
-                                  cv2.VideoWriter_fourcc(*'MJPG'),
-                                  fps, (width, height))
-
-        count = 0
-        success = True
-        while success:
-            print("frame: ", count)
-            # Read next image
-            success, image = vcapture.read()
-            if success:
-                # OpenCV returns images as BGR, convert to RGB
-                image = image[..., ::-1]
-                # Detect objects
-                r = model.detect([image], verbose=0)[0]
-                # Color splash
-                splash = apply_detection_results(image, r['masks'], r['rois'], r['class_ids'], dataset.class_names, class_colors, scores=r['scores'])
-                # RGB -> BGR to save image to video
-                splash = splash[..., ::-1]
-                # Add image to video writer
-                vwriter.write(splash)
-                count += 1
-        vwriter.release()
+        def composite(image, r):
+            return apply_detection_results(image, r['masks'], r['rois'], r['class_ids'], dataset.class_names, class_colors, scores=r['scores'])
+        if keyframe_interval > 1:
+            # Full detection on keyframes only, tracking in between
+            model = tracking.TrackingDetector(model, keyframe_interval=keyframe_interval)
+        pipeline = pipelines.VideoPipeline(model, composite)
+        for stage_stats in pipeline.run(video_path, file_name):
+            print(stage_stats)
     print("Saved to ", file_name)
 
 def evaluate_model(model, config):
@@ -249,13 +238,17 @@ def evaluate_model(model, config):
     # Compute COCO-Style mAP @ IoU=0.5-0.95 in 0.05 increments
     # Running on all images
     #image_ids = np.random.choice(dataset_val.image_ids, 200)
-    image_ids = dataset_val.image_ids
+    # Batch together images that are molded to the same shape, so batches
+    # don't mix shapes when IMAGE_RESIZE_MODE is "pad64"
+    image_batches = modellib.batch_image_ids_by_shape(dataset_val, config,
+                                                      config.BATCH_SIZE)
+    image_ids = [image_id for batch in image_batches for image_id in batch]
+    batch_ends = set(np.cumsum([len(batch) for batch in image_batches]) - 1)
     APs = []
     AP50s = []
     AP75s = []
     image_batch_vector = []
     image_batch_eval_data = []
-    img_batch_count = 0
 
     import time
     t_inference = 0
@@ -281,11 +274,11 @@ def evaluate_model(model, config):
         # Compose a vector of images and data
         image_batch_vector.append(image)
         image_batch_eval_data.append(image_eval_data(image_id, gt_class_id, gt_bbox, gt_mask))
-        img_batch_count += 1
 
         # If a batch is ready, go on to detection
-        # The last few images in the dataset will not be used if batch size > 1
-        if img_batch_count < config.BATCH_SIZE:
+        # The last few images of each shape are run as a smaller batch,
+        # since the inference graph accepts a variable batch size
+        if idx not in batch_ends:
             continue
 
         # Run object detection
@@ -324,7 +317,6 @@ def evaluate_model(model, config):
         # Reset the batch info
         image_batch_vector = []
         image_batch_eval_data = []
-        img_batch_count = 0
 
         progbar.update(idx+1)
 
@@ -364,7 +356,7 @@ if __name__ == '__main__':
         description='Train Mask R-CNN to detect objects.')
     parser.add_argument("command",
                         metavar="<command>",
-                        help="'train', 'splash', 'evaluate'")
+                        help="'train', 'splash', 'evaluate', 'export'")
     parser.add_argument('--dataset', required=False,
                         metavar="/path/to/dataset/",
                         help='Directory of the dataset')
@@ -381,6 +373,13 @@ if __name__ == '__main__':
     parser.add_argument('--video', required=False,
                         metavar="path or URL to video",
                         help='Video to detect objects on')
+    parser.add_argument('--keyframe_interval', required=False,
+                        default=1, type=int,
+                        help='Run the full detection every this many video frames '
+                             'and track the objects in between (default=1, no tracking)')
+    parser.add_argument('--graph', required=False,
+                        metavar="/path/to/graph.pb",
+                        help='Frozen inference graph written by export')
     args = parser.parse_args()
 
     # Validate arguments
@@ -389,6 +388,8 @@ if __name__ == '__main__':
     elif args.command == "splash":
         assert args.image or args.video,\
                "Provide --image or --video to apply color splash"
+    elif args.command == "export":
+        assert args.graph, "Argument --graph is required for export"
 
     print("Weights: ", args.weights)
     print("Dataset: ", args.dataset)
@@ -405,7 +406,8 @@ if __name__ == '__main__':
 
     # Add some env variables to set GPU usage
     os.environ['CUDA_DEVICE_ORDER'] = 'PCI_BUS_ID'
-    os.environ['CUDA_VISIBLE_DEVICES'] = config.GPU_ID
+    # Export and check the exported graph on the CPU
+    os.environ['CUDA_VISIBLE_DEVICES'] = "" if args.command == "export" else config.GPU_ID
     config.display()
 
     # Create model
@@ -468,10 +470,23 @@ if __name__ == '__main__':
         class_colors = {class_id: color for (color, class_id) in zip(random_class_colors, dataset.class_names)}
 
         detect_and_splash_results(model, image_path=args.image,
-                                video_path=args.video, config=config, dataset=dataset, class_colors=class_colors)
+                                video_path=args.video, config=config, dataset=dataset, class_colors=class_colors,
+                                keyframe_interval=args.keyframe_interval)
 
     elif args.command == 'evaluate':
         evaluate_model(model, config)
+    elif args.command == 'export':
+        export.export_frozen_graph(model, args.graph)
+        print("Exported to ", args.graph)
+        # Check the outputs of the exported graph against the Keras model.
+        # Fails if they differ by more than the tolerance of compare_outputs()
+        if args.image:
+            image = cv2.imread(args.image)[..., ::-1]
+        else:
+            image = np.random.randint(0, 256, (config.IMAGE_MAX_DIM, config.IMAGE_MAX_DIM, 3), dtype=np.uint8)
+        frozen_model = export.FrozenMaskRCNN(args.graph, config)
+        for name, difference in export.compare_outputs(model, frozen_model, [image] * config.BATCH_SIZE).items():
+            print("{:15} max abs difference {:.6f}".format(name, difference))
     else:
         print("'{}' is not recognized. "
-              "Use 'train', 'splash' or 'evaluate'".format(args.command))
+              "Use 'train', 'splash', 'evaluate' or 'export'".format(args.command))
@@ -19,9 +19,14 @@ ROOT_DIR = os.path.abspath("../../")
 #   Import Mask R-CNN
 sys.path.append(ROOT_DIR)
 import mrcnn.model as modellib
+from mrcnn import utils
+from mrcnn.tracking import TrackingDetector
+from mrcnn.export import FrozenMaskRCNN
 
 #   Import the tabletop dataset custom configuration
 import tabletop
+from pipelines import StreamPipeline
+import serialization
 
 #   Import YARP bindings
 if 'yarp' not in sys.modules:
@@ -49,9 +54,9 @@ MODEL_DIR = os.path.join(ROOT_DIR, "logs")
 import tensorflow as tf
 from keras import backend as K
 
-config = tf.ConfigProto()
-config.gpu_options.per_process_gpu_memory_fraction = 0.5
-sess = tf.Session(config=config)
+session_config = tf.ConfigProto()
+session_config.gpu_options.per_process_gpu_memory_fraction = 0.5
+sess = tf.Session(config=session_config)
 K.set_session(sess)
 
 class MaskRCNNWrapperModule (yarp.RFModule):
@@ -74,6 +79,14 @@ class MaskRCNNWrapperModule (yarp.RFModule):
 
         self._output_mask_buf_image = None
         self._output_mask_buf_array = None
+        self._mask_format = args.mask_format
+        self._output_format = args.output_format
+
+        #   Images pointed at the packed detections of the binary output format
+        self._bboxes_image = None
+        self._info_image = None
+        self._rle_image = None
+        self._packed_arrays = None
 
         self._port_out_bboxes = None
         self._port_out_info = None
@@ -86,6 +99,8 @@ class MaskRCNNWrapperModule (yarp.RFModule):
 
         self._input_img_width = args.input_img_width
         self._input_img_height = args.input_img_height
+        self._native_resolution = args.native_resolution
+        self._keyframe_interval = args.keyframe_interval
 
         self._model_weights_path = os.path.join(MODEL_DIR, args.model_weights_path)
 
@@ -97,6 +112,9 @@ class MaskRCNNWrapperModule (yarp.RFModule):
 
         self._obj_stream = None
 
+        self._graph = None
+        self._pipeline = None
+
     def configure (self, rf):
         '''
         Configure the module internal variables and ports according to resource finder
@@ -132,6 +150,13 @@ class MaskRCNNWrapperModule (yarp.RFModule):
         self._port_out_info = yarp.Port()
         self._port_out_info.open('/' + self._module_name + '/detectionInfo:o')
 
+        #   Binary output format: the packed detections are sent as float images
+        #   ([N, (x1 y1 x2 y2)] boxes and [N, (x1 y1 x2 y2 class_id score)] info)
+        #   and the RLE masks as a one row int image
+        self._bboxes_image = yarp.ImageFloat()
+        self._info_image = yarp.ImageFloat()
+        self._rle_image = yarp.ImageInt()
+
         #   Output buffer initialization
         self._output_buf_image = yarp.ImageRgb()
         self._output_buf_image.resize(self._input_img_width, self._input_img_height)
@@ -146,9 +171,13 @@ class MaskRCNNWrapperModule (yarp.RFModule):
         self._port_out_mask = yarp.Port()
         self._port_out_mask.open('/' + self._module_name + '/maskImage:o')
 
-        #   Output mask buffer initialization
+        #   Output mask buffer initialization, reused for every frame
         self._output_mask_buf_image = yarp.ImageMono()
         self._output_mask_buf_image.resize(self._input_img_width, self._input_img_height)
+        self._output_mask_buf_array = np.zeros((self._input_img_height, self._input_img_width), dtype = np.uint8)
+        self._output_mask_buf_image.setExternal(self._output_mask_buf_array,
+                                                self._output_mask_buf_array.shape[1],
+                                                self._output_mask_buf_array.shape[0])
         print('Output mask buffer configured')
 
 
@@ -164,12 +193,19 @@ class MaskRCNNWrapperModule (yarp.RFModule):
         config.PRE_NMS_LIMIT                  =1000
         config.DETECTION_MAX_INSTANCES        =10
         config.DETECTION_MIN_CONFIDENCE       =0.75
+        if self._native_resolution:
+            # Run the camera frames padded to a multiple of 64, unscaled
+            config.IMAGE_RESIZE_MODE          ="native"
         
         config.display()
 
-        self._model = modellib.MaskRCNN(mode='inference',
-                                  model_dir=MODEL_DIR,
-                                  config=config)
+        #   A frozen graph written by the export command of the training
+        #   script has the weights embedded, and loads without building the model
+        frozen_graph = self._model_weights_path.endswith('.pb')
+        if not frozen_graph:
+            self._model = modellib.MaskRCNN(mode='inference',
+                                      model_dir=MODEL_DIR,
+                                      config=config)
 
         self._detection_results = None
 
@@ -200,15 +236,39 @@ class MaskRCNNWrapperModule (yarp.RFModule):
             print(error)
             return False
 
-        self._model.load_weights(self._model_weights_path, by_name=True)
+        if frozen_graph:
+            self._model = FrozenMaskRCNN(self._model_weights_path, config,
+                                         session_config=session_config)
+
+            print("Frozen graph loaded")
+        else:
+            self._model.load_weights(self._model_weights_path, by_name=True)
+
+            print("Model weights loaded")
+
+            #   Inference runs in its own thread, which needs the graph and the
+            #   predict function ready beforehand
+            self._model.keras_model._make_predict_function()
+        self._graph = tf.get_default_graph()
 
-        print("Model weights loaded")
+        #   Run the full detection on keyframes only and track the objects in between
+        self._detector = self._model
+        if self._keyframe_interval > 1:
+            self._detector = TrackingDetector(self._model, keyframe_interval=self._keyframe_interval)
+
+        #   Start grabbing, detecting and publishing in separate threads
+        self._pipeline = StreamPipeline(self._read_frame, self._detect, self._publish)
+        self._pipeline.start()
+
+        print("Pipeline started")
 
         return True
 
     def interruptModule(self):
 
         self._port_in.interrupt()
+        if self._pipeline:
+            self._pipeline.stop()
         self._port_out.interrupt()
         self._port_out_bboxes.interrupt()
         self._port_out_info.interrupt()
@@ -228,127 +288,184 @@ class MaskRCNNWrapperModule (yarp.RFModule):
 
     def getPeriod(self):
 
-        return 0.0
+        #   Period of the pipeline statistics report
+        return 5.0
 
     def updateModule(self):
         '''
-        During module update, acquire a streamed image, perform inference using the model and then
-        return/display results
+        The frames are acquired, processed and streamed out by the pipeline threads.
+        Here, just report the pipeline throughput, latency and dropped frames
         '''
 
-        input_img = self._port_in.read()
-        if input_img is None:
-            print('Invalid input image (image is None)')
-        else:
-            self._input_buf_image.copy(input_img)
-            assert self._input_buf_array.__array_interface__['data'][0] == self._input_buf_image.getRawImage().__int__()
-
-            #   run detection/segmentation on frame
-            frame = self._input_buf_array
-            results = self._model.detect([frame], verbose=0)
-
-            # Visualize and stream results
-            r = results[0]
-            self._detection_results = r
-            if len(r['rois']) > 0:
-                frame_with_detections = tabletop.apply_detection_results(frame, r['masks'], r['rois'], r['class_ids'],
-                                                                         self._dataset.class_names,
-                                                                         self._class_colors,
-                                                                         scores=r['scores'])
+        print(self._pipeline)
 
-                b = yarp.Bottle()
-                for detection_bbox in r['rois']:
-                    y1, x1, y2, x2 = detection_bbox
-                    bb = b.addList()
-                    bb.addDouble(float(x1))
-                    bb.addDouble(float(y1))
-                    bb.addDouble(float(x2))
-                    bb.addDouble(float(y2))
+        return True
 
+    def _read_frame(self):
+        '''
+        Wait for the next streamed image (pipeline grabber thread)
+        :return (np.ndarray): copy of the image, or None if the read was interrupted
+        '''
 
-                #   Send out the processed image
-                self._output_buf_array[:,:] = frame_with_detections.astype(np.uint8)
-                self._port_out.write(self._output_buf_image)
+        input_img = self._port_in.read()
+        if input_img is None:
+            return None
+        self._input_buf_image.copy(input_img)
+        assert self._input_buf_array.__array_interface__['data'][0] == self._input_buf_image.getRawImage().__int__()
 
-                # Default behavior is a blank image
-                output_mask_buf_array = np.zeros((self._input_img_height, self._input_img_width), dtype = np.uint8)
+        #   The buffer is overwritten by the next read
+        return self._input_buf_array.copy()
 
-                #   Send the mask related to the asked object
-                if self._obj_stream:
-                    obj_stream_idx = self._dataset.class_names.index(self._obj_stream)
-                    if any(r['class_ids'] == obj_stream_idx):
-                        #   If desired object was detected
-                        obj_stream_mask_id = np.where(r['class_ids'] == obj_stream_idx)[0][0]
-                        output_mask_buf_array[:,:] = r['masks'][:,:,obj_stream_mask_id].astype(np.uint8) * 255
+    def _detect(self, frame):
+        '''
+        Run detection/segmentation on a frame (pipeline inference thread)
+        '''
 
-                    self._output_mask_buf_image.setExternal(output_mask_buf_array,
-                                                            output_mask_buf_array.shape[1],
-                                                            output_mask_buf_array.shape[0])
+        with self._graph.as_default(), sess.as_default():
+            return self._detector.detect([frame], verbose=0)[0]
 
-                    self._port_out_mask.write(self._output_mask_buf_image)
+    def _publish(self, frame, r):
+        '''
+        Visualize and stream out the results of a frame (pipeline publisher thread)
+        '''
 
+        #   Label map for the RPC seed lookups, built once per frame
+        r['labels'] = self._build_label_map(r)
+        self._detection_results = r
+        if len(r['rois']) > 0:
+            frame_with_detections = tabletop.apply_detection_results(frame, r['masks'], r['rois'], r['class_ids'],
+                                                                     self._dataset.class_names,
+                                                                     self._class_colors,
+                                                                     scores=r['scores'])
+
+            #   Pack all the detections in one array, sent as is or formatted in one go
+            binary = self._output_format == 'binary'
+            detections = serialization.pack_detections(r, np.float32 if binary else np.float64)
+            #   The images point at the packed arrays, which must outlive the writes
+            self._packed_arrays = []
+
+            #   Send out the processed image
+            self._output_buf_array[:,:] = frame_with_detections.astype(np.uint8)
+            self._port_out.write(self._output_buf_image)
+
+            #   Send out the masks
+            if self._mask_format == 'labels':
+                #   All the objects, labelled in the order of the detections
+                serialization.labels_to_image(r['labels'], self._output_mask_buf_array)
+                self._port_out_mask.write(self._output_mask_buf_image)
+            elif self._mask_format == 'rle' and binary:
+                self._packed_arrays.append(serialization.array_to_image(
+                    serialization.pack_rles(r), self._rle_image))
+                self._port_out_mask.write(self._rle_image)
+            elif self._mask_format == 'rle':
+                mask_bottle = yarp.Bottle()
+                mask_bottle.fromString(serialization.rle_to_string(r))
+                self._port_out_mask.write(mask_bottle)
+            elif self._obj_stream:
+                #   Send the mask related to the asked object. Blank if it was not detected
+                obj_stream_idx = self._dataset.class_names.index(self._obj_stream)
+                serialization.object_mask_to_image(r, obj_stream_idx, self._output_mask_buf_array)
+                self._port_out_mask.write(self._output_mask_buf_image)
+
+            if binary:
+                #   Send out the bounding boxes data and the detection info
+                self._packed_arrays.append(serialization.array_to_image(
+                    detections[:, :4], self._bboxes_image))
+                self._port_out_bboxes.write(self._bboxes_image)
+                self._packed_arrays.append(serialization.array_to_image(
+                    detections, self._info_image))
+                self._port_out_info.write(self._info_image)
+            else:
                 #   Send out the bounding boxes data
+                b = yarp.Bottle()
+                b.fromString(serialization.bboxes_to_string(detections))
                 self._port_out_bboxes.write(b)
 
                 #   Send out the detection info
                 info_bottle = yarp.Bottle()
-                for detection_idx in range(len(r['rois'])):
-                    instance_bottle = info_bottle.addList()
-                    #   Add class name to info
-                    instance_bottle.addString(self._dataset.class_names[r['class_ids'][detection_idx]])
-                    #   Add class ID to info
-                    instance_bottle.addInt(int(r['class_ids'][detection_idx]))
-                    #   Add bounding box
-                    bb = instance_bottle.addList()
-                    y1, x1, y2, x2 = r['rois'][detection_idx]
-                    bb.addInt(int(x1))
-                    bb.addInt(int(y1))
-                    bb.addInt(int(x2))
-                    bb.addInt(int(y2))
-                    #   Add confidence score
-                    instance_bottle.addDouble(float(r['scores'][detection_idx]))
-
+                info_bottle.fromString(serialization.info_to_string(detections, self._dataset.class_names))
                 self._port_out_info.write(info_bottle)
 
-            else:
-                # If nothing is detected, just pass the video frame through
-                self._output_buf_array[:,:] = frame.astype(np.uint8)
-                self._port_out.write(self._output_buf_image)
+        else:
+            # If nothing is detected, just pass the video frame through
+            self._output_buf_array[:,:] = frame.astype(np.uint8)
+            self._port_out.write(self._output_buf_image)
 
-        return True
+    def _build_label_map(self, r):
+        '''
+        Build the instance label map of a frame
+        :param r (dict): detection results
+        :return (np.ndarray): [height, width] map of 1 + the index of the first detection covering each pixel,
+                              0 for the background. Only the pixels within the bounding boxes are written
+        '''
+
+        label_map = np.zeros(r['masks'].shape[:2], dtype=np.int32)
+        #   Write the last detection first, so the first one wins where masks overlap
+        for detection_idx in reversed(range(len(r['rois']))):
+            y1, x1, y2, x2 = r['rois'][detection_idx]
+            label_map[y1:y2, x1:x2][r['masks'][y1:y2, x1:x2, detection_idx]] = detection_idx + 1
+        return label_map
 
-    def get_component_around(self, seed_x, seed_y):
+    def _get_detection_around(self, seed_x, seed_y):
         '''
-        Return a list of points belonging to a detected object, starting from a seed point
+        Look up the detection whose mask contains a seed point
         :param seed_x (int): seed point x coordinate
         :param seed_y (int): seed point y coordinate
-        :return (list): list of [x,y] points pertaining to the segmented object. Empty if seed is outside the component
+        :return (tuple): detection results and index of the detection. The index is None if the seed is outside
+                         every mask. If the seed point is contained in more than one mask, the first one is returned
         '''
 
-        blob_point_list = []
+        r = self._detection_results
 
         #   Assert seed point is within image boundaries
-        if not ((seed_x > 0 and seed_x < self._input_img_width) and (seed_y > 0 and seed_y < self._input_img_height)):
-            return blob_point_list
-        
-        #   Assert if seed point is contained in any detection mask
-        detection_masks = self._detection_results['masks']
-        if not np.any(detection_masks[seed_y, seed_x, :]):
-            return blob_point_list
-
-        #   Given seed point is contained in a mask, retrieve such mask
-        #   If the seed point is contained in more than one mask, return the first found mask
-        #TODO: THIS IS BRUTAL, MAYBE REWRITE THIS SO YOU DON'T LOOK LIKE A CAVEMAN
-        for mask_idx in range(detection_masks.shape[2]):
-            if detection_masks[seed_y, seed_x, mask_idx]:
-                point_array_row, point_array_col = np.where(detection_masks[:,:,mask_idx])
-                for point_idx in range(point_array_row.shape[0]):
-                    #   The points are enlisted as [x, y] coordinates so row and column order is swapped
-                    blob_point_list.append([point_array_col[point_idx], point_array_row[point_idx]])
-                break
-
-        #   If none is found, return empty list of points
-        return blob_point_list
+        if r is None or not (0 <= seed_x < r['labels'].shape[1] and 0 <= seed_y < r['labels'].shape[0]):
+            return r, None
+
+        label = r['labels'][seed_y, seed_x]
+        return r, (label - 1 if label else None)
+
+    def get_component_around(self, seed_x, seed_y, step=1, contour=False):
+        '''
+        Return the points belonging to a detected object, starting from a seed point
+        :param seed_x (int): seed point x coordinate
+        :param seed_y (int): seed point y coordinate
+        :param step (int): keep one point every step points
+        :param contour (bool): only return the points on the contour of the object
+        :return (np.ndarray): [N, 2] array of (x, y) points pertaining to the segmented object.
+                              Empty if seed is outside the component
+        '''
+
+        r, detection_idx = self._get_detection_around(seed_x, seed_y)
+        if detection_idx is None:
+            return np.empty((0, 2), dtype=np.int32)
+
+        #   The mask is empty outside of its bounding box
+        y1, x1, y2, x2 = r['rois'][detection_idx]
+        mask = r['masks'][y1:y2, x1:x2, detection_idx]
+
+        if contour:
+            #   Keep the pixels with at least one 4-neighbour outside the mask
+            padded = np.pad(mask, 1, mode='constant')
+            interior = padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:]
+            mask = mask & ~interior
+
+        #   The points are enlisted as [x, y] coordinates so row and column order is swapped
+        point_array_row, point_array_col = np.nonzero(mask)
+        points = np.stack([point_array_col + x1, point_array_row + y1], axis=1).astype(np.int32)
+        return points[::max(step, 1)]
+
+    def get_rle_around(self, seed_x, seed_y):
+        '''
+        Return the run-length encoded mask of a detected object, starting from a seed point
+        :param seed_x (int): seed point x coordinate
+        :param seed_y (int): seed point y coordinate
+        :return (dict): RLE mask (see mrcnn.utils.mask_to_rle), None if seed is outside the component
+        '''
+
+        r, detection_idx = self._get_detection_around(seed_x, seed_y)
+        if detection_idx is None:
+            return None
+        return utils.mask_to_rle(r['masks'][:, :, detection_idx])
 
     def respond(self, command, reply):
         '''
@@ -370,19 +487,28 @@ class MaskRCNNWrapperModule (yarp.RFModule):
 
         if command_string == available_commands[0]:
             #   return binary object around seed pixel
+            #   get_component_around x y [points|contour|rle] [step]
             seed_x = command.get(1).asInt()
             seed_y = command.get(2).asInt()
+            reply_format = command.get(3).toString() if command.size() > 3 else 'points'
+            step = command.get(4).asInt() if command.size() > 4 else 1
 
             pointlist = reply.addList()
 
-            point_list = self.get_component_around(seed_x, seed_y)
+            if reply_format == 'rle':
+                #   ((height width) (counts ...))
+                rle = self.get_rle_around(seed_x, seed_y)
+                if rle:
+                    pointlist.fromString("({} {}) ({})".format(rle['size'][0], rle['size'][1],
+                                                               " ".join(map(str, rle['counts']))))
+            else:
+                #   ((x y) (x y) ...)
+                point_list = self.get_component_around(seed_x, seed_y, step=step,
+                                                       contour=(reply_format == 'contour'))
 
-            #   Iterate over all points and add them to the bottle as lists
-            if point_list:
-                for point in point_list:
-                    p = pointlist.addList()
-                    p.addInt(int(point[0]))
-                    p.addInt(int(point[1]))
+                #   Parse all the points in one go rather than adding them one by one
+                if len(point_list):
+                    pointlist.fromString(("({} {}) " * len(point_list)).format(*point_list.ravel().tolist()))
 
         elif command_string == available_commands[1]:
             #   set the object whose detection mask to stream
@@ -413,7 +539,22 @@ def parse_args():
                         default=640, type=int)
     parser.add_argument('--height', dest='input_img_height', help='Input image height',
                         default=480, type=int)
-    parser.add_argument(dest='model_weights_path', help='Model weights path relative to the directory PROJECT_ROOT/logs',
+    parser.add_argument('--native', dest='native_resolution', action='store_true',
+                        help='Run inference at the input image resolution instead of resizing it')
+    parser.add_argument('--keyframe_interval', dest='keyframe_interval', help='Run the full detection every ' +
+                        'this many frames and track the objects in between (1 detects every frame)',
+                        default=1, type=int)
+    parser.add_argument('--mask_format', dest='mask_format', help='Format of the output masks: ' +
+                        'object (the object set through rpc), labels (all objects in one image), rle',
+                        default='object', choices=serialization.MASK_FORMATS, type=str)
+    parser.add_argument('--output_format', dest='output_format', help='Format of the detection ports: ' +
+                        'text (bottles, the default) or binary. In binary, /bboxes:o sends an ImageFloat of ' +
+                        '[N, (x1 y1 x2 y2)], /detectionInfo:o an ImageFloat of [N, (x1 y1 x2 y2 class_id score)] ' +
+                        'with class ids in place of the class names, and the rle mask format an ImageInt row of ' +
+                        'N, then height, width, number of counts and counts of each mask, padded to an even length',
+                        default='text', choices=serialization.OUTPUT_FORMATS, type=str)
+    parser.add_argument(dest='model_weights_path', help='Model weights path relative to the directory PROJECT_ROOT/logs. ' +
+                        'A .pb file is loaded as a frozen graph written by the export command',
 			type=str)
 
     return parser.parse_args()
@@ -0,0 +1,364 @@
+"""
+Mask R-CNN
+Pipelined video inference.
+
+Licensed under the MIT License (see LICENSE for details)
+
+------------------------------------------------------------
+
+VideoPipeline runs a model on a video file with separate stages connected
+by bounded queues, so that decoding, detection, compositing and encoding
+overlap:
+
+    reader thread -> detector -> compositor pool -> writer thread
+
+The detector runs in the calling thread, which owns the TensorFlow graph,
+and processes BATCH_SIZE frames per call to detect(). Frames are written
+in their original order.
+
+    pipeline = VideoPipeline(model, composite_fn)
+    pipeline.run("input.avi", "output.avi")
+
+StreamPipeline runs a model on a live stream, such as a camera, keeping
+only the latest frame so that the latency doesn't build up:
+
+    pipeline = StreamPipeline(read_fn, detect_fn, publish_fn)
+    pipeline.start()
+    ...
+    pipeline.stop()
+
+The stages are plain callables, so the pipelines can be driven without a
+camera or a YARP network.
+"""
+
+import time
+import queue
+import threading
+import traceback
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+
+
+class StageStats(object):
+    """Counts the frames processed by a pipeline stage and the time it
+    spent working on them (waiting on queues excluded).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, count, seconds):
+        with self._lock:
+            self.count += count
+            self.busy += seconds
+
+    def __str__(self):
+        fps = self.count / self.busy if self.busy > 0 else 0
+        return "{:12} {:6d} frames {:8.2f}s busy {:8.1f} fps".format(
+            self.name, self.count, self.busy, fps)
+
+
+class VideoPipeline(object):
+    """Detects objects in a video and writes the composited frames to
+    another video.
+
+    model: A MaskRCNN model in inference mode.
+    composite_fn: Callable (image, result) -> image that draws the result
+        of detect() on the RGB image and returns an RGB uint8 image.
+    batch_size: Frames per call to detect(). Defaults to BATCH_SIZE.
+    compositors: Number of compositor threads.
+    queue_size: Capacity of the queues between stages, in frames. Bounds
+        the memory used when a stage is slower than the others.
+    """
+
+    def __init__(self, model, composite_fn, batch_size=None, compositors=2,
+                 queue_size=16):
+        self.model = model
+        self.composite_fn = composite_fn
+        self.batch_size = batch_size or model.config.BATCH_SIZE
+        self.compositors = compositors
+        self.queue_size = queue_size
+        self.stats = None
+
+    def run(self, video_path, output_path, fourcc="MJPG"):
+        """Processes video_path and writes the result to output_path.
+
+        Returns the list of StageStats of the reader, detector, compositor
+        and writer stages.
+        """
+        vcapture = cv2.VideoCapture(video_path)
+        width = int(vcapture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(vcapture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        fps = vcapture.get(cv2.CAP_PROP_FPS)
+        vwriter = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*fourcc),
+                                  fps, (width, height))
+
+        self.stats = [StageStats(name) for name in
+                      ["reader", "detector", "compositor", "writer"]]
+        reader_stats, detector_stats, compositor_stats, writer_stats = self.stats
+        frames = queue.Queue(maxsize=self.queue_size)
+        composited = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        errors = []
+
+        # Queue operations give up when the pipeline is stopped by an error,
+        # so that no thread blocks forever on a queue that nobody serves.
+        def put(q, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(q):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return None
+
+        def read():
+            try:
+                while True:
+                    start = time.time()
+                    success, image = vcapture.read()
+                    if not success:
+                        break
+                    # OpenCV returns images as BGR, convert to RGB
+                    image = image[..., ::-1]
+                    reader_stats.add(1, time.time() - start)
+                    if not put(frames, image):
+                        break
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                put(frames, None)
+
+        def composite(image, result):
+            start = time.time()
+            splash = self.composite_fn(image, result)
+            compositor_stats.add(1, time.time() - start)
+            return splash
+
+        def write():
+            try:
+                while True:
+                    future = get(composited)
+                    if future is None:
+                        break
+                    splash = future.result()
+                    start = time.time()
+                    # RGB -> BGR to save image to video
+                    vwriter.write(splash[..., ::-1])
+                    writer_stats.add(1, time.time() - start)
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+
+        reader = threading.Thread(target=read, name="VideoPipelineReader")
+        writer = threading.Thread(target=write, name="VideoPipelineWriter")
+        reader.start()
+        writer.start()
+        pool = ThreadPoolExecutor(max_workers=self.compositors)
+        try:
+            done = False
+            while not done and not stop.is_set():
+                # Collect a batch
+                batch = []
+                while len(batch) < self.batch_size:
+                    image = get(frames)
+                    if image is None:
+                        done = True
+                        break
+                    batch.append(image)
+                if not batch:
+                    break
+
+                # With multiple GPUs, pad the last batch to a multiple of
+                # GPU_COUNT by repeating its last frame.
+                padding = -len(batch) % self.model.config.GPU_COUNT
+                start = time.time()
+                results = self.model.detect(batch + batch[-1:] * padding)
+                detector_stats.add(len(batch), time.time() - start)
+
+                # Composite in the pool. Futures are queued in frame order,
+                # so the writer keeps the order of the frames.
+                for image, result in zip(batch, results):
+                    if not put(composited, pool.submit(composite, image, result)):
+                        break
+        except:
+            stop.set()
+            raise
+        finally:
+            put(composited, None)
+            writer.join()
+            # Unblock the reader if it's waiting on a full queue
+            stop.set()
+            reader.join()
+            pool.shutdown()
+            vcapture.release()
+            vwriter.release()
+        if errors:
+            raise errors[0]
+        return self.stats
+
+
+class LatestSlot(object):
+    """Holds the latest item put in it, for a consumer that must never
+    fall behind its producer. Putting an item replaces the one that wasn't
+    taken yet, which counts as dropped.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._item = None
+        self._closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        with self._condition:
+            if self._item is not None:
+                self.dropped += 1
+            self._item = item
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        """Takes the item, waiting for one if there's none. Returns None on
+        timeout or if the slot is closed.
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._item is not None or self._closed, timeout)
+            item, self._item = self._item, None
+            return item
+
+    def close(self):
+        """Wakes up the consumer for good."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class StreamPipeline(object):
+    """Runs a model on a live stream in three threads, so that a slow
+    stage never makes the others wait:
+
+        grabber -> inference -> publisher
+
+    The grabber reads frames as fast as they come. The inference thread
+    always takes the latest frame and the publisher the latest result, so
+    the frames that arrive while the model is busy are dropped instead of
+    queued and the latency doesn't grow.
+
+    read_fn: Callable () -> frame that blocks until the next frame arrives.
+        The frame must not be modified by later reads. Returns None if
+        there's no frame, e.g. when the input is interrupted.
+    detect_fn: Callable (frame) -> result.
+    publish_fn: Callable (frame, result) that sends out the result.
+    latency_window: Number of recent frames the latency is averaged over.
+    """
+
+    def __init__(self, read_fn, detect_fn, publish_fn, latency_window=100):
+        self.read_fn = read_fn
+        self.detect_fn = detect_fn
+        self.publish_fn = publish_fn
+        self._frames = LatestSlot()
+        self._results = LatestSlot()
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        self.grabbed = 0
+        self.inferred = 0
+        self.published = 0
+        self.latencies = collections.deque(maxlen=latency_window)
+
+    def start(self):
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=target, name=name, daemon=True)
+            for target, name in [(self._grab, "StreamPipelineGrabber"),
+                                 (self._infer, "StreamPipelineInference"),
+                                 (self._publish, "StreamPipelinePublisher")]]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=None):
+        """Stops the threads. The read_fn must be unblocked first (e.g. by
+        interrupting the input port) for the grabber to exit.
+        """
+        self._stop.set()
+        self._frames.close()
+        self._results.close()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _grab(self):
+        while not self._stop.is_set():
+            frame = self.read_fn()
+            if frame is None:
+                continue
+            with self._lock:
+                self.grabbed += 1
+                frame_id = self.grabbed
+            self._frames.put((frame_id, time.time(), frame))
+
+    def _infer(self):
+        while not self._stop.is_set():
+            item = self._frames.get(timeout=0.1)
+            if item is None:
+                continue
+            frame_id, timestamp, frame = item
+            try:
+                result = self.detect_fn(frame)
+            except Exception:
+                traceback.print_exc()
+                continue
+            with self._lock:
+                self.inferred += 1
+            self._results.put((frame_id, timestamp, frame, result))
+
+    def _publish(self):
+        while not self._stop.is_set():
+            item = self._results.get(timeout=0.1)
+            if item is None:
+                continue
+            frame_id, timestamp, frame, result = item
+            try:
+                self.publish_fn(frame, result)
+            except Exception:
+                traceback.print_exc()
+                continue
+            with self._lock:
+                self.published += 1
+                self.latencies.append(time.time() - timestamp)
+
+    def stats(self):
+        """Returns a dict of frame counts, dropped frames and the mean and
+        max end-to-end latency in seconds, from grab to publish.
+        """
+        with self._lock:
+            latencies = list(self.latencies)
+            return {
+                "grabbed": self.grabbed,
+                "inferred": self.inferred,
+                "published": self.published,
+                "dropped_frames": self._frames.dropped,
+                "dropped_results": self._results.dropped,
+                "latency_mean": np.mean(latencies) if latencies else 0,
+                "latency_max": np.max(latencies) if latencies else 0,
+            }
+
+    def __str__(self):
+        return ("grabbed {grabbed} inferred {inferred} published {published} "
+                "dropped {dropped_frames}+{dropped_results} "
+                "latency {latency_mean:.3f}s (max {latency_max:.3f}s)"
+                ).format(**self.stats())
@@ -0,0 +1,131 @@
+"""
+Mask R-CNN
+Serialization of detection results for the YARP output ports.
+
+Licensed under the MIT License (see LICENSE for details)
+
+------------------------------------------------------------
+
+The detections of a frame are packed in one array, which is sent in one of
+the output formats:
+    text: The default. The array is formatted into the text form of a
+          YARP bottle with a single format call, and the bottle is filled
+          with Bottle.fromString().
+    binary: Opt-in. The array is sent as is, as a float image with one row
+            per detection. The image points at the array, so nothing is
+            copied or formatted. The detection info has class IDs in place
+            of the class names. The RLE masks are sent as a one row int
+            image. See pack_rles().
+
+Masks can be sent as:
+    object: A mono image of the mask of one object (255 on the object).
+    labels: A mono image where each pixel holds 1 + the index of the
+            detection covering it (in the order of the other ports) and 0
+            is the background. Carries the masks of all the objects.
+    rle: A bottle with the run-length encoded mask of each detection, as
+         ((height width) (counts ...)). See mrcnn.utils.mask_to_rle().
+"""
+
+import numpy as np
+
+from mrcnn import utils
+
+MASK_FORMATS = ["object", "labels", "rle"]
+OUTPUT_FORMATS = ["text", "binary"]
+
+
+def pack_detections(r, dtype=np.float64):
+    """Packs the detections of a frame in one array.
+
+    r: Detection results, as returned by MaskRCNN.detect().
+    dtype: Type of the array. float32 for a yarp.ImageFloat.
+
+    Returns: [N, (x1, y1, x2, y2, class_id, score)] array.
+    """
+    packed = np.empty((len(r['rois']), 6), dtype=dtype)
+    # The ports use (x, y) order
+    packed[:, :4] = r['rois'][:, [1, 0, 3, 2]]
+    packed[:, 4] = r['class_ids']
+    packed[:, 5] = r['scores']
+    return packed
+
+
+def bboxes_to_string(packed):
+    """Formats the boxes of packed detections as
+    ((x1 y1 x2 y2) ...) with float coordinates.
+    """
+    return ("({:.1f} {:.1f} {:.1f} {:.1f}) " * len(packed)).format(
+        *packed[:, :4].ravel().tolist())
+
+
+def info_to_string(packed, class_names):
+    """Formats packed detections as ((class_name class_id (x1 y1 x2 y2)
+    score) ...) with integer IDs and coordinates.
+    """
+    names = [class_names[int(class_id)] for class_id in packed[:, 4]]
+    values = [v for name, row in zip(names, packed.tolist())
+              for v in [name, row[4]] + row[:4] + [row[5]]]
+    return ('("{}" {:.0f} ({:.0f} {:.0f} {:.0f} {:.0f}) {!r}) ' * len(packed)).format(*values)
+
+
+def pack_rles(r):
+    """Packs the run-length encoded masks of the detections in one array:
+    the number of detections, then the height, width, number of counts and
+    counts of each mask, in column-major order. Padded with a zero to an
+    even length, so that it fills whole 8-byte rows of a YARP image.
+
+    Returns: [1, length] int32 array.
+    """
+    rles = [utils.mask_to_rle(r['masks'][:, :, i]) for i in range(len(r['rois']))]
+    parts = [[len(rles)]]
+    for rle in rles:
+        parts.append([rle['size'][0], rle['size'][1], len(rle['counts'])])
+        parts.append(rle['counts'])
+    packed = np.concatenate(parts).astype(np.int32)
+    if len(packed) % 2:
+        packed = np.append(packed, np.int32(0))
+    return packed[np.newaxis]
+
+
+def array_to_image(array, image):
+    """Points a YARP image at a 2D array of its pixel type, e.g. a
+    yarp.ImageFloat at a float32 array, to send the array without copying
+    it. The array must stay alive until the image is written.
+
+    Returns: The contiguous array the image points at.
+    """
+    array = np.ascontiguousarray(array)
+    image.setExternal(array, array.shape[1], array.shape[0])
+    return array
+
+
+def rle_to_string(r):
+    """Formats the masks of the detections as ((height width) (counts ...))
+    per detection, run-length encoded in column-major order.
+    """
+    rles = [utils.mask_to_rle(r['masks'][:, :, i]) for i in range(len(r['rois']))]
+    return " ".join("(({} {}) ({}))".format(rle['size'][0], rle['size'][1],
+                                            " ".join(map(str, rle['counts'])))
+                    for rle in rles)
+
+
+def object_mask_to_image(r, class_id, out):
+    """Writes the mask of the first detection of class_id to out, a
+    preallocated uint8 image, as 255 on the object and 0 elsewhere. Only
+    the pixels in the bounding box of the object are written besides
+    clearing the image.
+    """
+    out[:] = 0
+    ids = np.where(r['class_ids'] == class_id)[0]
+    if len(ids):
+        y1, x1, y2, x2 = r['rois'][ids[0]]
+        out[y1:y2, x1:x2][r['masks'][y1:y2, x1:x2, ids[0]]] = 255
+    return out
+
+
+def labels_to_image(labels, out):
+    """Writes an instance label map (see the labels mask format) to out, a
+    preallocated uint8 image. Supports up to 255 detections.
+    """
+    np.copyto(out, labels, casting="unsafe")
+    return out